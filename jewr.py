@@ -27,13 +27,756 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 from __future__ import print_function
+import io
 import zipfile
 import sys
 import os
 import argparse
+import collections
+import contextlib
+import functools
+import glob
 import tempfile
 import shutil
+import shlex
+import signal
+import socket
+import sqlite3
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import multiprocessing
+import multiprocessing.pool
+import mmap
 import subprocess
+import struct
+import stat
+import time
+import zlib
+try:
+    # The asyncio API is available on Python 3
+    import asyncio
+    import concurrent.futures
+except ImportError:
+    asyncio = None
+
+# Zip records written by the built-in archive writer
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+CENTRAL_DIR = struct.Struct('<4s4B4HL2L5H2L')
+END_ARCHIVE = struct.Struct('<4s4H2LH')
+END_ARCHIVE64 = struct.Struct('<4sQ2H2L4Q')
+END_ARCHIVE64_LOCATOR = struct.Struct('<4sLQL')
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_ENTRIES_LIMIT = 0xFFFF
+
+
+class ArchiveWriter(object):
+    """Writer for zip archives, unchanged entries are copied from the source
+    archive as they are (compressed) and only new entries are compressed"""
+    chunk_size = 1024 * 1024
+    # New entries of this size or bigger are deflated in chunks in parallel
+    # by the worker threads, when there are more than one
+    parallel_size = 4 * 1024 * 1024
+
+    def __init__(self, fileobj, workers=1):
+        self.fileobj = fileobj
+        self.entries = []
+        self.workers = workers
+
+    def copy_entry(self, source, zinfo):
+        """Copy the entry raw from the source archive file"""
+        offset = self.fileobj.tell()
+        source.seek(zinfo.header_offset)
+        header = source.read(LOCAL_HEADER.size)
+        fields = LOCAL_HEADER.unpack(header)
+        if fields[0] != b'PK\003\004':
+            raise IOError("bad local header of '" + zinfo.filename + "'")
+        name = source.read(fields[10])
+        extra = source.read(fields[11])
+        self.fileobj.write(header + name + extra)
+        self.copy_data(source, zinfo.compress_size)
+        # Data descriptor, with or without the optional signature
+        if zinfo.flag_bits & 0x08:
+            zip64 = 1 in [record[0] for record in self.split_extra(extra)]
+            size_len = 16 if zip64 else 8
+            descriptor = source.read(4)
+            if descriptor != b'PK\007\010':
+                size_len -= 4
+            self.fileobj.write(descriptor + source.read(size_len + 4))
+        self.entries.append((name, zinfo, offset))
+
+    def keep_entry(self, zinfo):
+        """Keep the entry in place, when appending to the archive"""
+        self.entries.append((self.raw_name(zinfo), zinfo, zinfo.header_offset))
+
+    def copy_data(self, source, length):
+        """Copy bytes from the source file in chunks"""
+        while length > 0:
+            chunk = source.read(min(length, self.chunk_size))
+            if not chunk:
+                raise IOError("unexpected end of archive")
+            self.fileobj.write(chunk)
+            length -= len(chunk)
+
+    def write_entry(self, zinfo, fileobj, level=zlib.Z_DEFAULT_COMPRESSION):
+        """Write a new entry from the file object, compress_type and
+        file_size of the zinfo tell how to write it"""
+        name, flags = self.encode_name(zinfo.filename)
+        zinfo.flag_bits = flags
+        zinfo.extra = b''
+        zinfo.CRC = 0
+        zinfo.compress_size = 0
+        zip64 = zinfo.file_size * 1.05 > ZIP64_LIMIT
+        offset = self.fileobj.tell()
+        self.fileobj.write(self.local_header(name, zinfo, zip64))
+        if zinfo.compress_type != zipfile.ZIP_DEFLATED:
+            crc, file_size, compress_size = self.write_data(fileobj)
+        elif self.workers > 1 and zinfo.file_size >= self.parallel_size:
+            crc, file_size, compress_size = self.write_parallel(fileobj,
+                                                                level)
+        else:
+            crc, file_size, compress_size = self.write_data(
+                fileobj, zlib.compressobj(level, zlib.DEFLATED, -15))
+        zinfo.CRC = crc & 0xFFFFFFFF
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        if not zip64 and (file_size >= ZIP64_LIMIT or
+                          compress_size >= ZIP64_LIMIT):
+            raise IOError("'" + zinfo.filename + "' grew too big while " +
+                          "writing it to the archive")
+        # Rewrite the header with the sizes and the checksum
+        end = self.fileobj.tell()
+        self.fileobj.seek(offset)
+        self.fileobj.write(self.local_header(name, zinfo, zip64))
+        self.fileobj.seek(end)
+        self.entries.append((name, zinfo, offset))
+
+    def write_data(self, fileobj, compressor=None):
+        """Write the data of the file object, compressed when the compressor
+        is given. Returns the CRC-32, the size and the compressed size"""
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        while True:
+            chunk = fileobj.read(self.chunk_size)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            compress_size += len(chunk)
+            self.fileobj.write(chunk)
+        if compressor is not None:
+            chunk = compressor.flush()
+            compress_size += len(chunk)
+            self.fileobj.write(chunk)
+        return crc, file_size, compress_size
+
+    def write_parallel(self, fileobj, level):
+        """Write the data of the file object deflated in chunks by the
+        worker threads (zlib releases the GIL), the compressed chunks are
+        written in order. Returns the CRC-32, the size and the compressed
+        size"""
+        pool = multiprocessing.pool.ThreadPool(self.workers)
+        pending = []
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        try:
+            chunk = fileobj.read(self.chunk_size)
+            while chunk:
+                next_chunk = fileobj.read(self.chunk_size)
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+                pending.append(pool.apply_async(
+                    deflate_chunk, (chunk, level, not next_chunk)))
+                chunk = next_chunk
+                # Bounds the chunks in memory, written as they complete
+                while pending and (len(pending) > self.workers * 2 or
+                                   pending[0].ready()):
+                    data = pending.pop(0).get()
+                    compress_size += len(data)
+                    self.fileobj.write(data)
+            for result in pending:
+                data = result.get()
+                compress_size += len(data)
+                self.fileobj.write(data)
+        finally:
+            pool.terminate()
+            pool.join()
+        if not file_size:
+            data = deflate_chunk(b'', level, True)
+            compress_size += len(data)
+            self.fileobj.write(data)
+        return crc, file_size, compress_size
+
+    def close(self, comment=b''):
+        """Write the central directory and the end of the archive"""
+        cd_offset = self.fileobj.tell()
+        for name, zinfo, offset in self.entries:
+            self.fileobj.write(self.central_dir(name, zinfo, offset))
+        cd_size = self.fileobj.tell() - cd_offset
+        count = len(self.entries)
+        if count >= ZIP64_ENTRIES_LIMIT or cd_offset >= ZIP64_LIMIT or \
+                cd_size >= ZIP64_LIMIT:
+            end64_offset = self.fileobj.tell()
+            self.fileobj.write(END_ARCHIVE64.pack(
+                b'PK\006\006', 44, 45, 45, 0, 0, count, count, cd_size,
+                cd_offset))
+            self.fileobj.write(END_ARCHIVE64_LOCATOR.pack(
+                b'PK\006\007', 0, end64_offset, 1))
+            count = min(count, ZIP64_ENTRIES_LIMIT)
+            cd_size = min(cd_size, ZIP64_LIMIT)
+            cd_offset = min(cd_offset, ZIP64_LIMIT)
+        comment = comment[:0xFFFF]
+        self.fileobj.write(END_ARCHIVE.pack(b'PK\005\006', 0, 0, count,
+                                            count, cd_size, cd_offset,
+                                            len(comment)) + comment)
+
+    def local_header(self, name, zinfo, zip64):
+        """Local file header of a new entry"""
+        extra = zinfo.extra
+        file_size = zinfo.file_size
+        compress_size = zinfo.compress_size
+        version = 20
+        if zip64:
+            extra = struct.pack('<HHQQ', 1, 16, file_size, compress_size) +\
+                extra
+            file_size = compress_size = ZIP64_LIMIT
+            version = 45
+        dostime, dosdate = self.dos_date_time(zinfo.date_time)
+        return LOCAL_HEADER.pack(b'PK\003\004', version, 0, zinfo.flag_bits,
+                                 zinfo.compress_type, dostime, dosdate,
+                                 zinfo.CRC, compress_size, file_size,
+                                 len(name), len(extra)) + name + extra
+
+    def central_dir(self, name, zinfo, offset):
+        """Central directory record of an entry"""
+        values = []
+        file_size = zinfo.file_size
+        compress_size = zinfo.compress_size
+        if file_size >= ZIP64_LIMIT:
+            values.append(file_size)
+            file_size = ZIP64_LIMIT
+        if compress_size >= ZIP64_LIMIT:
+            values.append(compress_size)
+            compress_size = ZIP64_LIMIT
+        if offset >= ZIP64_LIMIT:
+            values.append(offset)
+            offset = ZIP64_LIMIT
+        extra = b''.join([record for header_id, record in
+                          self.split_extra(zinfo.extra) if header_id != 1])
+        extract_version = zinfo.extract_version
+        create_version = zinfo.create_version
+        if values:
+            extra = struct.pack('<HH' + 'Q' * len(values), 1,
+                                8 * len(values), *values) + extra
+            extract_version = max(extract_version, 45)
+            create_version = max(create_version, 45)
+        dostime, dosdate = self.dos_date_time(zinfo.date_time)
+        return CENTRAL_DIR.pack(b'PK\001\002', create_version,
+                                zinfo.create_system, extract_version,
+                                zinfo.reserved, zinfo.flag_bits,
+                                zinfo.compress_type, dostime, dosdate,
+                                zinfo.CRC, compress_size, file_size,
+                                len(name), len(extra), len(zinfo.comment), 0,
+                                zinfo.internal_attr, zinfo.external_attr,
+                                offset) + name + extra + zinfo.comment
+
+    @staticmethod
+    def split_extra(extra):
+        """Split the extra field to (header id, record) pairs"""
+        records = []
+        i = 0
+        while i + 4 <= len(extra):
+            header_id, size = struct.unpack('<HH', extra[i:i + 4])
+            records.append((header_id, extra[i:i + 4 + size]))
+            i += 4 + size
+        return records
+
+    @staticmethod
+    def raw_name(zinfo):
+        """File name of the entry as it is stored in the archive"""
+        if isinstance(zinfo.filename, bytes):
+            return zinfo.filename
+        if zinfo.flag_bits & 0x800:
+            return zinfo.filename.encode('utf-8')
+        return zinfo.filename.encode('cp437')
+
+    @staticmethod
+    def encode_name(filename):
+        """Encode the file name, returns the name and the flag bits"""
+        if isinstance(filename, bytes):
+            return filename, 0
+        try:
+            return filename.encode('ascii'), 0
+        except UnicodeEncodeError:
+            return filename.encode('utf-8'), 0x800
+
+    @staticmethod
+    def dos_date_time(date_time):
+        """MS-DOS time and date of the date time tuple"""
+        year, month, day, hour, minute, second = date_time[0:6]
+        dosdate = (max(year, 1980) - 1980) << 9 | month << 5 | day
+        dostime = hour << 11 | minute << 5 | (second // 2)
+        return dostime, dosdate
+
+
+class ArchivePool(object):
+    """Thread-safe pool of the opened archive files keyed by their path,
+    inode, size and modification time. The least recently used archives are
+    closed when the pool is full, and the archives of a changed file when it
+    is opened again"""
+    size = 16
+
+    def __init__(self, size=None, opener=None):
+        if size is not None:
+            self.size = size
+        # Opens the archive file for reading
+        self.opener = opener or zipfile.ZipFile
+        self.archives = {}
+        # Keys of the archives, least recently used first
+        self.order = []
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self, filename):
+        """Open the archive file for reading, or return it from the pool"""
+        info = os.stat(filename)
+        path = os.path.abspath(filename)
+        key = (path, info.st_ino, info.st_size, info.st_mtime)
+        with self.lock:
+            if key in self.archives:
+                self.hits += 1
+                self.order.remove(key)
+                self.order.append(key)
+                return self.archives[key]
+            self.misses += 1
+            for stale in [elem for elem in self.order if elem[0] == path]:
+                self.discard(stale)
+            self.archives[key] = self.opener(filename)
+            self.order.append(key)
+            while len(self.order) > self.size:
+                self.discard(self.order[0])
+            return self.archives[key]
+
+    def discard(self, key):
+        """Close the archive of the key and remove it from the pool"""
+        self.order.remove(key)
+        self.archives.pop(key).close()
+        return True
+
+    def discard_path(self, path):
+        """Close the archives of the file, or the files under the dir (a
+        temp dir to be removed), and remove them from the pool"""
+        with self.lock:
+            if not self.order:
+                return True
+            path = os.path.abspath(path)
+            for key in [key for key in self.order if key[0] == path or
+                        key[0].startswith(path + os.sep)]:
+                self.discard(key)
+        return True
+
+    def pooled(self, contents):
+        """Whether the opened archive is held by the pool"""
+        with self.lock:
+            return any(contents is elem for elem in self.archives.values())
+
+    def close(self):
+        """Close all of the archives of the pool"""
+        with self.lock:
+            while self.order:
+                self.discard(self.order[0])
+        return True
+
+
+class MappedArchive(object):
+    """Read-only zip archive (duck typed as zipfile.ZipFile) on a memory map
+    of the archive file. The (zip64) central directory is parsed lazily into
+    an index of offsets and the entries are read by their offsets, so only
+    the touched parts of the archive are paged in"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = None
+        self.index = None
+        with open(filename, 'rb') as archive_file:
+            try:
+                self.fp = mmap.mmap(archive_file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                raise zipfile.BadZipfile("File is not a zip file")
+        try:
+            self.read_end()
+        except BaseException:
+            self.fp.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read_end(self):
+        """Read the (zip64) end of central directory records"""
+        end = self.fp.rfind(b'PK\005\006', max(
+            len(self.fp) - END_ARCHIVE.size - 0xFFFF, 0))
+        if end < 0 or end + END_ARCHIVE.size > len(self.fp):
+            raise zipfile.BadZipfile("File is not a zip file")
+        fields = END_ARCHIVE.unpack(self.fp[end:end + END_ARCHIVE.size])
+        self.count, self.cd_size, self.start_dir = fields[4:7]
+        self.comment = self.fp[end + END_ARCHIVE.size:end + END_ARCHIVE.size +
+                               fields[7]]
+        locator = end - END_ARCHIVE64_LOCATOR.size
+        end64 = locator - END_ARCHIVE64.size
+        if end64 >= 0 and self.fp[locator:locator + 4] == b'PK\006\007' and \
+                self.fp[end64:end64 + 4] == b'PK\006\006':
+            fields = END_ARCHIVE64.unpack(self.fp[end64:locator])
+            self.count, self.cd_size, self.start_dir = fields[7:10]
+            end = end64
+        # Data prepended to the archive shifts the offsets
+        self.concat = end - self.cd_size - self.start_dir
+        if self.concat < 0:
+            raise zipfile.BadZipfile("Bad offset for central directory")
+        self.start_dir += self.concat
+        return True
+
+    def iterinfo(self):
+        """Generate (offset, info) of the central directory records"""
+        offset = self.start_dir
+        for _ in range(self.count):
+            zinfo, next_offset = self.read_info(offset)
+            yield offset, zinfo
+            offset = next_offset
+
+    def read_info(self, offset):
+        """Read the info of the entry from the central directory record,
+        returns the info and the offset of the next record"""
+        fields = CENTRAL_DIR.unpack(self.fp[offset:offset + CENTRAL_DIR.size])
+        if fields[0] != b'PK\001\002':
+            raise zipfile.BadZipfile("Bad magic number for central directory")
+        offset += CENTRAL_DIR.size
+        raw_name = self.fp[offset:offset + fields[12]]
+        offset += fields[12]
+        if fields[5] & 0x800:
+            name = raw_name.decode('utf-8')
+        elif sys.version_info[0] < 3:
+            name = raw_name
+        else:
+            name = raw_name.decode('cp437')
+        zinfo = zipfile.ZipInfo(name, ((fields[8] >> 9) + 1980,
+                                       (fields[8] >> 5) & 0xF,
+                                       fields[8] & 0x1F, fields[7] >> 11,
+                                       (fields[7] >> 5) & 0x3F,
+                                       (fields[7] & 0x1F) * 2))
+        zinfo.extra = self.fp[offset:offset + fields[13]]
+        zinfo.comment = self.fp[offset + fields[13]:offset + fields[13] +
+                                fields[14]]
+        (zinfo.create_version, zinfo.create_system, zinfo.extract_version,
+         zinfo.reserved, zinfo.flag_bits, zinfo.compress_type) = fields[1:7]
+        (zinfo.CRC, zinfo.compress_size, zinfo.file_size) = fields[9:12]
+        (zinfo.volume, zinfo.internal_attr, zinfo.external_attr,
+         zinfo.header_offset) = fields[15:19]
+        # Zip64 extra has the sizes and the offset that did not fit
+        for header_id, record in ArchiveWriter.split_extra(zinfo.extra):
+            if header_id != 1:
+                continue
+            values = list(struct.unpack('<%dQ' % ((len(record) - 4) // 8),
+                                        record[4:4 + (len(record) - 4) //
+                                               8 * 8]))
+            for attr in ('file_size', 'compress_size', 'header_offset'):
+                if getattr(zinfo, attr) == ZIP64_LIMIT and values:
+                    setattr(zinfo, attr, values.pop(0))
+        zinfo.header_offset += self.concat
+        return zinfo, offset + fields[13] + fields[14]
+
+    def build_index(self):
+        """Index the offsets of the central directory records by name, the
+        last one of the duplicate entries is valid"""
+        if self.index is None:
+            index = {}
+            for offset, zinfo in self.iterinfo():
+                index[zinfo.filename] = offset
+            self.index = index
+        return self.index
+
+    def namelist(self):
+        """Names of the entries in the central directory order"""
+        return [zinfo.filename for _, zinfo in self.iterinfo()]
+
+    def infolist(self):
+        """Infos of the entries in the central directory order"""
+        return [zinfo for _, zinfo in self.iterinfo()]
+
+    def getinfo(self, name):
+        """Info of the entry, KeyError when there is no such entry"""
+        try:
+            offset = self.build_index()[name]
+        except KeyError:
+            raise KeyError("There is no item named %r in the archive" % name)
+        return self.read_info(offset)[0]
+
+    def data_offset(self, zinfo):
+        """Offset of the (compressed) data of the entry"""
+        offset = zinfo.header_offset
+        fields = LOCAL_HEADER.unpack(self.fp[offset:offset +
+                                             LOCAL_HEADER.size])
+        if fields[0] != b'PK\003\004':
+            raise zipfile.BadZipfile("Bad magic number for file header")
+        return offset + LOCAL_HEADER.size + fields[10] + fields[11]
+
+    def open(self, name, mode='r'):
+        """Open the entry (name or info) for reading"""
+        if mode != 'r':
+            raise RuntimeError('open() requires mode "r"')
+        zinfo = name if isinstance(name, zipfile.ZipInfo) else \
+            self.getinfo(name)
+        if zinfo.flag_bits & 0x1:
+            raise RuntimeError("File %s is encrypted" % zinfo.filename)
+        if zinfo.compress_type not in (zipfile.ZIP_STORED,
+                                       zipfile.ZIP_DEFLATED):
+            raise NotImplementedError("compression type %d" %
+                                      zinfo.compress_type)
+        return MappedEntry(self.fp, zinfo, self.data_offset(zinfo))
+
+    def read(self, name):
+        """Read the (uncompressed) data of the entry"""
+        entry = self.open(name)
+        try:
+            return entry.read()
+        finally:
+            entry.close()
+
+    def extract(self, member, path=None):
+        """Extract the entry to the path, returns the extracted file"""
+        zinfo = member if isinstance(member, zipfile.ZipInfo) else \
+            self.getinfo(member)
+        target = os.path.join(path or os.getcwd(), *[
+            elem for elem in zinfo.filename.split('/') if
+            elem not in ('', '.', '..')])
+        if zinfo.filename.endswith('/'):
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            return target
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        source = self.open(zinfo)
+        try:
+            with open(target, 'wb') as output:
+                shutil.copyfileobj(source, output)
+        finally:
+            source.close()
+        return target
+
+    def close(self):
+        """Close the memory map"""
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        return True
+
+
+class MappedEntry(object):
+    """Reader of an entry of the memory mapped archive, the data is
+    decompressed in chunks as it is read and the CRC is checked at the end"""
+    chunk_size = 64 * 1024
+
+    def __init__(self, mapped, zinfo, offset):
+        self.mapped = mapped
+        self.zinfo = zinfo
+        self.offset = offset
+        self.end = offset + zinfo.compress_size
+        self.left = zinfo.file_size
+        self.crc = 0
+        # Decompressed data and the read position in it
+        self.buffer = b''
+        self.position = 0
+        self.decompressor = zlib.decompressobj(-15) if \
+            zinfo.compress_type == zipfile.ZIP_DEFLATED else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def fill(self):
+        """Read and decompress the next chunk of the data"""
+        chunk = self.mapped[self.offset:min(self.offset + self.chunk_size,
+                                            self.end)]
+        self.offset += len(chunk)
+        if self.decompressor is not None:
+            chunk = self.decompressor.decompress(chunk)
+            if self.offset == self.end:
+                chunk += self.decompressor.flush()
+        self.buffer = chunk
+        self.position = 0
+        return True
+
+    def read(self, size=-1):
+        """Read up to size bytes (all of the rest when negative)"""
+        if size is None or size < 0:
+            size = self.left
+        chunks = []
+        length = 0
+        while length < size:
+            if self.position == len(self.buffer):
+                if self.offset >= self.end:
+                    break
+                self.fill()
+                continue
+            chunk = self.buffer[self.position:self.position + size - length]
+            self.position += len(chunk)
+            chunks.append(chunk)
+            length += len(chunk)
+        data = b''.join(chunks)
+        self.left -= len(data)
+        self.crc = zlib.crc32(data, self.crc)
+        if data and self.left <= 0 and self.crc & 0xFFFFFFFF != \
+                self.zinfo.CRC:
+            raise zipfile.BadZipfile("Bad CRC-32 for file %r" %
+                                     self.zinfo.filename)
+        return data
+
+    def close(self):
+        """Release the buffered data"""
+        self.buffer = b''
+        self.position = 0
+        return True
+
+
+class ArchiveWindow(object):
+    """Read-only seekable file of a region of a file, for opening an
+    archive stored (uncompressed) in its parent archive in place. The source
+    is the path of the file, opened by the window, or a file object shared
+    with the parent archive"""
+
+    def __init__(self, source, start, size):
+        if hasattr(source, 'read'):
+            self.fileobj = source
+            self.filename = None
+        else:
+            self.fileobj = open(source, 'rb')
+            self.filename = source
+        self.start = start
+        self.size = size
+        self.position = 0
+
+    def read(self, size=-1):
+        """Read up to size bytes (all of the rest when negative)"""
+        left = max(self.size - self.position, 0)
+        if size is None or size < 0 or size > left:
+            size = left
+        self.fileobj.seek(self.start + self.position)
+        data = self.fileobj.read(size)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Move the position in the window"""
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError("Invalid seek position " + str(offset))
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        """Position in the window"""
+        return self.position
+
+    def seekable(self):
+        """Windows are seekable"""
+        return True
+
+    def readable(self):
+        """Windows are readable"""
+        return True
+
+    def close(self):
+        """Close the file opened by the window"""
+        if self.filename is not None:
+            self.fileobj.close()
+        return True
+
+
+def interrupt_handler(signum, frame):
+    """Signal handler raising KeyboardInterrupt, for stopping the server on
+    SIGTERM as on interrupt"""
+    raise KeyboardInterrupt("signal " + str(signum))
+
+
+def deflate_chunk(data, level, last):
+    """Raw deflate the chunk of the file, the chunks before the last one end
+    at a byte boundary with a sync flush so that the compressed chunks can be
+    concatenated to one deflate stream (as in pigz)"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def inflate_chunks(data, compress_type, chunk_size):
+    """Generate the decompressed chunks (up to chunk_size) of the stored or
+    deflated data of a file"""
+    if compress_type != zipfile.ZIP_DEFLATED:
+        for position in range(0, len(data), chunk_size):
+            yield data[position:position + chunk_size]
+        return
+    decompressor = zlib.decompressobj(-15)
+    position = 0
+    while position < len(data) or decompressor.unconsumed_tail:
+        if decompressor.unconsumed_tail:
+            compressed = decompressor.unconsumed_tail
+        else:
+            compressed = data[position:position + chunk_size]
+            position += len(compressed)
+        yield decompressor.decompress(compressed, chunk_size)
+    chunk = decompressor.flush()
+    if chunk:
+        yield chunk
+
+
+def digest_chunks(chunks, algorithm=None):
+    """Returns (CRC-32, size, hex digest or None) of the chunks"""
+    digest = hashlib.new(algorithm) if algorithm else None
+    crc = 0
+    size = 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        if digest is not None:
+            digest.update(chunk)
+    return (crc & 0xFFFFFFFF, size,
+            digest.hexdigest() if digest is not None else None)
+
+
+def verify_raw_entries(entries, algorithm, chunk_size):
+    """Returns the (CRC-32, size, hex digest) list of the (compressed data,
+    compress type) list of files, CRC-32 is None for broken data (run by the
+    worker processes)"""
+    results = []
+    for data, compress_type in entries:
+        try:
+            results.append(digest_chunks(inflate_chunks(
+                data, compress_type, chunk_size), algorithm))
+        except zlib.error:
+            results.append((None, 0, None))
+    return results
 
 
 # pylint: disable=bad-indentation
@@ -41,43 +784,470 @@ class JarEarWarRar(object):
     """Class for manipulating java archives"""
     known_types = ['.jar', '.ear', '.rar', '.war']
     tmp_dir = ""
+    # Temp dir in /dev/shm for the levels fitting the memory budget
+    shm_dir = None
     destination_dir = None
+    # Set while a file is written to STDOUT, the messages go to STDERR then
+    stdout_data = False
     jar_command = ""
     verbosity = False
+    # Nested archives up to this size (uncompressed, in bytes) are opened
+    # in memory, bigger ones are extracted to the temp dir
+    memory_limit = 64 * 1024 * 1024
+    # Memory (in bytes) for the nested archives read in memory and extracted
+    # to /dev/shm, the others are extracted to the temp dir on disk. Without
+    # the budget the whole temp dir is in /dev/shm when it is available
+    memory_budget = None
+    # File list cache is used when the cache dir is set
+    cache_dir = None
+    cache_size = 64 * 1024 * 1024
+    # Nested archives extracted to disk are cached (by their CRC-32 and
+    # size) in the archives dir of the cache dir up to this size
+    archive_cache_size = 1024 * 1024 * 1024
+    # Counter of the shared archives for naming their temp dirs
+    shared_count = 0
+    # Number of the archive files kept open between the operations
+    pool_size = 16
+    # Number of the outermost archives the server keeps their (nested)
+    # archives open for, the least recently requested ones are closed
+    served_size = 8
+    # Seconds the server waits for the request of the client, the
+    # connections are served one at a time
+    serve_timeout = 60
+    # Records of the timed stages are kept when set to a list
+    stats = None
+    # Archive files of this size (in bytes) or bigger are memory mapped
+    mapped_size = 256 * 1024 * 1024
+    # Files are searched in chunks of this size, the matches can be up to
+    # grep_overlap bytes long
+    chunk_size = 64 * 1024
+    grep_overlap = 4096
+    # Files are verified by the workers in batches of this size (compressed)
+    verify_batch_size = 1024 * 1024
+    # Prefixes of the class dirs dropped from the class names in the index
+    class_dirs = ['WEB-INF/classes/', 'BOOT-INF/classes/']
+    # Number of the archive name tables and resolved paths memoized
+    resolve_size = 1024
+    # Deflate level of the entries written by the archive writer (0 stores
+    # them). The nested archives and the files of the compressed types are
+    # stored when store_compressed is set, and the replaced entries keep
+    # their original compression method when keep_method is set
+    compress_level = zlib.Z_DEFAULT_COMPRESSION
+    store_compressed = False
+    compressed_types = ['.gz', '.tgz', '.zip', '.bz2', '.xz', '.png', '.jpg',
+                        '.jpeg', '.gif', '.woff', '.woff2']
+    keep_method = False
+    # Number of the threads compressing the big files written to the
+    # archives (defaults to number of CPUs)
+    compress_workers = None
+
+    def __init__(self):
+        self.archive_pool = ArchivePool(self.pool_size,
+                                        self.open_archive_file)
+        # Callables called with the record of each timed stage
+        self.hooks = []
+        # Memoized names of the archives and resolved paths
+        self.name_tables = {}
+        self.resolved_paths = {}
+        # Bytes charged to the memory budget by the archive (or file) names,
+        # and the placed temp dirs of the update levels
+        self.memory_used = 0
+        self.memory_charges = {}
+        self.level_dirs = {}
+        # Numbers of the archives sharing the charged bytes, and the charged
+        # names of the windows opened in place of the charged archives
+        self.memory_refs = {}
+        self.memory_shares = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the archive files kept open"""
+        return self.archive_pool.close()
+
+    @contextlib.contextmanager
+    def stage(self, name, level=None, **args):
+        """Time the stage of an operation at the nesting level, the bytes
+        read, decompressed and written can be counted in the yielded record.
+        The record is kept in stats (when set) and passed to the hooks"""
+        record = {'name': name, 'level': level, 'args': args,
+                  'bytes_read': 0, 'bytes_decompressed': 0,
+                  'bytes_written': 0, 'start': time.time(),
+                  'thread': threading.current_thread().ident}
+        try:
+            yield record
+        finally:
+            record['duration'] = time.time() - record['start']
+            if self.stats is not None:
+                self.stats.append(record)
+            for hook in self.hooks:
+                hook(record)
+
+    def stage_size(self, filename):
+        """Size of the file for the stage records (0 if it is missing)"""
+        try:
+            return os.path.getsize(filename)
+        except OSError:
+            return 0
+
+    def add_hook(self, hook):
+        """Add a callable to be called with the record of each timed stage:
+        name, level, args, start, duration, thread and bytes_read,
+        bytes_decompressed and bytes_written"""
+        self.hooks.append(hook)
+        return True
+
+    def stats_summary(self):
+        """Summary lines of the timed stages by name and nesting level"""
+        totals = {}
+        for record in self.stats or []:
+            level = '-' if record['level'] is None else str(record['level'])
+            total = totals.setdefault((record['name'], level),
+                                      [0, 0.0, 0, 0, 0])
+            total[0] += 1
+            total[1] += record['duration']
+            total[2] += record['bytes_read']
+            total[3] += record['bytes_decompressed']
+            total[4] += record['bytes_written']
+        lines = ['%-12s %-8s %6s %10s %12s %12s %12s' % (
+            'stage', 'level', 'count', 'seconds', 'read', 'decompressed',
+            'written')]
+        for key in sorted(totals, key=lambda key: -totals[key][1]):
+            lines.append('%-12s %-8s %6d %10.4f %12d %12d %12d' % (
+                key + tuple(totals[key])))
+        return lines
+
+    def write_trace(self, filename):
+        """Write the timed stages as Chrome trace event JSON"""
+        events = []
+        for record in self.stats or []:
+            args = dict(record['args'])
+            for key in ('level', 'bytes_read', 'bytes_decompressed',
+                        'bytes_written'):
+                args[key] = record[key]
+            events.append({'name': record['name'], 'cat': 'jewr', 'ph': 'X',
+                           'ts': int(record['start'] * 1000000),
+                           'dur': int(record['duration'] * 1000000),
+                           'pid': os.getpid(), 'tid': record['thread'],
+                           'args': args})
+        with open(filename, 'w') as trace:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace)
+        return True
 
     # pylint: disable=no-self-use
-    def extract_file(self, filename, target_file, target_dir):
-        """Exctract a file from the archive file"""
-        if self.verbosity:
-            self.console_out("Processing extract...", filename)
-        contents = zipfile.ZipFile(filename, 'r')
-        files = [elem for elem in contents.namelist() if not elem.endswith(
-            os.sep)]
+    def open_archive(self, filename):
+        """Open an archive file for reading (opened archives pass through),
+        the archive files are kept open in the pool"""
+        if hasattr(filename, 'namelist'):
+            return filename
+        if self.pool_size:
+            return self.archive_pool.open(filename)
+        return self.open_archive_file(filename)
 
-        if target_file not in files:
+    def open_archive_file(self, filename):
+        """Open an archive file for reading, big archives are memory mapped
+        and their central directory is read lazily"""
+        if os.path.getsize(filename) >= self.mapped_size:
+            return MappedArchive(filename)
+        return zipfile.ZipFile(filename, 'r')
+
+    def archive_name(self, filename):
+        """Name of the archive file or the opened archive"""
+        return str(getattr(filename, 'filename', filename))
+
+    def get_file_info(self, filename, target_file):
+        """Get the info of a file (not a directory) in the archive"""
+        contents = self.open_archive(filename)
+        try:
+            if target_file.endswith(os.sep):
+                raise KeyError(target_file)
+            return contents.getinfo(target_file)
+        except KeyError:
             raise IOError("file '" + target_file + "' not found in '" +
-                          filename + "'")
-        contents.extract(target_file, target_dir)
+                          self.archive_name(filename) + "'")
+
+    def extract_file(self, filename, target_file, target_dir, level=None):
+        """Exctract a file from the archive file"""
+        if self.verbosity:
+            self.console_out("Processing extract...",
+                             self.archive_name(filename))
+        with self.stage('extract', level, file=target_file) as record:
+            contents = self.open_archive(filename)
+            info = self.get_file_info(contents, target_file)
+            contents.extract(target_file, target_dir)
+            record['bytes_read'] = info.compress_size
+            record['bytes_decompressed'] = info.file_size
+            record['bytes_written'] = info.file_size
         return True
 
     def extract_filelist(self, filename, fpfilter=None):
         """List files in the archive file"""
         if self.verbosity:
-            self.console_out("Processing file list...", filename)
-        contents = zipfile.ZipFile(filename, 'r')
+            self.console_out("Processing file list...",
+                             self.archive_name(filename))
+        contents = self.open_archive(filename)
         if fpfilter is None:
             return contents.namelist()
-        else:
-            filelist = [elem for elem in contents.namelist() if
-                        elem.startswith(fpfilter)]
+        return self.filter_filelist(contents.namelist(), fpfilter,
+                                    self.archive_name(filename))
+
+    def filter_filelist(self, filelist, fpfilter, filename):
+        """Filter the file list of the archive with the path prefix"""
+        filelist = [elem for elem in filelist if elem.startswith(fpfilter)]
         if filelist.__len__() == 0:
             raise IOError("'" + fpfilter + "' not found in '" + filename +
                           "'")
         return filelist
 
+    def open_nested_archive(self, contents, archive_file, level):
+        """Open an archive inside the opened archive. Stored archives are
+        opened in place, archives up to memory_limit are read in memory,
+        bigger ones are extracted to the temp dir of the nesting level"""
+        info = self.get_file_info(contents, archive_file)
+        if info.compress_type == zipfile.ZIP_STORED and \
+                not info.flag_bits & 0x1:
+            if self.verbosity:
+                self.console_out("Processing in place...", archive_file)
+            with self.stage('window', level, file=archive_file):
+                nested = zipfile.ZipFile(self.open_window(contents, info),
+                                         'r')
+            nested.filename = self.archive_name(contents) + os.sep +\
+                archive_file
+            self.share_memory(self.archive_name(contents), nested.filename)
+            return nested
+        name = self.archive_name(contents) + os.sep + archive_file
+        if info.file_size <= self.memory_limit and \
+                self.charge_memory(name, info.file_size):
+            if self.verbosity:
+                self.console_out("Processing in memory...", archive_file)
+            try:
+                with self.stage('read', level, file=archive_file) as record:
+                    nested = zipfile.ZipFile(io.BytesIO(contents.read(
+                        archive_file)), 'r')
+                    record['bytes_read'] = info.compress_size
+                    record['bytes_decompressed'] = info.file_size
+            except BaseException:
+                self.release_memory(name)
+                raise
+            # Name the in-memory archive after its path for the messages
+            nested.filename = name
+            return nested
+        if self.cache_dir is not None:
+            try:
+                return self.open_cached_archive(contents, archive_file, info,
+                                                level)
+            except (IOError, OSError) as ex:
+                if self.verbosity:
+                    self.console_err("Unable to cache archive:", str(ex))
+        subdir = self.place_temp(str(level), archive_file, info.file_size)
+        self.extract_file(contents, archive_file, subdir, level)
+        return self.open_archive_file(subdir + os.sep + archive_file)
+
+    def charge_memory(self, name, size):
+        """Charge the bytes of the archive (or file) name to the memory
+        budget, false when they do not fit in it"""
+        if self.memory_budget is None:
+            return True
+        if self.memory_used + size > self.memory_budget:
+            return False
+        self.memory_used += size
+        self.memory_charges[name] = self.memory_charges.get(name, 0) + size
+        return True
+
+    def share_memory(self, name, window):
+        """Share the bytes charged by the archive name (in memory or in
+        /dev/shm) with the window opened in place of it"""
+        name = self.memory_shares.get(name, name)
+        if name in self.memory_charges:
+            self.memory_refs[name] = self.memory_refs.get(name, 1) + 1
+            self.memory_shares[window] = name
+        return True
+
+    def release_memory(self, name):
+        """Release the bytes charged by the name from the memory budget,
+        when the last of the archives sharing them is closed"""
+        name = self.memory_shares.pop(name, name)
+        if self.memory_refs.get(name, 1) > 1:
+            self.memory_refs[name] -= 1
+            return True
+        self.memory_refs.pop(name, None)
+        self.memory_used -= self.memory_charges.pop(name, 0)
+        return True
+
+    def place_temp(self, subdir, filename, size):
+        """Temp dir (subdir) for extracting the file of the size: in
+        /dev/shm when it fits the memory budget, otherwise on disk"""
+        if self.memory_budget is None:
+            return self.tmp_dir + os.sep + subdir
+        if self.shm_dir is not None and self.charge_memory(
+                self.shm_dir + os.sep + subdir + os.sep + filename, size):
+            return self.shm_dir + os.sep + subdir
+        if self.verbosity:
+            self.console_out("Processing on disk...", filename)
+        return self.tmp_dir + os.sep + subdir
+
+    def level_dir(self, subdir, filename=None, archive_file=None):
+        """Temp dir of the update level, placed at the first call by the
+        size of the archive file extracted there from the file (and the
+        copy of it written when repacking), memoized until the next update"""
+        if subdir in self.level_dirs:
+            return self.level_dirs[subdir]
+        if filename is None:
+            return self.tmp_dir + os.sep + subdir
+        size = 0
+        if self.memory_budget is not None:
+            size = 2 * self.get_file_info(filename, archive_file).file_size
+        self.level_dirs[subdir] = self.place_temp(subdir, archive_file, size)
+        return self.level_dirs[subdir]
+
+    def release_levels(self):
+        """Remove the temp dirs of the levels of the previous update placed
+        in /dev/shm and release their memory"""
+        for level_dir in self.level_dirs.values():
+            if self.shm_dir is not None and \
+                    level_dir.startswith(self.shm_dir + os.sep):
+                shutil.rmtree(level_dir, ignore_errors=True)
+                for name in list(self.memory_charges):
+                    if name.startswith(level_dir + os.sep):
+                        self.release_memory(name)
+        self.level_dirs = {}
+        return True
+
+    def open_cached_archive(self, contents, archive_file, info, level):
+        """Open the nested archive from the archive cache, where the
+        archives are shared by their contents (CRC-32 and size) across the
+        parent archives and the runs. Extracted to the cache on cache miss"""
+        cache_dir = self.cache_dir + os.sep + 'archives'
+        cache_file = cache_dir + os.sep + self.cache_key(
+            info.CRC, info.file_size) + os.path.splitext(archive_file)[1]
+        try:
+            # Recently used archives are evicted last
+            os.utime(cache_file, None)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # Extracted to a dir of its own, concurrent runs may extract the
+            # same archive and the last one is kept
+            subdir = tempfile.mkdtemp(prefix='.jewr', dir=cache_dir)
+            try:
+                self.extract_file(contents, archive_file, subdir, level)
+                os.rename(subdir + os.sep + archive_file, cache_file)
+            finally:
+                shutil.rmtree(subdir, ignore_errors=True)
+        else:
+            if self.verbosity:
+                self.console_out("Using cached archive...", archive_file)
+        nested = self.open_archive_file(cache_file)
+        self.evict_cache(cache_dir, self.archive_cache_size)
+        return nested
+
+    def open_window(self, contents, info):
+        """Open the stored file of the opened archive as a window of the
+        file (or the data in memory) of the archive"""
+        offset = self.entry_offset(contents, info)
+        if isinstance(contents.fp, ArchiveWindow):
+            return ArchiveWindow(contents.fp.filename or contents.fp.fileobj,
+                                 contents.fp.start + offset, info.file_size)
+        if hasattr(contents.fp, 'getvalue'):
+            return ArchiveWindow(contents.fp, offset, info.file_size)
+        return ArchiveWindow(self.archive_name(contents), offset,
+                             info.file_size)
+
+    def entry_offset(self, contents, zinfo):
+        """Offset of the (compressed) data of the file in the archive"""
+        contents.fp.seek(zinfo.header_offset)
+        fields = LOCAL_HEADER.unpack(contents.fp.read(LOCAL_HEADER.size))
+        if fields[0] != b'PK\003\004':
+            raise IOError("Bad local header of '" + zinfo.filename + "'")
+        return zinfo.header_offset + LOCAL_HEADER.size + fields[10] + \
+            fields[11]
+
+    def open_archive_path(self, java_filelist, opened=None):
+        """Open the innermost archive of the list of nested archives. The
+        archives are shared through the opened dict (keyed by the tuple of
+        nested archives) when given, and left open then"""
+        if opened is None:
+            contents = self.open_archive(java_filelist[0])
+            for i in range(1, len(java_filelist)):
+                nested = self.open_nested_archive(contents, java_filelist[i],
+                                                  i - 1)
+                self.close_archive(contents)
+                contents = nested
+            return contents
+        key = tuple(java_filelist)
+        if key not in opened:
+            if len(key) == 1:
+                opened[key] = self.open_archive(key[0])
+            else:
+                parent = self.open_archive_path(java_filelist[:-1], opened)
+                # Each of the shared archives has a temp dir of its own
+                self.shared_count += 1
+                opened[key] = self.open_nested_archive(
+                    parent, key[-1], 'shared' + str(self.shared_count))
+        return opened[key]
+
+    def release_archive(self, contents):
+        """Close the archive unless it is kept open in the pool"""
+        if not self.archive_pool.pooled(contents):
+            fileobj = getattr(contents, 'fp', None)
+            contents.close()
+            if isinstance(fileobj, ArchiveWindow):
+                fileobj.close()
+        return True
+
+    def close_archive(self, contents):
+        """Close the archive, archives extracted to temp dir are removed"""
+        self.release_archive(contents)
+        filename = self.archive_name(contents)
+        if [temp_dir for temp_dir in (self.tmp_dir, self.shm_dir)
+                if temp_dir and filename.startswith(temp_dir + os.sep)] and \
+                os.path.isfile(filename):
+            os.remove(filename)
+        self.release_memory(filename)
+        return True
+
+    def walk_filelist(self, contents, prefix, level, fpfilter=None):
+        """Generate the files of the archive and its nested archives with
+        their full nested paths, the filter applies to the files of the
+        archive itself"""
+        for _, _, path in self.walk_archive(contents, prefix, level,
+                                            fpfilter):
+            yield path
+
+    def walk_archive(self, contents, prefix, level, fpfilter=None,
+                     descend=None):
+        """Generate (archive, info, nested path) of the files of the archive
+        and its nested archives, the archive of the file is open until the
+        next one is generated. Nested archives are descended into when
+        descend(nested path) is true (or not given)"""
+        for zinfo in contents.infolist():
+            name = zinfo.filename
+            if fpfilter is not None and not name.startswith(fpfilter):
+                continue
+            path = prefix + os.sep + name if prefix else name
+            yield contents, zinfo, path
+            if not name.endswith(tuple(self.known_types)) or \
+                    (descend is not None and not descend(path)):
+                continue
+            try:
+                nested = self.open_nested_archive(contents, name, level)
+            except zipfile.BadZipfile:
+                self.console_err("Skipping broken archive", path)
+                continue
+            try:
+                for nested_file in self.walk_archive(nested, path, level + 1,
+                                                     descend=descend):
+                    yield nested_file
+            finally:
+                self.close_archive(nested)
+
     def console_out(self, *objs):
-        """Console out for STDOUT"""
-        print(*objs, file=sys.stdout)
+        """Console out for STDOUT (STDERR while writing a file to STDOUT)"""
+        print(*objs, file=sys.stderr if self.stdout_data else sys.stdout)
         return True
 
     def console_err(self, *objs):
@@ -85,15 +1255,25 @@ class JarEarWarRar(object):
         print(*objs, file=sys.stderr)
         return True
 
-    def update_file(self, filename, archive_path, target_dir):
+    def update_file(self, filename, archive_path, target_dir, level=None):
         """Update file into the archive"""
         if self.verbosity:
             self.console_out("Processing repack...", filename)
-        process = subprocess.Popen([self.jar_command, 'uf', filename,
-                                   '-C', target_dir, archive_path],
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
-        out, err = process.communicate()
+        with self.stage('update', level, file=archive_path) as record:
+            record['bytes_read'] = self.stage_size(filename)
+            # The jar command is used only when it has been set
+            if not self.jar_command:
+                self.repack_archive(filename, {archive_path: target_dir +
+                                               os.sep + archive_path})
+                record['bytes_written'] = self.stage_size(filename)
+                return True
+            options = 'uf0' if self.compress_level == 0 else 'uf'
+            process = subprocess.Popen([self.jar_command, options, filename,
+                                       '-C', target_dir, archive_path],
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            out, err = process.communicate()
+            record['bytes_written'] = self.stage_size(filename)
         issue_triggered = False
         error_msg = ""
         # This roughly assumes that jar comman will keep silent if everything
@@ -108,6 +1288,275 @@ class JarEarWarRar(object):
         if issue_triggered:
             raise IOError("Unknown issue with jar executable." + err_msg)
 
+    def append_file(self, filename, archive_path, target_dir, level=None):
+        """Append file into the end of the archive"""
+        if self.verbosity:
+            self.console_out("Processing append...", filename)
+        with self.stage('append', level, file=archive_path) as record:
+            size = self.stage_size(filename)
+            self.append_archive(filename, {archive_path: target_dir +
+                                           os.sep + archive_path})
+            record['bytes_written'] = self.stage_size(filename) - size
+        return True
+
+    def append_archive(self, filename, replacements):
+        """Append the replaced (or added) files and a new central directory
+        to the end of the archive, the old files are left as dead space"""
+        with open(filename, 'r+b') as output:
+            self.write_appended(output, replacements)
+        return True
+
+    def write_appended(self, output, replacements):
+        """Append the replaced files to the archive opened for update"""
+        contents = zipfile.ZipFile(output, 'r')
+        replacements = dict(replacements)
+        writer = ArchiveWriter(output, self.compress_workers or
+                               multiprocessing.cpu_count())
+        # New entries overwrite the old central directory, which is
+        # written back when the append fails
+        output.seek(contents.start_dir)
+        directory = output.read()
+        output.seek(contents.start_dir)
+        try:
+            for zinfo in contents.infolist():
+                if contents.getinfo(zinfo.filename) is not zinfo:
+                    continue
+                if zinfo.filename in replacements:
+                    self.write_replacement(writer, zinfo.filename,
+                                           replacements.pop(zinfo.filename),
+                                           zinfo)
+                else:
+                    writer.keep_entry(zinfo)
+            for archive_path in sorted(replacements):
+                self.write_replacement(writer, archive_path,
+                                       replacements[archive_path])
+            writer.close(contents.comment)
+        except BaseException:
+            output.seek(contents.start_dir)
+            output.write(directory)
+            output.truncate()
+            raise
+        output.truncate()
+        return True
+
+    def repack_archive(self, filename, replacements):
+        """Repack the archive with the files replaced (or added), where
+        replacements maps the paths in the archive to the new files"""
+        handle, repacked = tempfile.mkstemp(
+            prefix='.jewr', dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with os.fdopen(handle, 'wb') as output:
+                with open(filename, 'rb') as source:
+                    self.write_repacked(source, output, replacements)
+            os.chmod(repacked, stat.S_IMODE(os.stat(filename).st_mode))
+            os.rename(repacked, filename)
+            # The pooled archive is of the replaced file
+            self.archive_pool.discard_path(filename)
+        except BaseException:
+            os.remove(repacked)
+            raise
+        return True
+
+    def write_repacked(self, source, output, replacements):
+        """Write the source archive to output with the files replaced"""
+        contents = zipfile.ZipFile(source, 'r')
+        replacements = dict(replacements)
+        writer = ArchiveWriter(output, self.compress_workers or
+                               multiprocessing.cpu_count())
+        for zinfo in contents.infolist():
+            # Only the last one of the duplicate entries is valid
+            if contents.getinfo(zinfo.filename) is not zinfo:
+                continue
+            if zinfo.filename in replacements:
+                self.write_replacement(writer, zinfo.filename,
+                                       replacements.pop(zinfo.filename),
+                                       zinfo)
+            else:
+                writer.copy_entry(source, zinfo)
+        for archive_path in sorted(replacements):
+            self.write_replacement(writer, archive_path,
+                                   replacements[archive_path])
+        writer.close(contents.comment)
+        return True
+
+    def write_replacement(self, writer, archive_path, filename,
+                          replaced=None):
+        """Write the file into the archive writer as the archive path,
+        replaced is the info of the entry replaced by the file"""
+        zinfo = self.get_replacement_info(archive_path, filename)
+        zinfo.compress_type, level = self.compress_method(archive_path,
+                                                          replaced)
+        if self.verbosity:
+            self.console_out("Processing compress..." if level else
+                             "Processing store...", archive_path)
+        with open(filename, 'rb') as source:
+            writer.write_entry(zinfo, source, level)
+        return True
+
+    def compress_method(self, archive_path, replaced=None):
+        """Compression method and deflate level of the entry written to the
+        archive by the compression policy"""
+        if self.keep_method and replaced is not None:
+            if replaced.compress_type == zipfile.ZIP_STORED:
+                return zipfile.ZIP_STORED, 0
+            return zipfile.ZIP_DEFLATED, self.compress_level or \
+                zlib.Z_DEFAULT_COMPRESSION
+        if self.compress_level == 0 or self.store_compressed and \
+                archive_path.lower().endswith(tuple(self.known_types +
+                                                    self.compressed_types)):
+            return zipfile.ZIP_STORED, 0
+        return zipfile.ZIP_DEFLATED, self.compress_level
+
+    def compression_policy(self):
+        """Attributes of the compression policy, for the tools of the
+        worker processes"""
+        return dict((name, getattr(self, name)) for name in (
+            'compress_level', 'store_compressed', 'keep_method'))
+
+    def get_replacement_info(self, archive_path, filename):
+        """Archive info of the file to be written into the archive"""
+        file_stat = os.stat(filename)
+        zinfo = zipfile.ZipInfo(archive_path,
+                                time.localtime(file_stat.st_mtime)[0:6])
+        zinfo.external_attr = (file_stat.st_mode & 0xFFFF) << 16
+        zinfo.file_size = file_stat.st_size
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        return zinfo
+
+    def resolve_java_path(self, java_archive_path, opened=None):
+        """Split java path in to array of components at the real boundaries
+        of the nested archives, by the names of the files of the archives
+        (memoized). Each of the nested archives is opened once for its names
+        and left in the opened dict when given. Falls back on parse_java_path
+        when the outermost archive file is not found"""
+        outer = self.outer_archive_file(java_archive_path)
+        if outer is None:
+            return self.parse_java_path(java_archive_path)
+        components = java_archive_path.split(os.sep)
+        i = len(outer.split(os.sep))
+        java_filelist = [outer]
+        identity = self.archive_identity(java_filelist[0])
+        key = (java_archive_path,) + identity
+        if key in self.resolved_paths:
+            return list(self.resolved_paths[key])
+        rest = components[i:]
+        local = {} if opened is None else opened
+        try:
+            while len(rest) > 1:
+                names = self.archive_names(java_filelist, identity, local)
+                # The path continues past a file only in a nested archive
+                for j in range(1, len(rest)):
+                    if os.sep.join(rest[:j]) in names:
+                        java_filelist.append(os.sep.join(rest[:j]))
+                        rest = rest[j:]
+                        break
+                else:
+                    break
+        finally:
+            if opened is None:
+                for contents in local.values():
+                    self.close_archive(contents)
+        if rest:
+            java_filelist.append(os.sep.join(rest))
+        if len(self.resolved_paths) >= self.resolve_size:
+            self.resolved_paths.clear()
+        self.resolved_paths[key] = list(java_filelist)
+        return java_filelist
+
+    def open_java_path(self, java_archive_path, opened):
+        """Resolve the java path and open its innermost archive through the
+        opened dict, the archives opened for resolving the path are not
+        opened again. Returns the archive, the list of the nested archives
+        and the path prefix in the archive (None when the path ends in an
+        archive). The opened archives are closed on failure"""
+        try:
+            java_filelist = self.resolve_java_path(java_archive_path, opened)
+            type_list = self.resolve_java_path_types(java_archive_path,
+                                                     opened)
+            fpfilter = None
+            # The last element is not archive (path prefix)
+            if len(java_filelist) > 1 and not type_list[-1]:
+                fpfilter = java_filelist.pop()
+            return (self.open_archive_path(java_filelist, opened),
+                    java_filelist, fpfilter)
+        except BaseException:
+            for contents in opened.values():
+                self.close_archive(contents)
+            raise
+
+    def outer_archive_file(self, java_archive_path):
+        """Outermost archive file of the java path, the first prefix of the
+        path which is a file (None when not found)"""
+        components = java_archive_path.split(os.sep)
+        for i in range(1, len(components) + 1):
+            if components[i - 1] and \
+                    os.path.isfile(os.sep.join(components[:i])):
+                return os.sep.join(components[:i])
+        return None
+
+    def resolve_java_path_types(self, java_archive_path, opened=None):
+        """An array of booleans of the resolved path, where True=archive,
+        False=non-archive. The last element is an archive when it is a file
+        of the known types, the files of other types are recognized as
+        archives by their contents"""
+        java_filelist = self.resolve_java_path(java_archive_path, opened)
+        identity = self.archive_identity(java_filelist[0])
+        if not identity:
+            return self.parse_java_path_types(java_archive_path)
+        types = [True] * (len(java_filelist) - 1)
+        last = java_filelist[-1]
+        if len(java_filelist) == 1:
+            return types + [True]
+        if last not in self.archive_names(java_filelist[:-1], identity,
+                                          opened):
+            return types + [False]
+        if last.endswith(tuple(self.known_types)):
+            return types + [True]
+        local = {} if opened is None else opened
+        try:
+            contents = self.open_archive_path(java_filelist[:-1], local)
+            with contents.open(last) as entry:
+                return types + [entry.read(4) == b'PK\003\004']
+        finally:
+            if opened is None:
+                for contents in local.values():
+                    self.close_archive(contents)
+
+    def archive_identity(self, filename):
+        """Identity (path, inode, size and mtime) of the archive file, empty
+        when not found"""
+        try:
+            file_stat = os.stat(filename)
+        except OSError:
+            return ()
+        return (os.path.abspath(filename), file_stat.st_ino,
+                file_stat.st_size, file_stat.st_mtime)
+
+    def archive_names(self, java_filelist, identity, opened=None):
+        """Set of the names of the files (not dirs) of the innermost
+        archive of the list of nested archives, memoized by the identity of
+        the outermost archive file (and the file list cache when set)"""
+        key = identity + tuple(java_filelist[1:])
+        if key in self.name_tables:
+            return self.name_tables[key]
+        if self.cache_dir is not None:
+            names = [entry[0] for entry in self.cached_filelist(
+                java_filelist, opened)]
+        else:
+            local = {} if opened is None else opened
+            try:
+                names = self.open_archive_path(java_filelist,
+                                               local).namelist()
+            finally:
+                if opened is None:
+                    for contents in local.values():
+                        self.close_archive(contents)
+        if len(self.name_tables) >= self.resolve_size:
+            self.name_tables.clear()
+        self.name_tables[key] = frozenset([name for name in names
+                                           if not name.endswith(os.sep)])
+        return self.name_tables[key]
+
     def parse_java_path_types(self, java_archive_path):
         """An array of booleans, where True=archive, False=non-archive"""
         split_token = "\n"
@@ -156,9 +1605,16 @@ class JarEarWarRar(object):
         return True
 
     def set_temp_dir(self, temp_dir=None):
-        """Set root temp dir"""
+        """Set root temp dir, with the memory budget the temp dir is on disk
+        (system temp by default) next to the one in /dev/shm"""
         self.clean_tmp_dir()
-        if temp_dir is None:
+        if self.memory_budget is not None:
+            if os.access('/dev/shm', os.W_OK):
+                self.shm_dir = tempfile.mkdtemp(suffix='', prefix='tmp',
+                                                dir="/dev/shm")
+            self.tmp_dir = tempfile.mkdtemp(suffix='', prefix='tmp',
+                                            dir=temp_dir)
+        elif temp_dir is None:
             if os.access('/dev/shm', os.W_OK):
                 self.tmp_dir = tempfile.mkdtemp(suffix='', prefix='tmp',
                                                 dir="/dev/shm")
@@ -169,185 +1625,1349 @@ class JarEarWarRar(object):
                                             dir=temp_dir)
         return self.tmp_dir
 
-    def clean_tmp_dir(self):
-        """Clean temp dir after usage"""
+    def clean_tmp_dir(self, keep_shm=False):
+        """Clean temp dir after usage. The temp dir in /dev/shm is removed
+        with the memory budget unless kept for the archives still open (only
+        the levels of the update are removed then)"""
+        self.discard_temp_archives()
         if self.tmp_dir is not "":
             if os.access(self.tmp_dir, os.W_OK):
-                shutil.rmtree(self.tmp_dir)
+                with self.stage('clean', dir=self.tmp_dir):
+                    shutil.rmtree(self.tmp_dir)
+        if keep_shm:
+            return self.release_levels()
+        if self.shm_dir is not None:
+            shutil.rmtree(self.shm_dir, ignore_errors=True)
+            self.shm_dir = None
+        self.memory_used = 0
+        self.memory_charges = {}
+        self.memory_refs = {}
+        self.memory_shares = {}
+        self.level_dirs = {}
+        return True
+
+    def set_cache_dir(self, cache_dir=None):
+        """Set/detect dir for the file list cache"""
+        if cache_dir is None and 'JEWR_CACHE_DIR' in os.environ:
+            cache_dir = os.environ['JEWR_CACHE_DIR']
+        if cache_dir is None:
+            cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser(
+                "~" + os.sep + ".cache")) + os.sep + "jewr"
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        if not os.access(cache_dir, os.W_OK):
+            raise IOError("error: " + cache_dir + " is not writeable.")
+        self.cache_dir = cache_dir
+        if self.verbosity:
+            self.console_out("Using cache dir:" + self.cache_dir)
+        return True
+
+    def cache_key(self, *identity):
+        """Cache key of the archive identity (path, size and mtime of
+        archive file, or parent key, name, size and crc of nested one)"""
+        key = "\0".join([str(elem) for elem in identity])
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return hashlib.sha1(key).hexdigest()
+
+    def read_cache(self, key):
+        """Read the file table (name, size, crc) of the key from cache"""
+        cache_file = self.cache_dir + os.sep + key + ".json"
+        try:
+            with open(cache_file) as cached:
+                table = json.load(cached)
+            # Recently used cache files are evicted last
+            os.utime(cache_file, None)
+        except (IOError, OSError, ValueError):
+            return None
+        if self.verbosity:
+            self.console_out("Using cached file list...", key)
+        return table
+
+    def write_cache(self, key, table):
+        """Write the file table of the key to cache"""
+        try:
+            handle, cache_file = tempfile.mkstemp(prefix='.jewr',
+                                                  dir=self.cache_dir)
+            with os.fdopen(handle, 'w') as cached:
+                json.dump(table, cached)
+            os.rename(cache_file, self.cache_dir + os.sep + key + ".json")
+        except (IOError, OSError, ValueError, UnicodeError) as ex:
+            if self.verbosity:
+                self.console_err("Unable to cache file list:", str(ex))
+            return False
+        self.evict_cache()
         return True
 
+    def evict_cache(self, cache_dir=None, cache_size=None):
+        """Remove least recently used cache files over the cache size"""
+        cache_dir = cache_dir or self.cache_dir
+        if cache_size is None:
+            cache_size = self.cache_size
+        cache_files = []
+        for name in os.listdir(cache_dir):
+            try:
+                file_stat = os.stat(cache_dir + os.sep + name)
+            except OSError:
+                continue
+            if not stat.S_ISREG(file_stat.st_mode):
+                continue
+            cache_files.append((file_stat.st_mtime, file_stat.st_size,
+                                cache_dir + os.sep + name))
+        total = sum([elem[1] for elem in cache_files])
+        for _, size, cache_file in sorted(cache_files):
+            if total <= cache_size:
+                break
+            try:
+                os.remove(cache_file)
+            except OSError:
+                pass
+            total -= size
+        return True
+
+    def cached_filelist(self, java_filelist, opened=None):
+        """File table (name, size, crc) of the innermost archive of the
+        list of nested archives, the archives are opened only on cache miss
+        (and left in the opened dict when given)"""
+        file_stat = os.stat(java_filelist[0])
+        key = self.cache_key(os.path.abspath(java_filelist[0]),
+                             file_stat.st_size, repr(file_stat.st_mtime))
+        local = {} if opened is None else opened
+        try:
+            for i in range(len(java_filelist)):
+                table = self.read_cache(key)
+                if table is None:
+                    contents = self.open_archive_path(java_filelist[:i + 1],
+                                                      local)
+                    table = [[zinfo.filename, zinfo.file_size, zinfo.CRC]
+                             for zinfo in contents.infolist()]
+                    self.write_cache(key, table)
+                if i + 1 == len(java_filelist):
+                    return table
+                entries = [entry for entry in table if
+                           entry[0] == java_filelist[i + 1]]
+                if not entries:
+                    raise IOError("file '" + java_filelist[i + 1] +
+                                  "' not found in '" +
+                                  os.sep.join(java_filelist[:i + 1]) + "'")
+                key = self.cache_key(key, *entries[-1])
+        finally:
+            if opened is None:
+                for contents in local.values():
+                    self.close_archive(contents)
+
     def set_destination_dir(self, destination_dir=None):
-        """Set destination dir for extract operation"""
+        """Set destination dir for extract operation ('-' is STDOUT)"""
         if destination_dir is None:
             self.destination_dir = os.getcwd()
         else:
             self.destination_dir = destination_dir
-        if not os.access(self.destination_dir, os.W_OK):
+        if self.destination_dir != '-' and \
+                not os.access(self.destination_dir, os.W_OK):
             raise IOError("error: " + self.destination_dir +
                           " is not writeable.")
         return True
 
     def return_file(self, file_path):
         """Helper for returning an extracted file"""
-        shutil.move(file_path, self.destination_dir)
+        with self.stage('return', file=file_path) as record:
+            record['bytes_written'] = self.stage_size(file_path)
+            shutil.move(file_path, self.destination_dir)
         return True
 
-    def process_file_extract(self, java_archive_path):
-        """Process extract operation"""
-        java_filelist = self.parse_java_path(java_archive_path)
-        if java_filelist.__len__() is 1:
-            raise RuntimeError("error: no file to extract in path " +
-                               java_archive_path)
-        first_element = 0
-        last_element = len(java_filelist)-1
-        for i in range(0, len(java_filelist)):
-            # First element
-            if i == first_element:
-                # And same time the second last (two elements in array)
-                if i+1 == last_element:
-                    subdir = self.tmp_dir + os.sep + str(i)
-                    self.extract_file(java_filelist[i], java_filelist[i+1],
-                                      subdir)
-                    self.return_file(subdir + os.sep +
-                                     java_filelist[i+1])
-
-                # More than two elements in a array
+    def return_entry(self, contents, target_file):
+        """Helper for writing a file of the archive to destination dir"""
+        info = self.get_file_info(contents, target_file)
+        if self.verbosity:
+            self.console_out("Processing extract...", target_file)
+        with self.stage('return', file=target_file) as record:
+            source = contents.open(target_file)
+            try:
+                if self.destination_dir == '-':
+                    # Binary STDOUT, the file is streamed in chunks
+                    target = getattr(sys.stdout, 'buffer', sys.stdout)
+                    shutil.copyfileobj(source, target)
+                    target.flush()
                 else:
-                    subdir = self.tmp_dir + os.sep + str(i)
-                    os.mkdir(subdir)
-                    self.extract_file(java_filelist[i], java_filelist[i+1],
-                                      subdir)
-
-            # All the next elements until second last element
-            if i > first_element and i < last_element:
-                nsubdir = self.tmp_dir + os.sep + str(i)
-                psubdir = self.tmp_dir + os.sep + str(i-1)
-                # Second last element
-                if i+1 == last_element:
-                    self.extract_file(psubdir + os.sep + java_filelist[i],
-                                      java_filelist[i+1],
-                                      nsubdir)
-                    self.return_file(nsubdir + os.sep +
-                                     java_filelist[i+1])
-                # Other element than second last
+                    with open(self.destination_dir + os.sep +
+                              target_file.split(os.sep)[-1], 'wb') as target:
+                        shutil.copyfileobj(source, target)
+            finally:
+                source.close()
+            record['bytes_read'] = info.compress_size
+            record['bytes_decompressed'] = info.file_size
+            record['bytes_written'] = info.file_size
+        return True
+
+    def process_file_extract(self, java_archive_path, opened=None):
+        """Process extract operation, the archives opened for resolving
+        the path are shared through the opened dict"""
+        shared = {} if opened is None else opened
+        stdout_data = self.stdout_data
+        self.stdout_data = stdout_data or self.destination_dir == '-'
+        try:
+            java_filelist = self.resolve_java_path(java_archive_path, shared)
+            if java_filelist.__len__() is 1:
+                raise RuntimeError("error: no file to extract in path " +
+                                   java_archive_path)
+            contents = self.open_archive_path(java_filelist[:-1], shared)
+            self.return_entry(contents, java_filelist[-1])
+        finally:
+            self.stdout_data = stdout_data
+            if opened is None:
+                for contents in shared.values():
+                    self.close_archive(contents)
+        return True
+
+    def process_filelist(self, java_archive_path, opened=None):
+        """Process file list operation, the archives opened for resolving
+        the path are shared through the opened dict"""
+        shared = {} if opened is None else opened
+        try:
+            java_filelist = self.resolve_java_path(java_archive_path, shared)
+            type_list = self.resolve_java_path_types(java_archive_path,
+                                                     shared)
+            # The last element is not archive (path prefix)
+            if len(java_filelist) > 1 and not type_list[-1]:
+                fpfilter = java_filelist.pop()
+                if self.cache_dir is not None:
+                    return self.filter_filelist(
+                        [entry[0] for entry in self.cached_filelist(
+                            java_filelist, shared)], fpfilter,
+                        os.sep.join(java_filelist))
+                contents = self.open_archive_path(java_filelist, shared)
+                return self.extract_filelist(contents, fpfilter)
+            if self.cache_dir is not None:
+                return [entry[0] for entry in self.cached_filelist(
+                    java_filelist, shared)]
+            return self.extract_filelist(self.open_archive_path(java_filelist,
+                                                                shared))
+        finally:
+            if opened is None:
+                for contents in shared.values():
+                    self.close_archive(contents)
+
+    def process_filelist_recursive(self, java_archive_path):
+        """Process recursive file list operation, generates the files of
+        the archive and all of its nested archives as they are found. The
+        nested paths are relative to the archive path (as with the other
+        operations)"""
+        opened = {}
+        contents, java_filelist, fpfilter = self.open_java_path(
+            java_archive_path, opened)
+        try:
+            for name in self.walk_filelist(contents, '',
+                                           len(java_filelist) - 1, fpfilter):
+                yield name
+        finally:
+            for contents in opened.values():
+                self.close_archive(contents)
+
+    def process_verify(self, java_archive_path, algorithm=None,
+                       workers=None):
+        """Verify the CRC-32s of the files of the archive and its nested
+        archives by the worker processes. Generates the manifest lines
+        'digest  nested path' when the hash algorithm is given, the broken
+        files and the throughput are written to stderr"""
+        if algorithm is not None:
+            # Unknown algorithm raises ValueError before the work
+            hashlib.new(algorithm)
+        workers = workers or multiprocessing.cpu_count()
+        # Batches of ((path, CRC-32) list, result list or async result)
+        results = []
+        batch = ([], [])
+        batch_size = 0
+        # Number of the files, their bytes and the broken files
+        totals = [0, 0, 0]
+        start = time.time()
+        opened = {}
+        contents, java_filelist, fpfilter = self.open_java_path(
+            java_archive_path, opened)
+        pool = None
+        try:
+            pool = multiprocessing.Pool(workers)
+            for archive, zinfo, path in self.walk_archive(
+                    contents, '', len(java_filelist) - 1, fpfilter):
+                if path.endswith(os.sep):
+                    continue
+                if zinfo.compress_type not in (zipfile.ZIP_STORED,
+                                               zipfile.ZIP_DEFLATED) or \
+                        zinfo.compress_size > self.memory_limit:
+                    try:
+                        result = digest_chunks(self.read_chunks(
+                            archive.open(zinfo)), algorithm)
+                    except (zipfile.BadZipfile, zlib.error):
+                        result = None, 0, None
+                    results.append(([(path, zinfo.CRC)], [result]))
                 else:
-                    os.mkdir(nsubdir)
-                    self.extract_file(psubdir + os.sep + java_filelist[i],
-                                      java_filelist[i+1], nsubdir)
+                    # Small files are sent to the workers in batches
+                    batch[0].append((path, zinfo.CRC))
+                    batch[1].append((self.read_raw_entry(archive, zinfo),
+                                     zinfo.compress_type))
+                    batch_size += zinfo.compress_size
+                    if batch_size < self.verify_batch_size:
+                        continue
+                    results.append((batch[0], pool.apply_async(
+                        verify_raw_entries, (batch[1], algorithm,
+                                             self.chunk_size))))
+                    batch = ([], [])
+                    batch_size = 0
+                # Results are handled in the order of the files, waiting for
+                # the oldest one bounds the batches waiting for the workers
+                while results and (len(results) > workers * 2 or
+                                   isinstance(results[0][1], list) or
+                                   results[0][1].ready()):
+                    for line in self.verify_results(totals, *results.pop(0)):
+                        yield line
+            if batch[0]:
+                results.append((batch[0], verify_raw_entries(
+                    batch[1], algorithm, self.chunk_size)))
+            for result in results:
+                for line in self.verify_results(totals, *result):
+                    yield line
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            for contents in opened.values():
+                self.close_archive(contents)
+        elapsed = max(time.time() - start, 0.001)
+        self.console_err("Verified {0} files ({1:.1f} MB) in {2:.2f} s, "
+                         "{3:.1f} MB/s".format(totals[0],
+                                               totals[1] / 1048576.0,
+                                               elapsed, totals[1] /
+                                               1048576.0 / elapsed))
+        if totals[2]:
+            raise RuntimeError("error: " + str(totals[2]) +
+                               " broken files in " + java_archive_path)
+
+    def verify_results(self, totals, files, results):
+        """Check the (CRC-32, size, digest) results of the verified (path,
+        CRC-32) files, returns their manifest lines"""
+        if not isinstance(results, list):
+            results = results.get()
+        lines = []
+        for (path, crc), result in zip(files, results):
+            totals[0] += 1
+            totals[1] += result[1]
+            if result[0] != crc:
+                totals[2] += 1
+                self.console_err("Bad CRC-32 for file", path)
+            elif result[2] is not None:
+                lines.append(result[2] + '  ' + path)
+        return lines
+
+    def open_index(self, index_file):
+        """Open the SQLite index of the archives, creating its tables.
+        The archives are identified by their size and mtime (outermost) or
+        CRC-32 and size (nested), the entries are looked up by their name,
+        base name and class name"""
+        connection = sqlite3.connect(index_file)
+        # Names of the files are stored as they are read from the archives
+        connection.text_factory = str
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS archives (path TEXT PRIMARY KEY,
+                parent TEXT, crc INTEGER, size INTEGER, mtime REAL);
+            CREATE INDEX IF NOT EXISTS archives_parent ON archives (parent);
+            CREATE TABLE IF NOT EXISTS entries (archive TEXT, name TEXT,
+                base TEXT, class TEXT, path TEXT, crc INTEGER,
+                size INTEGER);
+            CREATE INDEX IF NOT EXISTS entries_archive ON entries (archive);
+            CREATE INDEX IF NOT EXISTS entries_name ON entries (name);
+            CREATE INDEX IF NOT EXISTS entries_base ON entries (base);
+            CREATE INDEX IF NOT EXISTS entries_class ON entries (class);
+            """)
+        return connection
+
+    def process_index(self, java_archive_path, index_file):
+        """Index the files of the archive and its nested archives to the
+        index file, only the changed archives are indexed again. Returns the
+        number of the (re)indexed archives"""
+        # The path is resolved only when the outermost archive has changed
+        outer = self.outer_archive_file(java_archive_path) or \
+            self.parse_java_path(java_archive_path)[0]
+        file_stat = os.stat(outer)
+        path = os.path.abspath(outer) + java_archive_path[len(outer):]
+        connection = self.open_index(index_file)
+        try:
+            with connection:
+                cursor = connection.cursor()
+                cursor.execute("SELECT size, mtime FROM archives WHERE "
+                               "path = ?", (path,))
+                if cursor.fetchone() == (file_stat.st_size,
+                                         file_stat.st_mtime):
+                    return 0
+                opened = {}
+                try:
+                    java_filelist = self.resolve_java_path(java_archive_path,
+                                                           opened)
+                    contents = self.open_archive_path(java_filelist, opened)
+                    indexed = self.index_archive(cursor, contents, path,
+                                                 len(java_filelist) - 1)
+                finally:
+                    for contents in opened.values():
+                        self.close_archive(contents)
+                cursor.execute("INSERT OR REPLACE INTO archives VALUES "
+                               "(?, NULL, NULL, ?, ?)",
+                               (path, file_stat.st_size, file_stat.st_mtime))
+        finally:
+            connection.close()
+        return indexed
+
+    def index_archive(self, cursor, contents, path, level):
+        """Index the files of the opened archive, descending into the
+        nested archives with changed CRC-32 or size. Returns the number of
+        the indexed archives"""
+        if self.verbosity:
+            self.console_out("Processing index...", path)
+        cursor.execute("SELECT path FROM archives WHERE parent = ?", (path,))
+        removed = set([row[0] for row in cursor.fetchall()])
+        cursor.execute("DELETE FROM entries WHERE archive = ?", (path,))
+        indexed = 1
+        rows = []
+        for zinfo in contents.infolist():
+            name = zinfo.filename
+            nested_path = path + os.sep + name
+            rows.append((path, name, name.rstrip('/').split('/')[-1],
+                         self.class_name(name), nested_path, zinfo.CRC,
+                         zinfo.file_size))
+            if not name.endswith(tuple(self.known_types)):
+                continue
+            removed.discard(nested_path)
+            cursor.execute("SELECT crc, size FROM archives WHERE path = ?",
+                           (nested_path,))
+            if cursor.fetchone() == (zinfo.CRC, zinfo.file_size):
+                continue
+            try:
+                nested = self.open_nested_archive(contents, name, level)
+            except zipfile.BadZipfile:
+                self.console_err("Skipping broken archive", nested_path)
+                self.remove_indexed(cursor, nested_path)
+                continue
+            try:
+                indexed += self.index_archive(cursor, nested, nested_path,
+                                              level + 1)
+            finally:
+                self.close_archive(nested)
+            cursor.execute("INSERT OR REPLACE INTO archives VALUES "
+                           "(?, ?, ?, ?, NULL)", (nested_path, path,
+                                                  zinfo.CRC, zinfo.file_size))
+        cursor.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           rows)
+        for nested_path in removed:
+            self.remove_indexed(cursor, nested_path)
+        return indexed
+
+    def remove_indexed(self, cursor, path):
+        """Remove the archive and its nested archives from the index"""
+        cursor.execute("SELECT path FROM archives WHERE parent = ?", (path,))
+        for row in cursor.fetchall():
+            self.remove_indexed(cursor, row[0])
+        cursor.execute("DELETE FROM entries WHERE archive = ?", (path,))
+        cursor.execute("DELETE FROM archives WHERE path = ?", (path,))
         return True
 
-    def process_filelist(self, java_archive_path):
-        """Process file list operation"""
-        java_filelist = self.parse_java_path(java_archive_path)
-        type_list = self.parse_java_path_types(java_archive_path)
-        first_element = 0
-        last_element = len(java_filelist)-1
-        for i in range(0, len(java_filelist)):
-            # First element
-            if i == first_element:
-                # There is just only one element, that is, the file
-                if len(java_filelist) is 1:
-                    return self.extract_filelist(java_filelist[i])
-                # And same time the second last (two elements in array)
-                if i+1 == last_element:
-                    # The last element is archive itself
-                    if type_list[i+1]:
-                        subdir = self.tmp_dir + os.sep + str(i)
-                        os.mkdir(subdir)
-                        self.extract_file(java_filelist[i],
-                                          java_filelist[i+1], subdir)
-                        return self.extract_filelist(subdir + os.sep +
-                                                     java_filelist[i+1])
-                    # The last elemant is not archive (path prefix)
-                    else:
-                        return self.extract_filelist(java_filelist[i],
-                                                     java_filelist[i+1])
-                # More than two elements in a array
+    def class_name(self, name):
+        """Fully qualified name of the class file (None for other files)"""
+        if not name.endswith('.class'):
+            return None
+        for class_dir in self.class_dirs:
+            if name.startswith(class_dir):
+                name = name[len(class_dir):]
+                break
+        return name[:-len('.class')].replace('/', '.')
+
+    def process_lookup(self, index_file, name):
+        """Generate the 'nested path CRC-32 size' lines of the indexed
+        files with the class name, name or base name"""
+        connection = self.open_index(index_file)
+        try:
+            cursor = connection.execute(
+                "SELECT path, crc, size FROM entries WHERE class = ? UNION "
+                "SELECT path, crc, size FROM entries WHERE name = ? UNION "
+                "SELECT path, crc, size FROM entries WHERE base = ? "
+                "ORDER BY path", (name, name, name))
+            for path, crc, size in cursor:
+                yield "{0} {1:08x} {2}".format(path, crc, size)
+        finally:
+            connection.close()
+
+    def process_diff(self, java_archive_path, other_archive_path):
+        """Generate the differences of the archives and their nested
+        archives as 'A path' (added to the other), 'D path' (deleted) and
+        'M path' (modified) by the central directories"""
+        opened = {}
+        try:
+            contents = self.open_archive_path(
+                self.resolve_java_path(java_archive_path, opened), opened)
+            other = self.open_archive_path(
+                self.resolve_java_path(other_archive_path, opened), opened)
+            for line in self.diff_archive(contents, other, ''):
+                yield line
+        finally:
+            for contents in opened.values():
+                self.close_archive(contents)
+
+    def diff_archive(self, contents, other, prefix):
+        """Generate the differences of the opened archives by the names,
+        sizes and CRC-32s of their files. Only the modified nested archives
+        are opened and compared"""
+        infos = dict((zinfo.filename, zinfo) for zinfo in contents.infolist())
+        other_infos = dict((zinfo.filename, zinfo) for zinfo in
+                           other.infolist())
+        for name in sorted(set(infos) | set(other_infos)):
+            path = prefix + os.sep + name if prefix else name
+            if name not in other_infos:
+                yield 'D ' + path
+                continue
+            if name not in infos:
+                yield 'A ' + path
+                continue
+            zinfo = infos[name]
+            other_zinfo = other_infos[name]
+            if (zinfo.CRC, zinfo.file_size) == (other_zinfo.CRC,
+                                                other_zinfo.file_size):
+                continue
+            yield 'M ' + path
+            if not name.endswith(tuple(self.known_types)):
+                continue
+            nested = nested_other = None
+            try:
+                # Both of the nested archives have a temp dir of their own
+                self.shared_count += 2
+                nested = self.open_nested_archive(
+                    contents, name, 'shared' + str(self.shared_count - 1))
+                nested_other = self.open_nested_archive(
+                    other, name, 'shared' + str(self.shared_count))
+                for line in self.diff_archive(nested, nested_other, path):
+                    yield line
+            except zipfile.BadZipfile:
+                self.console_err("Skipping broken archive", path)
+            finally:
+                for archive in (nested, nested_other):
+                    if archive is not None:
+                        self.close_archive(archive)
+
+    def compile_pattern(self, pattern, regex=False):
+        """Compile the glob (or regex) pattern for matching nested paths.
+        Glob without path separators matches the file name, '**' matches
+        any number of directories and '*' anything but a separator"""
+        if regex:
+            return re.compile(pattern).search
+        expression = ''
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith('**' + os.sep, i):
+                expression += '(?:.*' + re.escape(os.sep) + ')?'
+                i += 3
+            elif pattern.startswith('**', i):
+                expression += '.*'
+                i += 2
+            elif pattern[i] == '*':
+                expression += '[^' + re.escape(os.sep) + ']*'
+                i += 1
+            elif pattern[i] == '?':
+                expression += '[^' + re.escape(os.sep) + ']'
+                i += 1
+            elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+                end = pattern.index(']', i + 2)
+                chars = pattern[i + 1:end]
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                expression += '[' + chars.replace('\\', '\\\\') + ']'
+                i = end + 1
+            else:
+                expression += re.escape(pattern[i])
+                i += 1
+        match = re.compile(expression + r'\Z').match
+        if os.sep in pattern:
+            return match
+        return lambda path: match(path.split(os.sep)[-1])
+
+    def process_pattern_extract(self, java_archive_path, pattern,
+                                regex=False, workers=None):
+        """Process extract operation of all the files matching the pattern
+        in the archive and its nested archives, the files are written under
+        destination dir by their nested paths. Matching archives are not
+        descended into. Decompressing and writing is done by the workers,
+        no matching files is an error"""
+        if self.destination_dir == '-':
+            raise RuntimeError("error: files matching the pattern can not " +
+                               "be extracted to stdout")
+        match = self.compile_pattern(pattern, regex)
+        workers = workers or multiprocessing.cpu_count()
+        # Bounds the compressed data waiting for the workers, released by
+        # the workers also when the file fails
+        pending = threading.BoundedSemaphore(workers * 2)
+        results = []
+        opened = {}
+        contents, java_filelist, fpfilter = self.open_java_path(
+            java_archive_path, opened)
+        pool = None
+        try:
+            pool = multiprocessing.pool.ThreadPool(workers)
+            for archive, zinfo, path in self.walk_archive(
+                    contents, '', len(java_filelist) - 1, fpfilter,
+                    lambda path: not match(path)):
+                if path.endswith(os.sep) or not match(path):
+                    continue
+                target = self.destination_dir + os.sep + os.sep.join(
+                    [elem for elem in path.split(os.sep) if
+                     elem not in ('', '.', '..')])
+                if zinfo.compress_type not in (zipfile.ZIP_STORED,
+                                               zipfile.ZIP_DEFLATED) or \
+                        zinfo.compress_size > self.memory_limit:
+                    if self.verbosity:
+                        self.console_out("Processing extract...", target)
+                    self.write_entry(archive.open(zinfo), target)
+                    results.append(None)
+                    continue
+                data = self.read_raw_entry(archive, zinfo)
+                pending.acquire()
+                results.append(pool.apply_async(
+                    self.write_raw_entry, (data, zinfo, target, pending)))
+            if not results:
+                raise IOError("no files matched '" + pattern + "' in '" +
+                              java_archive_path + "'")
+            for result in results:
+                if result is not None:
+                    result.get()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            for contents in opened.values():
+                self.close_archive(contents)
+        return True
+
+    def read_raw_entry(self, contents, zinfo):
+        """Read the compressed data of the file from the opened archive"""
+        contents.fp.seek(self.entry_offset(contents, zinfo))
+        return contents.fp.read(zinfo.compress_size)
+
+    def write_raw_entry(self, data, zinfo, target, pending=None):
+        """Decompress and write the compressed data of the file to target
+        (run by the workers)"""
+        try:
+            if self.verbosity:
+                self.console_out("Processing extract...", target)
+            with self.stage('return', file=target) as record:
+                record['bytes_read'] = len(data)
+                if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+                    data = zlib.decompress(data, -15)
+                if zlib.crc32(data) & 0xFFFFFFFF != zinfo.CRC:
+                    raise IOError("Bad CRC-32 for file '" + zinfo.filename +
+                                  "'")
+                self.write_entry(io.BytesIO(data), target)
+                record['bytes_decompressed'] = len(data)
+                record['bytes_written'] = len(data)
+        finally:
+            if pending is not None:
+                pending.release()
+        return True
+
+    def write_entry(self, source, target):
+        """Write the file from the stream to target, creating the dirs"""
+        try:
+            os.makedirs(os.path.dirname(target))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(target)):
+                raise
+        try:
+            with open(target, 'wb') as output:
+                shutil.copyfileobj(source, output)
+        finally:
+            source.close()
+        return True
+
+    def process_grep(self, java_archive_path, pattern, name_pattern=None,
+                     regex=False, workers=None, binary=False):
+        """Generate the matches of the regular expression in the files of
+        the archive and its nested archives as 'nested path:offset:match'.
+        Files are filtered by the name pattern (glob or regex), binary files
+        are skipped unless binary. Decompressing and searching is done in
+        chunks by the workers"""
+        if not isinstance(pattern, bytes):
+            pattern = pattern.encode('utf-8')
+        search = re.compile(pattern).finditer
+        match = None
+        if name_pattern is not None:
+            match = self.compile_pattern(name_pattern, regex)
+        workers = workers or multiprocessing.cpu_count()
+        # Bounds the compressed data waiting for the workers, released by
+        # the workers also when the search fails
+        pending = threading.BoundedSemaphore(workers * 2)
+        results = []
+        opened = {}
+        contents, java_filelist, fpfilter = self.open_java_path(
+            java_archive_path, opened)
+        pool = None
+        try:
+            pool = multiprocessing.pool.ThreadPool(workers)
+            for archive, zinfo, path in self.walk_archive(
+                    contents, '', len(java_filelist) - 1, fpfilter):
+                if path.endswith(os.sep) or \
+                        (match is not None and not match(path)) or \
+                        (match is None and
+                         path.endswith(tuple(self.known_types))):
+                    continue
+                if zinfo.compress_type not in (zipfile.ZIP_STORED,
+                                               zipfile.ZIP_DEFLATED) or \
+                        zinfo.compress_size > self.memory_limit:
+                    results.append(self.grep_entry(
+                        self.read_chunks(archive.open(zinfo)), search, path,
+                        binary))
                 else:
-                    subdir = self.tmp_dir + os.sep + str(i)
-                    os.mkdir(subdir)
-                    self.extract_file(java_filelist[i], java_filelist[i+1],
-                                      subdir)
-
-            # All the next elements until second last element
-            if i > first_element and i < last_element:
-                nsubdir = self.tmp_dir + os.sep + str(i)
-                psubdir = self.tmp_dir + os.sep + str(i-1)
-                # Second last element
-                if i+1 == last_element:
-                    # The last element is archive itself
-                    if type_list[i+1]:
-                        os.mkdir(nsubdir)
-                        self.extract_file(psubdir + os.sep + java_filelist[i],
-                                          java_filelist[i+1], nsubdir)
-                        return self.extract_filelist(nsubdir + os.sep +
-                                                     java_filelist[i+1])
-                    # The last elemant is not archive (path prefix)
-                    else:
-                        return self.extract_filelist(psubdir + os.sep +
-                                                     java_filelist[i],
-                                                     java_filelist[i+1])
-                # Other element than second last
+                    data = self.read_raw_entry(archive, zinfo)
+                    pending.acquire()
+                    results.append(pool.apply_async(
+                        self.grep_raw_entry,
+                        (data, zinfo, search, path, binary, pending)))
+                # Matches are generated in the order of the files
+                while results and (isinstance(results[0], list) or
+                                   results[0].ready()):
+                    for line in self.grep_result(results.pop(0)):
+                        yield line
+            for result in results:
+                for line in self.grep_result(result):
+                    yield line
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            for contents in opened.values():
+                self.close_archive(contents)
+
+    def grep_result(self, result):
+        """Format the matches of the file searched by grep_entry"""
+        if not isinstance(result, list):
+            result = result.get()
+        return [path + ':' + str(offset) + ':' +
+                found.decode('utf-8', 'replace')
+                for path, offset, found in result]
+
+    def grep_raw_entry(self, data, zinfo, search, path, binary=False,
+                       pending=None):
+        """Decompress and search the compressed data of the file in chunks
+        (run by the workers)"""
+        try:
+            with self.stage('grep', file=path) as record:
+                record['bytes_read'] = len(data)
+                chunks = self.raw_chunks(data, zinfo, record)
+                return self.grep_entry(chunks, search, path, binary)
+        finally:
+            if pending is not None:
+                pending.release()
+
+    def raw_chunks(self, data, zinfo, record=None):
+        """Generate the decompressed chunks of the compressed data of the
+        file, checking its CRC-32"""
+        crc = 0
+        for chunk in inflate_chunks(data, zinfo.compress_type,
+                                    self.chunk_size):
+            crc = zlib.crc32(chunk, crc)
+            if record is not None:
+                record['bytes_decompressed'] += len(chunk)
+            yield chunk
+        if crc & 0xFFFFFFFF != zinfo.CRC:
+            raise IOError("Bad CRC-32 for file '" + zinfo.filename + "'")
+
+    def read_chunks(self, source):
+        """Generate the chunks of the stream, closing it at the end"""
+        try:
+            chunk = source.read(self.chunk_size)
+            while chunk:
+                yield chunk
+                chunk = source.read(self.chunk_size)
+        finally:
+            source.close()
+
+    def grep_entry(self, chunks, search, path, binary=False):
+        """Search the file in the generated chunks, returns the list of
+        (path, offset, match). Files with NUL bytes in the first chunk are
+        binary and skipped unless binary"""
+        found = []
+        data = b''
+        # Offset of the data in the file and end of the last match
+        offset = 0
+        done = 0
+        first = True
+        for chunk in chunks:
+            if first and not binary and b'\0' in chunk:
+                chunks.close()
+                return []
+            first = False
+            data += chunk
+            limit = len(data) - self.grep_overlap
+            done = self.grep_data(data, offset, limit, done, search, path,
+                                  found)
+            if limit > 0:
+                data = data[limit:]
+                offset += limit
+        self.grep_data(data, offset, len(data), done, search, path, found)
+        return found
+
+    def grep_data(self, data, offset, limit, done, search, path, found):
+        """Add the matches starting before limit and after done (offsets
+        in the file) to found, returns the end of the last match"""
+        for result in search(data):
+            if offset + result.start() < done:
+                continue
+            if result.start() >= limit:
+                break
+            found.append((path, offset + result.start(), result.group()))
+            done = offset + max(result.end(), result.start() + 1)
+        return done
+
+    def read_batch(self, batch):
+        """Read batch operations from the lines of the batch file"""
+        arguments = {'list': [2], 'extract': [2, 3], 'replace': [3]}
+        operations = []
+        for line in batch:
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
+            if len(fields) not in arguments.get(fields[0], []):
+                raise RuntimeError("error: invalid batch operation " +
+                                   line.strip())
+            operations.append((fields[0], fields[1], (fields[2:] +
+                                                      [None])[0]))
+        return operations
+
+    def process_batch(self, operations, append=False):
+        """Process batch of (operation, path, argument) operations. The
+        archives are opened once for all of the operations, and all of the
+        replacements are made after the list and extract operations with one
+        repack per archive"""
+        opened = {}
+        destination_dir = self.destination_dir
+        try:
+            for operation, java_archive_path, argument in operations:
+                if operation == 'list':
+                    for line in self.process_filelist(java_archive_path,
+                                                      opened):
+                        self.console_out(line)
+                elif operation == 'extract':
+                    self.set_destination_dir(argument or destination_dir)
+                    self.process_file_extract(java_archive_path, opened)
+            replacements = [(java_archive_path, argument) for
+                            operation, java_archive_path, argument in
+                            operations if operation == 'replace']
+            if replacements:
+                self.process_batch_update(replacements, append, opened)
+        finally:
+            self.destination_dir = destination_dir
+            for contents in opened.values():
+                self.close_archive(contents)
+        return True
+
+    def process_batch_update(self, replacements, append=False, opened=None):
+        """Process the (path, file) replacements with one repack per
+        archive, the outermost archives are appended to when append is set.
+        The archives opened for resolving the paths are shared through the
+        opened dict and written to the levels as they are"""
+        levels = {}
+        shared = {} if opened is None else opened
+        try:
+            for java_archive_path, filename in replacements:
+                java_filelist = self.resolve_java_path(java_archive_path,
+                                                       shared)
+                if len(java_filelist) == 1:
+                    raise RuntimeError("error: no file to replace in path " +
+                                       java_archive_path)
+                key = tuple(java_filelist[:-1])
+                levels.setdefault(key, {})[java_filelist[-1]] = filename
+                for i in range(1, len(key)):
+                    levels.setdefault(key[:i], {})
+            # Extract the nested archives once, outer levels first
+            self.release_levels()
+            extracted = {}
+            for key in sorted(levels, key=lambda key: (len(key), key)):
+                if len(key) == 1:
+                    extracted[key] = key[0]
                 else:
-                    os.mkdir(nsubdir)
-                    self.extract_file(psubdir + os.sep + java_filelist[i],
-                                      java_filelist[i+1], nsubdir)
+                    subdir = self.level_dir('batch' + str(len(extracted)),
+                                            extracted[key[:-1]], key[-1])
+                    self.extract_level(list(key), len(key) - 2,
+                                       extracted[key[:-1]], subdir, shared)
+                    extracted[key] = subdir + os.sep + key[-1]
+        finally:
+            if opened is None:
+                for contents in shared.values():
+                    self.close_archive(contents)
+        # All of the replaced files are checked before anything is written
+        for key in levels:
+            contents = self.open_archive(extracted[key])
+            try:
+                for archive_path in levels[key]:
+                    self.get_file_info(contents, archive_path)
+            finally:
+                self.release_archive(contents)
+        # Repack backwards, inner levels first
+        for key in sorted(levels, key=lambda key: (len(key), key),
+                          reverse=True):
+            if self.verbosity:
+                self.console_out("Processing repack...", extracted[key])
+            with self.stage('update', len(key) - 1, file=key[-1]) as record:
+                record['bytes_read'] = self.stage_size(extracted[key])
+                if len(key) > 1:
+                    self.repack_archive(extracted[key], levels[key])
+                    levels[key[:-1]][key[-1]] = extracted[key]
+                elif append:
+                    self.append_archive(extracted[key], levels[key])
+                else:
+                    self.repack_archive(extracted[key], levels[key])
+                record['bytes_written'] = self.stage_size(extracted[key])
+        self.discard_temp_archives()
+        return True
+
+    def serve(self, socket_path):
+        """Serve the requests of the clients from the unix socket until
+        interrupted (or terminated). The archives are kept open between the
+        requests and reopened when the outermost archive has changed"""
+        if os.path.exists(socket_path) and \
+                stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.remove(socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        opened = {}
+        served = collections.OrderedDict()
+        try:
+            # SIGTERM stops the server like interrupt, the signal can only
+            # be handled in the main thread
+            terminate = signal.signal(signal.SIGTERM, interrupt_handler)
+        except ValueError:
+            terminate = None
+        try:
+            # Only the user can connect to the socket, from its creation on
+            umask = os.umask(0o077)
+            try:
+                server.bind(socket_path)
+            finally:
+                os.umask(umask)
+            os.chmod(socket_path, stat.S_IRUSR | stat.S_IWUSR)
+            server.listen(5)
+            if self.verbosity:
+                self.console_out("Serving...", socket_path)
+            while True:
+                connection = server.accept()[0]
+                # Idle client does not block the others for long
+                connection.settimeout(self.serve_timeout)
+                try:
+                    self.serve_connection(connection, opened, served)
+                except socket.error as ex:
+                    if self.verbosity:
+                        self.console_err("Connection closed:", str(ex))
+                finally:
+                    connection.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            for contents in opened.values():
+                self.close_archive(contents)
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self.clean_tmp_dir()
+            if terminate is not None:
+                signal.signal(signal.SIGTERM, terminate)
+        return True
+
+    def serve_connection(self, connection, opened, served):
+        """Serve the JSON requests of the connection, one per line"""
+        stream = connection.makefile('rb')
+        try:
+            for line in stream:
+                try:
+                    response = {'status': 'ok', 'output':
+                                self.process_request(json.loads(line.decode(
+                                    'utf-8')), opened, served)}
+                except (IOError, OSError, RuntimeError, ValueError, KeyError,
+                        zipfile.BadZipfile) as ex:
+                    response = {'status': 'error', 'error': str(ex)}
+                connection.sendall((json.dumps(response) + '\n')
+                                   .encode('utf-8'))
+        finally:
+            stream.close()
+        return True
+
+    def process_request(self, request, opened, served):
+        """Process the request of the client: {'op': 'list', 'extract' or
+        'replace', 'path': path, 'destdir': dir, 'file': file, 'append':
+        bool}, returns the output lines"""
+        operation = request['op']
+        java_archive_path = request['path']
+        # Only the outermost archive file is needed, the nested archives
+        # are opened by the operation
+        filename = self.outer_archive_file(java_archive_path) or \
+            self.parse_java_path(java_archive_path)[0]
+        self.refresh_served(filename, opened, served)
+        if operation == 'list':
+            return self.process_filelist(java_archive_path, opened)
+        if operation == 'extract':
+            destination_dir = self.destination_dir
+            try:
+                self.set_destination_dir(request.get('destdir') or
+                                         destination_dir)
+                self.process_file_extract(java_archive_path, opened)
+            finally:
+                self.destination_dir = destination_dir
+            return []
+        if operation == 'replace':
+            # The archives are replaced by the update
+            self.refresh_served(filename, opened, served, True)
+            tmp_dir = self.tmp_dir
+            self.tmp_dir = tempfile.mkdtemp(prefix='update', dir=tmp_dir)
+            try:
+                if request.get('append'):
+                    self.process_file_append(java_archive_path,
+                                             request['file'])
+                else:
+                    self.process_file_update(java_archive_path,
+                                             request['file'])
+            finally:
+                # Archives still open keep their memory in /dev/shm
+                self.clean_tmp_dir(keep_shm=True)
+                self.tmp_dir = tmp_dir
+            return []
+        raise RuntimeError("error: invalid request operation " +
+                           str(operation))
+
+    def refresh_served(self, filename, opened, served, changed=False):
+        """Close the opened archives of the outermost archive when it has
+        changed (by inode, size and modification time) since served, and
+        the ones of the least recently served outermost archives (first in
+        the ordered served dict) over served_size"""
+        info = os.stat(filename)
+        identity = (info.st_dev, info.st_ino, info.st_size, info.st_mtime)
+        if changed or served.get(filename, identity) != identity:
+            self.close_served(filename, opened)
+        served.pop(filename, None)
+        served[filename] = identity
+        while len(served) > self.served_size:
+            oldest = next(iter(served))
+            self.close_served(oldest, opened)
+            del served[oldest]
+        return True
+
+    def close_served(self, filename, opened):
+        """Close the opened archives of the outermost archive"""
+        # Inner archives first, they can be read from the outer ones
+        for key in sorted(opened, key=len, reverse=True):
+            if key[0] == filename:
+                self.close_archive(opened.pop(key))
+        return True
+
+    def request_server(self, socket_path, request):
+        """Send the request to the server, returns the output lines"""
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(socket_path)
+            client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            stream = client.makefile('rb')
+            try:
+                response = json.loads(stream.readline().decode('utf-8'))
+            finally:
+                stream.close()
+        finally:
+            client.close()
+        if response['status'] != 'ok':
+            raise RuntimeError(response['error'])
+        return response['output']
 
     def process_file_update(self, java_archive_path, filename):
         """Process file update in to archive"""
-        java_filelist = self.parse_java_path(java_archive_path)
-        if java_filelist.__len__() is 1:
-            raise RuntimeError("error: no file to replace in path " +
-                               java_archive_path)
-        first_element = 0
-        last_element = len(java_filelist)-1
-        for i in range(0, len(java_filelist)):
-            # First element
-            if i == first_element:
-                # And same time the second last (two elements in array)
-                if i+1 == last_element:
-                    subdir = self.tmp_dir + os.sep + str(i)
-                    self.extract_file(java_filelist[i], java_filelist[i+1],
-                                      subdir)
-                    shutil.copy(filename, subdir + os.sep +
-                                java_filelist[i+1])
-
-                # More than two elements in a array
-                else:
-                    subdir = self.tmp_dir + os.sep + str(i)
-                    os.mkdir(subdir)
-                    self.extract_file(java_filelist[i], java_filelist[i+1],
-                                      subdir)
-
-            # All the next elements until second last element
-            if i > first_element and i < last_element:
-                nsubdir = self.tmp_dir + os.sep + str(i)
-                psubdir = self.tmp_dir + os.sep + str(i-1)
-                # Second last element
-                if i+1 == last_element:
-                    self.extract_file(psubdir + os.sep + java_filelist[i],
-                                      java_filelist[i+1],
-                                      nsubdir)
-                    shutil.copy(filename, nsubdir + os.sep +
-                                java_filelist[i+1])
-
-                # Other element than second last
-                else:
-                    os.mkdir(nsubdir)
-                    self.extract_file(psubdir + os.sep + java_filelist[i],
-                                      java_filelist[i+1], nsubdir)
-        # Repack backwards
+        java_filelist = self.prepare_file_update(java_archive_path, filename)
+        self.repack_file_update(java_filelist, self.update_file)
+        return True
+
+    def process_file_append(self, java_archive_path, filename):
+        """Process file update in to archive by appending the file to the
+        end of the outermost archive (the replaced file is left as dead space,
+        see process_compact)"""
+        java_filelist = self.prepare_file_update(java_archive_path, filename)
+        self.repack_file_update(java_filelist, self.append_file)
+        return True
+
+    def process_compact(self, java_archive_path):
+        """Process compacting the dead space out of the archive"""
+        filename = self.outer_archive_file(java_archive_path) or \
+            self.parse_java_path(java_archive_path)[0]
+        if filename != java_archive_path:
+            raise RuntimeError("error: only the outermost archive can be " +
+                               "compacted " + java_archive_path)
+        size = os.stat(filename).st_size
+        self.repack_archive(filename, {})
+        if self.verbosity:
+            self.console_out("Compacted bytes:", size -
+                             os.stat(filename).st_size)
+        return True
+
+    def prepare_file_update(self, java_archive_path, filename, opened=None):
+        """Extract the nested archives and place the file for the update, the
+        archives opened for resolving the path are shared through the opened
+        dict and written to the levels without decompressing them again"""
+        shared = {} if opened is None else opened
+        try:
+            java_filelist = self.resolve_java_path(java_archive_path, shared)
+            if java_filelist.__len__() is 1:
+                raise RuntimeError("error: no file to replace in path " +
+                                   java_archive_path)
+            self.release_levels()
+            first_element = 0
+            last_element = len(java_filelist)-1
+            for i in range(0, len(java_filelist)):
+                # First element
+                if i == first_element:
+                    # And same time the second last (two elements in array)
+                    if i+1 == last_element:
+                        subdir = self.level_dir(str(i), java_filelist[i],
+                                                java_filelist[i+1])
+                        self.extract_level(java_filelist, i, java_filelist[i],
+                                           subdir, shared)
+                        shutil.copy(filename, subdir + os.sep +
+                                    java_filelist[i+1])
+
+                    # More than two elements in a array
+                    else:
+                        subdir = self.level_dir(str(i), java_filelist[i],
+                                                java_filelist[i+1])
+                        os.mkdir(subdir)
+                        self.extract_level(java_filelist, i, java_filelist[i],
+                                           subdir, shared)
+
+                # All the next elements until second last element
+                if i > first_element and i < last_element:
+                    psubdir = self.level_dir(str(i-1))
+                    nsubdir = self.level_dir(str(i), psubdir + os.sep +
+                                             java_filelist[i],
+                                             java_filelist[i+1])
+                    # Second last element
+                    if i+1 == last_element:
+                        self.extract_level(java_filelist, i, psubdir + os.sep +
+                                           java_filelist[i], nsubdir, shared)
+                        shutil.copy(filename, nsubdir + os.sep +
+                                    java_filelist[i+1])
+
+                    # Other element than second last
+                    else:
+                        os.mkdir(nsubdir)
+                        self.extract_level(java_filelist, i, psubdir + os.sep +
+                                           java_filelist[i], nsubdir, shared)
+        finally:
+            if opened is None:
+                for contents in shared.values():
+                    self.close_archive(contents)
+        return java_filelist
+
+    def extract_level(self, java_filelist, i, filename, target_dir, opened):
+        """Extract the file i+1 of the list of nested archives from the
+        archive file of the level i, the archives already opened are written
+        as they are. Archives read from the archive cache (or from the
+        archives in it) are extracted, the cache is keyed only by CRC-32 and
+        size and the archive is written back to its parent"""
+        key = tuple(java_filelist[:i + 2])
+        if key not in opened or (self.cache_dir is not None and
+                                 self.archive_name(opened[key]).startswith(
+                                     self.cache_dir + os.sep)):
+            return self.extract_file(filename, java_filelist[i + 1],
+                                     target_dir, i)
+        return self.write_opened(opened[key], target_dir + os.sep +
+                                 java_filelist[i + 1], i)
+
+    def write_opened(self, contents, target_file, level=None):
+        """Write the opened (nested) archive to the file as it is: the
+        archives in memory or in place from their buffer or window, the
+        extracted ones by copying the file"""
+        if self.verbosity:
+            self.console_out("Processing write...", target_file)
+        if not os.path.isdir(os.path.dirname(target_file)):
+            os.makedirs(os.path.dirname(target_file))
+        with self.stage('extract', level, file=target_file) as record:
+            if isinstance(contents.fp, ArchiveWindow) or \
+                    hasattr(contents.fp, 'getvalue'):
+                contents.fp.seek(0)
+                with open(target_file, 'wb') as target:
+                    shutil.copyfileobj(contents.fp, target)
+            else:
+                shutil.copyfile(self.archive_name(contents), target_file)
+            record['bytes_written'] = self.stage_size(target_file)
+        return True
+
+    def repack_file_update(self, java_filelist, update):
+        """Repack the prepared update backwards, the outermost archive is
+        updated with the given update method"""
         for j in range(len(java_filelist)-1, 0, -1):
             file_to_replace = java_filelist[j]
             file_to_update = java_filelist[j-1]
-            nsubdir = self.tmp_dir + os.sep + str(j-1)
-            psubdir = self.tmp_dir + os.sep + str(j-2)
+            nsubdir = self.level_dir(str(j-1))
+            psubdir = self.level_dir(str(j-2))
             if j-1 > 0:
                 self.update_file(psubdir+os.sep+file_to_update,
-                                 file_to_replace, nsubdir)
+                                 file_to_replace, nsubdir, j-1)
             else:
-                self.update_file(file_to_update, file_to_replace, nsubdir)
+                update(file_to_update, file_to_replace, nsubdir, 0)
+        self.discard_temp_archives()
+        return True
 
+    def discard_temp_archives(self):
+        """Close the pooled archives of the temp dirs, the extracted
+        archives are not read after the update"""
+        for temp_dir in (self.tmp_dir, self.shm_dir):
+            if temp_dir:
+                self.archive_pool.discard_path(temp_dir)
+        return True
+
+    def fleet_targets(self, targets):
+        """Expand the target archives: glob patterns and @files listing
+        the archives (one per line), duplicates are dropped"""
+        archives = []
+        for target in targets:
+            if target.startswith('@'):
+                with open(target[1:]) as listing:
+                    expanded = [line.strip() for line in listing
+                                if line.strip()]
+            elif glob.has_magic(target):
+                expanded = sorted(glob.glob(target))
+            else:
+                expanded = [target]
+            archives.extend([archive for archive in expanded
+                             if archive not in archives])
+        return archives
+
+    def process_fleet_update(self, java_archive_path, targets, filename,
+                             append=False, workers=None):
+        """Replace the file of the nested path in each of the target
+        archives by the worker processes, each with a temp dir of its own.
+        Generates the result of each archive as it completes, the summary is
+        written to stderr"""
+        archives = self.fleet_targets(targets)
+        if not archives:
+            raise RuntimeError("error: no target archives found")
+        update = functools.partial(fleet_update, filename=filename,
+                                   temp_dir=self.tmp_dir or None,
+                                   append=append,
+                                   jar_command=self.jar_command,
+                                   compression=self.compression_policy())
+        pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+        failed = 0
+        total = 0
+        start = time.time()
+        try:
+            for path, error, seconds, size in pool.imap_unordered(
+                    update, [archive + os.sep + java_archive_path
+                             for archive in archives]):
+                total += size
+                if error is None:
+                    yield "patched {0} in {1:.2f} s".format(path, seconds)
+                else:
+                    failed += 1
+                    yield "failed {0}: {1}".format(path, error)
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = max(time.time() - start, 0.001)
+        self.console_err("Patched {0} of {1} archives ({2:.1f} MB) in "
+                         "{3:.2f} s, {4:.1f} MB/s, {5} failed".format(
+                             len(archives) - failed, len(archives),
+                             total / 1048576.0, elapsed,
+                             total / 1048576.0 / elapsed, failed))
+        if failed:
+            raise RuntimeError("error: " + str(failed) + " of " +
+                               str(len(archives)) + " archives failed")
+
+
+def fleet_update(java_archive_path, filename, temp_dir=None, append=False,
+                 jar_command="", compression=None):
+    """Replace the file in the archive with a tool and temp dir of its own,
+    returns (path, error or None, seconds, size of the archive) (run by the
+    worker processes)"""
+    start = time.time()
+    tool = JarEarWarRar()
+    tool.jar_command = jar_command
+    for name, value in (compression or {}).items():
+        setattr(tool, name, value)
+    # The archives are already updated in parallel
+    tool.compress_workers = 1
+    error = None
+    size = 0
+    try:
+        tool.set_temp_dir(temp_dir)
+        if append:
+            tool.process_file_append(java_archive_path, filename)
+        else:
+            tool.process_file_update(java_archive_path, filename)
+        outer = tool.outer_archive_file(java_archive_path)
+        size = tool.stage_size(outer) if outer is not None else 0
+    # pylint: disable=broad-except
+    except Exception as ex:
+        error = str(ex) or ex.__class__.__name__
+    finally:
+        tool.close()
+        tool.clean_tmp_dir()
+    return java_archive_path, error, time.time() - start, size
+
+
+class AsyncJarEarWarRar(object):
+    """asyncio API of the archive operations. The operations are run by an
+    executor of up to workers threads, each with a tool and a temp dir of
+    its own, so the event loop is never blocked (the archives are repacked
+    with the built-in archive writer, or the jar command in the thread).
+    The methods return futures to be awaited, e.g.
+    filelist = await service.filelist('example.ear')"""
+    workers = 4
+
+    def __init__(self, workers=None, temp_dir=None, jar_command="",
+                 loop=None):
+        if asyncio is None:
+            raise RuntimeError("error: asyncio is not available")
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            workers or self.workers)
+        self.temp_dir = temp_dir
+        self.jar_command = jar_command
+        self.loop = loop
+
+    def filelist(self, java_archive_path):
+        """List the files of the archive path"""
+        return self.submit(lambda tool: list(tool.process_filelist(
+            java_archive_path)))
+
+    def extract(self, java_archive_path, destination_dir=None):
+        """Extract the file of the archive path to destination dir"""
+        def extract(tool):
+            """Extract with the tool of the thread"""
+            tool.set_destination_dir(destination_dir)
+            return tool.process_file_extract(java_archive_path)
+        return self.submit(extract)
+
+    def update(self, java_archive_path, filename, append=False):
+        """Replace the file of the archive path with the file"""
+        if append:
+            return self.submit(lambda tool: tool.process_file_append(
+                java_archive_path, filename))
+        return self.submit(lambda tool: tool.process_file_update(
+            java_archive_path, filename))
+
+    def submit(self, operation):
+        """Run the operation(tool) by the executor, returns the future of
+        its result"""
+        loop = self.loop or asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, self.run, operation)
+
+    def run(self, operation):
+        """Run the operation with a tool of its own (run by the
+        executor)"""
+        tool = JarEarWarRar()
+        tool.jar_command = self.jar_command
+        try:
+            tool.set_temp_dir(self.temp_dir)
+            return operation(tool)
+        finally:
+            tool.close()
+            tool.clean_tmp_dir()
+
+    def close(self):
+        """Shut down the executor, waiting for the operations"""
+        self.executor.shutdown()
         return True
 
 
@@ -366,12 +2986,17 @@ def test(test_name=None):
         """Built-in testsuite"""
 
         # pylint: disable=unused-argument
+        @mock.patch('os.stat')
         @mock.patch.object(JarEarWarRar, 'console_out', return_value=True)
         @mock.patch('jewr.zipfile.ZipFile')
-        def test_extract_file(self, mock_zipfile, mock_out):
+        def test_extract_file(self, mock_zipfile, mock_out, mock_stat):
             """Testing file extraction from Java archive"""
+            mock_stat.return_value.st_size = 0
             mock_zipfile.return_value.namelist.return_value = \
                 ['foo' + os.sep, 'foo' + os.sep + 'bar.jar', 'baz.jar']
+            mock_zipfile.return_value.getinfo.side_effect = dict(
+                (name, mock.MagicMock()) for name in
+                mock_zipfile.return_value.namelist.return_value).__getitem__
             tool = JarEarWarRar()
             tool.verbosity = True
             # Test the sunshiny path, file is found'test.
@@ -398,6 +3023,16 @@ def test(test_name=None):
 
             tool = JarEarWarRar()
             tool.verbosity = True
+            # Built-in archive writer is used when jar command is not set
+            with mock.patch.object(JarEarWarRar, 'repack_archive',
+                                   return_value=True) as mock_repack:
+                tool.update_file("foo.ear", "foo" + os.sep + "bar.jar",
+                                 "/tmp")
+                mock_repack.assert_called_with(
+                    "foo.ear", {"foo" + os.sep + "bar.jar": "/tmp" + os.sep +
+                                "foo" + os.sep + "bar.jar"})
+                self.assertFalse(mock_popen.called)
+
             tool.set_jar_path("/usr/bin")
             # Test the sunshiny path, file is found test.
             tool.update_file("foo.ear", "foo" + os.sep + "bar.jar", "/tmp")
@@ -410,6 +3045,442 @@ def test(test_name=None):
             self.assertRaises(IOError, tool.update_file, "foo.ear", "foo" +
                               os.sep + "bar.jar", "/tmp")
 
+        def test_archive_writer(self):
+            """Testing built-in archive writer"""
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as src:
+                src.writestr('foo{0}bar.properties'.format(os.sep),
+                             'foo=bar' * 100)
+                src.writestr('baz.txt', 'baz')
+            archive.write('trailing')
+            contents = zipfile.ZipFile(archive, 'r')
+            output = io.BytesIO()
+            writer = ArchiveWriter(output)
+            # Unchanged entry is copied as it is
+            writer.copy_entry(archive, contents.getinfo(
+                'foo{0}bar.properties'.format(os.sep)))
+            # New entries are compressed or stored
+            for name, compress_type in [('new.txt', zipfile.ZIP_DEFLATED),
+                                        ('lib{0}new.jar'.format(os.sep),
+                                         zipfile.ZIP_STORED)]:
+                zinfo = zipfile.ZipInfo(name, (2014, 1, 2, 3, 4, 5))
+                zinfo.compress_type = compress_type
+                zinfo.file_size = 6
+                writer.write_entry(zinfo, io.BytesIO('abcdef'))
+            writer.close('comment')
+
+            result = zipfile.ZipFile(output, 'r')
+            self.assertEqual(result.testzip(), None)
+            self.assertEqual(result.namelist(),
+                             ['foo{0}bar.properties'.format(os.sep),
+                              'new.txt', 'lib{0}new.jar'.format(os.sep)])
+            self.assertEqual(result.read('foo{0}bar.properties'
+                                         .format(os.sep)), 'foo=bar' * 100)
+            self.assertEqual(result.read('new.txt'), 'abcdef')
+            self.assertEqual(result.getinfo('lib{0}new.jar'.format(os.sep))
+                             .compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(result.getinfo('new.txt').date_time,
+                             (2014, 1, 2, 3, 4, 4))
+            self.assertEqual(result.comment, 'comment')
+            # Unchanged entry is not compressed again
+            self.assertEqual(result.getinfo('foo{0}bar.properties'
+                                            .format(os.sep)).compress_size,
+                             contents.getinfo('foo{0}bar.properties'
+                                              .format(os.sep)).compress_size)
+
+        def test_write_parallel(self):
+            """Testing big entries are deflated in parallel chunks"""
+            rand = random.Random(0)
+            data = b''.join([rand.choice([b'foo', b'bar', b'baz\n'])
+                             for _ in range(20000)])
+            output = io.BytesIO()
+            writer = ArchiveWriter(output, 3)
+            writer.chunk_size = 4096
+            writer.parallel_size = 10000
+            for name, content in [('big.txt', data), ('small.txt', b'qux'),
+                                  ('empty.txt', b'')]:
+                zinfo = zipfile.ZipInfo(name)
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                zinfo.file_size = 10000 if name == 'empty.txt' else \
+                    len(content)
+                with mock.patch.object(sys.modules[__name__],
+                                       'deflate_chunk',
+                                       side_effect=deflate_chunk) \
+                        as mock_deflate:
+                    writer.write_entry(zinfo, io.BytesIO(content), 6)
+                    self.assertEqual(mock_deflate.call_count,
+                                     {'big.txt': len(data) // 4096 + 1,
+                                      'small.txt': 0,
+                                      'empty.txt': 1}[name])
+            writer.close()
+            result = zipfile.ZipFile(output, 'r')
+            self.assertEqual(result.testzip(), None)
+            self.assertEqual(result.read('big.txt'), data)
+            self.assertEqual(result.read('small.txt'), b'qux')
+            self.assertEqual(result.read('empty.txt'), b'')
+            self.assertTrue(result.getinfo('big.txt').compress_size <
+                            len(data) // 2)
+
+        @mock.patch('jewr.zipfile.ZipFile')
+        @mock.patch('os.stat')
+        def test_archive_pool(self, mock_stat, mock_zipfile):
+            """Testing the pool of the opened archive files"""
+            mock_zipfile.side_effect = lambda *args: mock.MagicMock()
+            mock_stat.return_value = mock.MagicMock(st_ino=1, st_size=2,
+                                                    st_mtime=3)
+            # Absolute paths, the pool keys do not depend on the cwd
+            srv = os.sep + 'srv' + os.sep
+            with ArchivePool(2) as pool:
+                foo = pool.open(srv + 'foo.jar')
+                self.assertTrue(pool.open(srv + 'foo.jar') is foo)
+                bar = pool.open(srv + 'bar.jar')
+                self.assertEqual((pool.hits, pool.misses), (1, 2))
+                self.assertTrue(pool.pooled(foo))
+                # The least recently used archive is closed
+                pool.open(srv + 'foo.jar')
+                baz = pool.open(srv + 'baz.jar')
+                self.assertTrue(bar.close.called)
+                self.assertFalse(pool.pooled(bar))
+                self.assertFalse(foo.close.called)
+                # Changed archive files are opened again
+                mock_stat.return_value.st_mtime = 4
+                self.assertFalse(pool.open(srv + 'foo.jar') is foo)
+                self.assertTrue(foo.close.called)
+                self.assertEqual((pool.hits, pool.misses), (2, 4))
+                # The archives of a removed temp dir are closed
+                temp = pool.open(os.sep + 'tmp' + os.sep + 'qux.jar')
+                pool.discard_path(os.sep + 'tmp')
+                self.assertEqual([key[0] for key in pool.order],
+                                 [srv + 'foo.jar'])
+                self.assertTrue(temp.close.called)
+                self.assertFalse(pool.pooled(temp))
+                self.assertEqual(len(pool.archives), 1)
+            self.assertTrue(baz.close.called)
+            self.assertEqual(pool.archives, {})
+
+        @mock.patch('jewr.zipfile.ZipFile')
+        @mock.patch('os.stat')
+        def test_release_archive(self, mock_stat, mock_zipfile):
+            """Testing the archives of the pool are kept open"""
+            mock_stat.return_value.st_size = 0
+            with JarEarWarRar() as tool:
+                contents = tool.open_archive('foo.jar')
+                tool.release_archive(contents)
+                self.assertFalse(contents.close.called)
+                nested = mock.MagicMock()
+                tool.release_archive(nested)
+                self.assertTrue(nested.close.called)
+            self.assertTrue(contents.close.called)
+            # Without the pool the archives are opened every time
+            tool.pool_size = 0
+            tool.open_archive('foo.jar')
+            tool.open_archive('foo.jar')
+            self.assertEqual(mock_zipfile.call_count, 3)
+
+        def test_mapped_archive(self):
+            """Testing reading the memory mapped archive"""
+            handle, filename = tempfile.mkstemp(suffix='.jar')
+            try:
+                with os.fdopen(handle, 'wb') as output:
+                    # Data prepended to the archive
+                    output.write(b'#!/bin/sh\n')
+                    with zipfile.ZipFile(output, 'w') as archive:
+                        archive.writestr('META-INF{0}'.format(os.sep), '')
+                        archive.writestr('foo.txt', 'foo' * 100000,
+                                         zipfile.ZIP_DEFLATED)
+                        archive.writestr('bar.txt', 'bar')
+                        archive.comment = b'baz'
+                expected = zipfile.ZipFile(filename)
+                with MappedArchive(filename) as contents:
+                    self.assertEqual(contents.namelist(),
+                                     expected.namelist())
+                    self.assertEqual(contents.comment, b'baz')
+                    for name in expected.namelist():
+                        self.assertEqual(contents.read(name),
+                                         expected.read(name))
+                        for attr in ('CRC', 'file_size', 'compress_size',
+                                     'header_offset', 'date_time'):
+                            self.assertEqual(
+                                getattr(contents.getinfo(name), attr),
+                                getattr(expected.getinfo(name), attr))
+                    # Data is decompressed in chunks as it is read
+                    entry = contents.open('foo.txt')
+                    self.assertEqual(entry.read(4), b'foof')
+                    self.assertEqual(len(entry.read()), 299996)
+                    self.assertRaises(KeyError, contents.getinfo, 'baz.txt')
+                expected.close()
+                # Broken data is detected
+                with open(filename, 'r+b') as output:
+                    output.seek(expected.getinfo('bar.txt').header_offset +
+                                30 + len('bar.txt'))
+                    output.write(b'baz')
+                with MappedArchive(filename) as contents:
+                    self.assertRaises(zipfile.BadZipfile, contents.read,
+                                      'bar.txt')
+                with open(filename, 'wb') as output:
+                    output.write(b'foo')
+                self.assertRaises(zipfile.BadZipfile, MappedArchive,
+                                  filename)
+            finally:
+                os.remove(filename)
+
+        @mock.patch('os.path.getsize', return_value=1024)
+        @mock.patch.object(sys.modules[__name__], 'MappedArchive')
+        @mock.patch('jewr.zipfile.ZipFile')
+        def test_open_archive_file(self, mock_zipfile, mock_mapped,
+                                   mock_size):
+            """Testing big archive files are memory mapped"""
+            tool = JarEarWarRar()
+            self.assertEqual(tool.open_archive_file('foo.ear'),
+                             mock_zipfile.return_value)
+            tool.mapped_size = 1024
+            self.assertEqual(tool.open_archive_file('foo.ear'),
+                             mock_mapped.return_value)
+            mock_mapped.assert_called_with('foo.ear')
+
+        def test_archive_window(self):
+            """Testing reading a region of a file"""
+            window = ArchiveWindow(io.BytesIO(b'foobarbaz'), 3, 3)
+            self.assertEqual(window.read(2), b'ba')
+            self.assertEqual(window.read(), b'r')
+            self.assertEqual(window.read(), b'')
+            self.assertEqual(window.seek(-2, os.SEEK_END), 1)
+            self.assertEqual(window.read(5), b'ar')
+            self.assertEqual(window.tell(), 3)
+            self.assertRaises(IOError, window.seek, -1)
+            self.assertTrue(window.close())
+
+        def test_write_opened(self):
+            """Testing writing the opened archive without decompressing"""
+            data = io.BytesIO()
+            with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('foo.properties', 'foo=bar')
+            outer = io.BytesIO(b'foo' + data.getvalue() + b'bar')
+            tool = JarEarWarRar()
+            for contents in (zipfile.ZipFile(data), zipfile.ZipFile(
+                    ArchiveWindow(outer, 3, len(data.getvalue())))):
+                contents.read('foo.properties')
+                with mock.patch('__builtin__.open', mock.mock_open()) \
+                        as mock_open, \
+                        mock.patch('os.path.isdir', return_value=False), \
+                        mock.patch('os.path.getsize', return_value=0), \
+                        mock.patch('os.makedirs') as mock_makedirs:
+                    tool.write_opened(contents, '/tmp/0/lib/foo.jar', 1)
+                    self.assertTrue(mock_makedirs.called)
+                    self.assertEqual(b''.join(
+                        call[0][0] for call in
+                        mock_open.return_value.write.call_args_list),
+                                     data.getvalue())
+            # Archives extracted to a file are copied
+            contents = mock.Mock(fp=mock.Mock(spec=['read']),
+                                 filename='/tmp/shared1/foo.jar')
+            with mock.patch('shutil.copyfile') as mock_copy, \
+                    mock.patch('os.path.isdir', return_value=True), \
+                    mock.patch('os.path.getsize', return_value=0):
+                tool.write_opened(contents, '/tmp/0/foo.jar')
+                mock_copy.assert_called_with('/tmp/shared1/foo.jar',
+                                             '/tmp/0/foo.jar')
+
+        @mock.patch.object(JarEarWarRar, 'console_out', return_value=True)
+        def test_write_repacked(self, mock_out):
+            """Testing writing archive with replaced files"""
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as src:
+                src.writestr('foo.properties', 'foo=bar')
+                src.writestr('baz.txt', 'baz')
+            tool = JarEarWarRar()
+            tool.verbosity = True
+            output = io.BytesIO()
+            zinfos = [zipfile.ZipInfo('foo.properties'),
+                      zipfile.ZipInfo('new.txt')]
+            for zinfo in zinfos:
+                zinfo.file_size = 7
+            with mock.patch('__builtin__.open',
+                            mock.mock_open(read_data='foo=baz')), \
+                mock.patch.object(JarEarWarRar, 'get_replacement_info',
+                                  side_effect=zinfos) as mock_info:
+                tool.write_repacked(archive, output,
+                                    {'foo.properties': '/tmp/foo',
+                                     'new.txt': '/tmp/new'})
+                mock_info.assert_has_calls(
+                    [mock.call('foo.properties', '/tmp/foo'),
+                     mock.call('new.txt', '/tmp/new')])
+            result = zipfile.ZipFile(output, 'r')
+            self.assertEqual(result.namelist(), ['foo.properties', 'baz.txt',
+                                                 'new.txt'])
+            self.assertEqual(result.read('foo.properties'), 'foo=baz')
+            self.assertEqual(result.read('baz.txt'), 'baz')
+
+        def test_compress_method(self):
+            """Testing the compression policy of the written entries"""
+            tool = JarEarWarRar()
+            stored = zipfile.ZipInfo('foo.jar')
+            deflated = zipfile.ZipInfo('bar.txt')
+            deflated.compress_type = zipfile.ZIP_DEFLATED
+            self.assertEqual(tool.compress_method('foo.jar'),
+                             (zipfile.ZIP_DEFLATED,
+                              zlib.Z_DEFAULT_COMPRESSION))
+            tool.compress_level = 1
+            tool.store_compressed = True
+            self.assertEqual(tool.compress_method('lib/foo.JAR'),
+                             (zipfile.ZIP_STORED, 0))
+            self.assertEqual(tool.compress_method('img/foo.png', deflated),
+                             (zipfile.ZIP_STORED, 0))
+            self.assertEqual(tool.compress_method('bar.txt'),
+                             (zipfile.ZIP_DEFLATED, 1))
+            # Replaced entries keep their method when keep_method is set
+            tool.keep_method = True
+            self.assertEqual(tool.compress_method('foo.jar', deflated),
+                             (zipfile.ZIP_DEFLATED, 1))
+            self.assertEqual(tool.compress_method('bar.txt', stored),
+                             (zipfile.ZIP_STORED, 0))
+            self.assertEqual(tool.compress_method('baz.jar'),
+                             (zipfile.ZIP_STORED, 0))
+            # Level 0 stores everything
+            tool.keep_method = False
+            tool.compress_level = 0
+            self.assertEqual(tool.compress_method('bar.txt'),
+                             (zipfile.ZIP_STORED, 0))
+            self.assertEqual(sorted(tool.compression_policy()),
+                             ['compress_level', 'keep_method',
+                              'store_compressed'])
+
+        def test_write_replacement(self):
+            """Testing the replacement is written by the policy"""
+            tool = JarEarWarRar()
+            tool.store_compressed = True
+            writer = mock.Mock()
+            with mock.patch('__builtin__.open',
+                            mock.mock_open(read_data='foo')), \
+                mock.patch.object(JarEarWarRar, 'get_replacement_info',
+                                  side_effect=lambda path, filename:
+                                  zipfile.ZipInfo(path)):
+                tool.write_replacement(writer, 'lib/foo.jar', '/tmp/foo')
+                zinfo = writer.write_entry.call_args[0][0]
+                self.assertEqual(zinfo.compress_type, zipfile.ZIP_STORED)
+                self.assertEqual(writer.write_entry.call_args[0][2], 0)
+                tool.write_replacement(writer, 'foo.xml', '/tmp/foo')
+                zinfo = writer.write_entry.call_args[0][0]
+                self.assertEqual(zinfo.compress_type, zipfile.ZIP_DEFLATED)
+
+        def test_write_appended(self):
+            """Testing appending files to the end of the archive"""
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as src:
+                src.writestr('foo.properties', 'foo=bar')
+                src.writestr('baz.txt', 'baz')
+            original = archive.getvalue()
+            start_dir = zipfile.ZipFile(archive, 'r').start_dir
+            zinfo = zipfile.ZipInfo('foo.properties')
+            zinfo.file_size = 7
+            tool = JarEarWarRar()
+            with mock.patch('__builtin__.open',
+                            mock.mock_open(read_data='foo=baz')), \
+                mock.patch.object(JarEarWarRar, 'get_replacement_info',
+                                  return_value=zinfo):
+                tool.write_appended(archive, {'foo.properties': '/tmp/foo'})
+            # Old entries are left in place
+            self.assertEqual(archive.getvalue()[:start_dir],
+                             original[:start_dir])
+            result = zipfile.ZipFile(archive, 'r')
+            self.assertEqual(result.testzip(), None)
+            self.assertEqual(result.namelist(), ['foo.properties',
+                                                 'baz.txt'])
+            self.assertEqual(result.read('foo.properties'), 'foo=baz')
+            self.assertTrue(result.getinfo('foo.properties').header_offset >=
+                            start_dir)
+            # Failed append leaves the archive as it was
+            archive = io.BytesIO(original)
+
+            def fail_write(writer, archive_path, filename, zinfo=None):
+                writer.fileobj.write(b'PK\003\004broken')
+                raise IOError("No space left on device")
+            with mock.patch.object(JarEarWarRar, 'write_replacement',
+                                   side_effect=fail_write):
+                self.assertRaises(IOError, tool.write_appended, archive,
+                                  {'foo.properties': '/tmp/foo'})
+            self.assertEqual(archive.getvalue(), original)
+            result = zipfile.ZipFile(archive, 'r')
+            self.assertEqual(result.testzip(), None)
+            self.assertEqual(result.read('foo.properties'), 'foo=bar')
+
+        # pylint: disable=unused-argument,no-self-use
+        @mock.patch.object(JarEarWarRar, 'write_repacked', return_value=True)
+        def test_repack_archive(self, mock_write):
+            """Testing archive is repacked through temporary file"""
+            with mock.patch('__builtin__.open', mock.mock_open()), \
+                mock.patch('os.fdopen', mock.mock_open()), \
+                mock.patch('os.rename') as mock_rename, \
+                mock.patch('os.chmod'), mock.patch('os.stat'), \
+                mock.patch('os.remove') as mock_remove, \
+                mock.patch('tempfile.mkstemp',
+                           return_value=(3, '/foo/.jewrtmp')) as mock_temp:
+                tool = JarEarWarRar()
+                tool.repack_archive('/foo/bar.ear', {'baz': '/tmp/baz'})
+                mock_temp.assert_called_with(prefix='.jewr', dir='/foo')
+                self.assertEqual(mock_write.call_args[0][2],
+                                 {'baz': '/tmp/baz'})
+                mock_rename.assert_called_with('/foo/.jewrtmp',
+                                               '/foo/bar.ear')
+                # Temporary file is removed on failure
+                mock_write.side_effect = IOError('foo')
+                self.assertRaises(IOError, tool.repack_archive,
+                                  '/foo/bar.ear', {'baz': '/tmp/baz'})
+                mock_remove.assert_called_with('/foo/.jewrtmp')
+
+        def test_stage(self):
+            """Testing timing the stages of the operations"""
+            tool = JarEarWarRar()
+            records = []
+            tool.add_hook(records.append)
+            with tool.stage('extract', 1, file='foo.jar') as record:
+                record['bytes_read'] = 10
+            self.assertEqual(tool.stats, None)
+            self.assertEqual(records[0]['name'], 'extract')
+            self.assertEqual(records[0]['level'], 1)
+            self.assertEqual(records[0]['args'], {'file': 'foo.jar'})
+            self.assertEqual(records[0]['bytes_read'], 10)
+            self.assertTrue(records[0]['duration'] >= 0)
+            # Failed stages are recorded too
+            tool.stats = []
+            try:
+                with tool.stage('update', 0):
+                    raise IOError('foo')
+            except IOError:
+                pass
+            self.assertEqual([record['name'] for record in tool.stats],
+                             ['update'])
+            self.assertEqual(len(records), 2)
+
+        def test_stats_summary(self):
+            """Testing the summary and the trace of the timed stages"""
+            tool = JarEarWarRar()
+            tool.stats = []
+            for level, duration in ((0, 1.0), (0, 2.0), (None, 4.0)):
+                with tool.stage('update' if level is None else 'extract',
+                                level, file='foo') as record:
+                    record['bytes_written'] = 5
+                record['duration'] = duration
+            lines = tool.stats_summary()
+            self.assertEqual(len(lines), 3)
+            self.assertEqual(lines[1].split(),
+                             ['update', '-', '1', '4.0000', '0', '0', '5'])
+            self.assertEqual(lines[2].split(),
+                             ['extract', '0', '2', '3.0000', '0', '0', '10'])
+            mock_file = mock.mock_open()
+            with mock.patch.object(sys.modules[__name__], 'open', mock_file,
+                                   create=True):
+                tool.write_trace(os.devnull)
+            mock_file.assert_called_with(os.devnull, 'w')
+            trace = json.loads(''.join(call[0][0] for call in
+                                       mock_file().write.call_args_list))
+            self.assertEqual(len(trace['traceEvents']), 3)
+            self.assertEqual(trace['traceEvents'][1]['ph'], 'X')
+            self.assertEqual(trace['traceEvents'][1]['dur'], 2000000)
+            self.assertEqual(trace['traceEvents'][1]['args'],
+                             {'file': 'foo', 'level': 0, 'bytes_read': 0,
+                              'bytes_decompressed': 0, 'bytes_written': 5})
+
         # pylint: disable=no-self-use
         def test_console_out(self):
             """Test console out to stdout"""
@@ -418,6 +3489,15 @@ def test(test_name=None):
                 msg = 'foo'
                 tool.console_out(msg)
                 mock_print.assert_has_calls([mock.call(msg, file=sys.stdout)])
+                # Only the messages of writing a file to stdout go to stderr
+                tool.destination_dir = '-'
+                tool.console_out(msg)
+                self.assertEqual(mock_print.call_args,
+                                 mock.call(msg, file=sys.stdout))
+                tool.stdout_data = True
+                tool.console_out(msg)
+                self.assertEqual(mock_print.call_args,
+                                 mock.call(msg, file=sys.stderr))
 
         # pylint: disable=no-self-use
         def test_console_err(self):
@@ -477,6 +3557,49 @@ def test(test_name=None):
             parse_result = tool.parse_java_path(java_archive_path)
             self.assertEquals(parse_result, expected_parse)
 
+        def test_resolve_java_path(self):
+            """Testing resolving the path by the names of the archives"""
+            inner = io.BytesIO()
+            with zipfile.ZipFile(inner, 'w') as archive:
+                archive.writestr('META-INF{0}foo.xml'.format(os.sep), 'foo')
+            handle, filename = tempfile.mkstemp(suffix='.ear')
+            try:
+                with os.fdopen(handle, 'wb') as output:
+                    with zipfile.ZipFile(output, 'w') as archive:
+                        archive.writestr('lib{0}baz.sar'.format(os.sep),
+                                         inner.getvalue())
+                        archive.writestr('conf.jar{0}'.format(os.sep), '')
+                        archive.writestr('conf.jar{0}bar.xml'.format(os.sep),
+                                         'bar')
+                tool = JarEarWarRar()
+                # Nested archive of other type
+                path = filename + '{0}lib{0}baz.sar{0}META-INF{0}foo.xml' \
+                    .format(os.sep)
+                self.assertEqual(tool.resolve_java_path(path), [
+                    filename, 'lib{0}baz.sar'.format(os.sep),
+                    'META-INF{0}foo.xml'.format(os.sep)])
+                self.assertEqual(tool.resolve_java_path_types(
+                    filename + '{0}lib{0}baz.sar'.format(os.sep)),
+                                 [True, True])
+                # Dir named like an archive
+                path = filename + '{0}conf.jar{0}bar.xml'.format(os.sep)
+                self.assertEqual(tool.resolve_java_path(path), [
+                    filename, 'conf.jar{0}bar.xml'.format(os.sep)])
+                self.assertEqual(tool.resolve_java_path_types(
+                    filename + '{0}conf.jar'.format(os.sep)), [True, False])
+                # Memoized
+                with mock.patch.object(JarEarWarRar, 'open_archive_path') \
+                        as mock_open_path:
+                    tool.resolve_java_path(path)
+                    self.assertFalse(mock_open_path.called)
+            finally:
+                tool.close()
+                os.remove(filename)
+            # Not found, falls back on parsing the path
+            self.assertEqual(tool.resolve_java_path(
+                'foo.ear{0}bar.war{0}baz.txt'.format(os.sep)),
+                             ['foo.ear', 'bar.war', 'baz.txt'])
+
         def test_parse_java_path_types(self):
             """Testing parsing java path and splitting to types list"""
             tool = JarEarWarRar()
@@ -519,6 +3642,66 @@ def test(test_name=None):
             tool.set_temp_dir("/foo")
             self.assertEquals(tool.tmp_dir.startswith("/foo"), True)
 
+        def test_memory_budget(self):
+            """Testing the nested archives are placed by the memory budget"""
+            tool = JarEarWarRar()
+            tool.memory_budget = 1000
+            shm_dir = '/dev/shm/tmp1' + os.sep
+            tmp_dir = '/tmp/tmp2' + os.sep
+            with mock.patch('os.access', return_value=True), \
+                    mock.patch('tempfile.mkdtemp',
+                               side_effect=[shm_dir[:-1], tmp_dir[:-1]]) \
+                    as mock_temp, \
+                    mock.patch('shutil.rmtree') as mock_rmtree:
+                tool.set_temp_dir()
+                # Temp dir is on disk next to the one in /dev/shm
+                mock_temp.assert_called_with(suffix='', prefix='tmp',
+                                             dir=None)
+                self.assertEqual(tool.place_temp('0', 'a.war', 600),
+                                 shm_dir + '0')
+                # Does not fit the rest of the budget
+                self.assertEqual(tool.place_temp('0', 'b.war', 600),
+                                 tmp_dir + '0')
+                self.assertTrue(tool.charge_memory('foo.ear/c.jar', 400))
+                self.assertFalse(tool.charge_memory('foo.ear/d.jar', 1))
+                tool.release_memory('foo.ear/c.jar')
+                self.assertEqual(tool.memory_used, 600)
+                # Update levels are placed once, for the archive and its
+                # repacked copy
+                with mock.patch.object(JarEarWarRar, 'get_file_info',
+                                       return_value=mock.Mock(
+                                           file_size=200)) as mock_info:
+                    self.assertEqual(tool.level_dir('1', 'foo.ear', 'e.war'),
+                                     shm_dir + '1')
+                    self.assertEqual(tool.level_dir('1'), shm_dir + '1')
+                    mock_info.assert_called_once_with('foo.ear', 'e.war')
+                self.assertEqual(tool.memory_used, 1000)
+                tool.release_levels()
+                mock_rmtree.assert_called_with(shm_dir + '1',
+                                               ignore_errors=True)
+                self.assertEqual(tool.memory_used, 600)
+                # Windows opened in place share the charge of the archive
+                self.assertTrue(tool.charge_memory('foo.ear/g.war', 100))
+                tool.share_memory('foo.ear/g.war', 'foo.ear/g.war/h.jar')
+                tool.share_memory('foo.ear/g.war/h.jar',
+                                  'foo.ear/g.war/h.jar/i.jar')
+                tool.release_memory('foo.ear/g.war')
+                tool.release_memory('foo.ear/g.war/h.jar')
+                self.assertEqual(tool.memory_used, 700)
+                tool.release_memory('foo.ear/g.war/h.jar/i.jar')
+                self.assertEqual(tool.memory_used, 600)
+                # The dir in /dev/shm is kept for the archives still open
+                tool.clean_tmp_dir(keep_shm=True)
+                self.assertEqual((tool.shm_dir, tool.memory_used),
+                                 (shm_dir[:-1], 600))
+                tool.clean_tmp_dir()
+                mock_rmtree.assert_called_with(shm_dir[:-1],
+                                               ignore_errors=True)
+                self.assertEqual((tool.shm_dir, tool.memory_used), (None, 0))
+            self.assertEqual(byte_size('1.5K'), 1536)
+            self.assertEqual(byte_size('2g'), 2 * 1024 ** 3)
+            self.assertRaises(argparse.ArgumentTypeError, byte_size, 'foo')
+
         def test_clean_tmp_dir(self):
             """Testing temp directory cleaning functionality"""
             tool = JarEarWarRar()
@@ -532,19 +3715,201 @@ def test(test_name=None):
             # pylint: disable=maybe-no-member
             shutil.rmtree.assert_called_with('/dev/shm/tempdir')
 
-        # pylint: disable=no-self-use
-        def test_return_file(self):
-            """Testing file return functionality"""
+        # pylint: disable=no-self-use
+        def test_return_file(self):
+            """Testing file return functionality"""
+            tool = JarEarWarRar()
+            os.getcwd = mock.MagicMock(return_value='/tmp/test')
+            os.access = mock.MagicMock(return_value=True)
+            shutil.move = mock.MagicMock(return_value=True)
+            tool.set_destination_dir()
+            tool.return_file('/tmp/td/2/lib/foo.properties')
+
+            # pylint: disable=maybe-no-member
+            shutil.move.assert_called_with('/tmp/td/2/lib/foo.properties',
+                                           '/tmp/test')
+
+        @mock.patch.object(JarEarWarRar, 'console_out', return_value=True)
+        def test_set_cache_dir(self, mock_out):
+            """Testing if cache directory can be set properly"""
+            tool = JarEarWarRar()
+            tool.verbosity = True
+            with mock.patch('os.path.isdir', return_value=False), \
+                    mock.patch('os.makedirs') as mock_makedirs, \
+                    mock.patch('os.access', return_value=True):
+                tool.set_cache_dir('/foo')
+                self.assertEqual(tool.cache_dir, '/foo')
+                mock_makedirs.assert_called_with('/foo')
+                with mock.patch.dict('os.environ',
+                                     {'JEWR_CACHE_DIR': '/bar',
+                                      'XDG_CACHE_HOME': '/baz'}, clear=True):
+                    tool.set_cache_dir()
+                    self.assertEqual(tool.cache_dir, '/bar')
+                with mock.patch.dict('os.environ', {'XDG_CACHE_HOME': '/baz'},
+                                     clear=True):
+                    tool.set_cache_dir()
+                    self.assertEqual(tool.cache_dir, '/baz/jewr')
+            with mock.patch('os.path.isdir', return_value=True), \
+                    mock.patch('os.access', return_value=False):
+                self.assertRaises(IOError, tool.set_cache_dir, '/foo')
+
+        @mock.patch.object(JarEarWarRar, 'console_out', return_value=True)
+        def test_read_cache(self, mock_out):
+            """Testing reading file list from cache"""
+            tool = JarEarWarRar()
+            tool.verbosity = True
+            tool.cache_dir = '/cache'
+            with mock.patch('__builtin__.open',
+                            mock.mock_open(read_data='[["foo.txt", 3, 7]]')) \
+                    as mock_file, mock.patch('os.utime') as mock_utime:
+                self.assertEqual(tool.read_cache('abc'), [['foo.txt', 3, 7]])
+                mock_file.assert_called_with('/cache{0}abc.json'
+                                             .format(os.sep))
+                mock_utime.assert_called_with('/cache{0}abc.json'
+                                              .format(os.sep), None)
+            # Cache miss
+            with mock.patch('__builtin__.open', side_effect=IOError('foo')):
+                self.assertEqual(tool.read_cache('abc'), None)
+
+        @mock.patch.object(JarEarWarRar, 'console_err', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'evict_cache', return_value=True)
+        def test_write_cache(self, mock_evict, mock_err):
+            """Testing writing file list to cache"""
+            tool = JarEarWarRar()
+            tool.verbosity = True
+            tool.cache_dir = '/cache'
+            with mock.patch('tempfile.mkstemp',
+                            return_value=(3, '/cache/.jewrtmp')), \
+                    mock.patch('os.fdopen', mock.mock_open()) as mock_file, \
+                    mock.patch('os.rename') as mock_rename:
+                self.assertTrue(tool.write_cache('abc', [['foo.txt', 3, 7]]))
+                mock_file.assert_called_with(3, 'w')
+                mock_rename.assert_called_with('/cache/.jewrtmp',
+                                               '/cache{0}abc.json'
+                                               .format(os.sep))
+                self.assertTrue(mock_evict.called)
+                # Failing cache does not fail the listing
+                mock_rename.side_effect = OSError('foo')
+                self.assertFalse(tool.write_cache('abc', []))
+
+        def test_evict_cache(self):
+            """Testing least recently used cache files are evicted"""
+            tool = JarEarWarRar()
+            tool.cache_dir = '/cache'
+            tool.cache_size = 250
+            stats = {'/cache{0}a.json'.format(os.sep): (3, 100),
+                     '/cache{0}b.json'.format(os.sep): (1, 100),
+                     '/cache{0}c.json'.format(os.sep): (2, 100)}
+
+            def fake_stat(path):
+                """Fake stat for cache files"""
+                file_stat = mock.MagicMock()
+                file_stat.st_mtime, file_stat.st_size = stats[path]
+                file_stat.st_mode = stat.S_IFREG
+                return file_stat
+            with mock.patch('os.listdir',
+                            return_value=['a.json', 'b.json', 'c.json']), \
+                    mock.patch('os.stat', side_effect=fake_stat), \
+                    mock.patch('os.remove') as mock_remove:
+                tool.evict_cache()
+                mock_remove.assert_called_once_with('/cache{0}b.json'
+                                                    .format(os.sep))
+                mock_remove.reset_mock()
+                tool.evict_cache('/cache', 50)
+                self.assertEqual(mock_remove.call_count, 3)
+
+        @mock.patch.object(JarEarWarRar, 'evict_cache', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'open_archive_file')
+        @mock.patch.object(JarEarWarRar, 'extract_file', return_value=True)
+        @mock.patch('shutil.rmtree')
+        @mock.patch('os.rename')
+        @mock.patch('os.path.isdir', return_value=True)
+        def test_open_cached_archive(self, mock_isdir, mock_rename,
+                                     mock_rmtree, mock_extract, mock_open,
+                                     mock_evict):
+            """Testing nested archives are shared through the cache"""
             tool = JarEarWarRar()
-            os.getcwd = mock.MagicMock(return_value='/tmp/test')
-            os.access = mock.MagicMock(return_value=True)
-            shutil.move = mock.MagicMock(return_value=True)
-            tool.set_destination_dir()
-            tool.return_file('/tmp/td/2/lib/foo.properties')
+            tool.cache_dir = '/cache'
+            info = zipfile.ZipInfo('lib{0}baz.jar'.format(os.sep))
+            info.CRC, info.file_size = 1234, 100
+            cache_file = '/cache{0}archives{0}{1}.jar'.format(
+                os.sep, tool.cache_key(1234, 100))
+            # Cache miss, extracted to the cache
+            with mock.patch('os.utime', side_effect=OSError), \
+                    mock.patch('tempfile.mkdtemp', return_value='/tmp1'):
+                self.assertEqual(tool.open_cached_archive(
+                    'bar.ear', 'lib{0}baz.jar'.format(os.sep), info, 1),
+                                 mock_open.return_value)
+                mock_extract.assert_called_with(
+                    'bar.ear', 'lib{0}baz.jar'.format(os.sep), '/tmp1', 1)
+                mock_rename.assert_called_with(
+                    '/tmp1{0}lib{0}baz.jar'.format(os.sep), cache_file)
+                mock_rmtree.assert_called_with('/tmp1', ignore_errors=True)
+            mock_open.assert_called_with(cache_file)
+            mock_evict.assert_called_with('/cache{0}archives'.format(os.sep),
+                                          tool.archive_cache_size)
+            # Cache hit, the same contents in another archive
+            mock_extract.reset_mock()
+            with mock.patch('os.utime') as mock_utime:
+                tool.open_cached_archive('foo.ear', 'qux.jar', info, 0)
+                mock_utime.assert_called_with(cache_file, None)
+            self.assertFalse(mock_extract.called)
+            mock_open.assert_called_with(cache_file)
 
-            # pylint: disable=maybe-no-member
-            shutil.move.assert_called_with('/tmp/td/2/lib/foo.properties',
-                                           '/tmp/test')
+        @mock.patch.object(JarEarWarRar, 'close_archive', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'write_cache', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'open_archive_path')
+        def test_cached_filelist(self, mock_open_path, mock_write,
+                                 mock_close):
+            """Testing file list of nested archive from cache"""
+            tool = JarEarWarRar()
+            tool.cache_dir = '/cache'
+            ear = [['foo.war', 100, 7], ['baz.txt', 3, 8]]
+            war = [['a.txt', 1, 9]]
+            with mock.patch('os.stat') as mock_stat:
+                mock_stat.return_value.st_size = 200
+                mock_stat.return_value.st_mtime = 1.5
+                ear_key = tool.cache_key(os.path.abspath('bar.ear'), 200,
+                                         '1.5')
+                war_key = tool.cache_key(ear_key, 'foo.war', 100, 7)
+                # Warm cache, archives are not opened
+                caches = {ear_key: ear, war_key: war}
+                with mock.patch.object(JarEarWarRar, 'read_cache',
+                                       side_effect=caches.get):
+                    self.assertEqual(tool.cached_filelist(['bar.ear',
+                                                           'foo.war']), war)
+                    self.assertFalse(mock_open_path.called)
+                    self.assertRaises(IOError, tool.cached_filelist,
+                                      ['bar.ear', 'qux.war'])
+                # Cold cache for the nested archive
+                zinfo = zipfile.ZipInfo('a.txt')
+                zinfo.file_size = 1
+                zinfo.CRC = 9
+                mock_open_path.return_value.infolist.return_value = [zinfo]
+                with mock.patch.object(JarEarWarRar, 'read_cache',
+                                       side_effect={ear_key: ear}.get):
+                    self.assertEqual(tool.cached_filelist(['bar.ear',
+                                                           'foo.war']),
+                                     war)
+                    self.assertEqual(mock_open_path.call_args[0][0],
+                                     ['bar.ear', 'foo.war'])
+                    mock_write.assert_called_with(war_key, war)
+
+        @mock.patch.object(JarEarWarRar, 'cached_filelist',
+                           return_value=[['META-INF{0}'.format(os.sep), 0, 0],
+                                         ['baz.txt', 3, 7]])
+        def test_process_filelist_cached(self, mock_cached):
+            """Testing file list processing with cache"""
+            tool = JarEarWarRar()
+            tool.cache_dir = '/cache'
+            self.assertEqual(tool.process_filelist('bar.ear'),
+                             ['META-INF{0}'.format(os.sep), 'baz.txt'])
+            mock_cached.assert_called_with(['bar.ear'], {})
+            self.assertEqual(tool.process_filelist('bar.ear{0}baz'
+                                                   .format(os.sep)),
+                             ['baz.txt'])
+            self.assertRaises(IOError, tool.process_filelist,
+                              'bar.ear{0}qux'.format(os.sep))
 
         def test_set_destination_dir(self):
             """Testing if destination directory can be set properly"""
@@ -565,14 +3930,16 @@ def test(test_name=None):
             os.access = mock.MagicMock(return_value=False)
             self.assertRaises(IOError, tool.set_destination_dir)
 
-        # pylint: disable=unused-argument,too-many-arguments
+            # Stdout is always writeable
+            tool.set_destination_dir('-')
+            self.assertEquals(tool.destination_dir, '-')
+
+        # pylint: disable=unused-argument
         @mock.patch.object(JarEarWarRar, 'console_out', return_value=True)
-        @mock.patch.object(JarEarWarRar, 'return_file', return_value=True)
-        @mock.patch.object(JarEarWarRar, 'extract_file', return_value=True)
-        @mock.patch.object(JarEarWarRar, 'clean_tmp_dir', return_value=True)
-        def test_process_file_extract(self, mock_clean_tmp,
-                                      mock_extract, mock_return_file,
-                                      mock_out):
+        @mock.patch.object(JarEarWarRar, 'return_entry', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'open_archive_path')
+        def test_process_file_extract(self, mock_open_path,
+                                      mock_return_entry, mock_out):
             """Testing file processing and call order"""
             with mock.patch.object(JarEarWarRar, 'parse_java_path',
                                    return_value=['bar.ear', 'foo.war',
@@ -583,51 +3950,599 @@ def test(test_name=None):
                 # Sunshine path with many elements
                 path = 'bar.ear{0}foo.war{0}META-INF{0}lib{0}baz.jar{0}\
                         baz.properties'.format(os.sep)
-                temp = '{0}dev{0}shm{0}tempdir'.format(os.sep)
-                target = '{0}{1}2'.format(temp, os.sep)
-                dest_dir = '{0}foo'.format(os.sep)
-                os.mkdir = mock.MagicMock(return_value=True)
                 os.access = mock.MagicMock(return_value=True)
-                shutil.move = mock.MagicMock(return_value=True)
-                tempfile.mkdtemp = mock.MagicMock(return_value=temp)
 
                 tool = JarEarWarRar()
                 tool.verbosity = True
-                tool.set_temp_dir(temp)
-                tool.set_destination_dir(dest_dir)
+                tool.set_destination_dir('{0}foo'.format(os.sep))
+                # The opened archives are closed after the extract
+                mock_open_path.side_effect = lambda filelist, opened: \
+                    opened.setdefault(tuple(filelist),
+                                      mock_open_path.return_value)
                 tool.process_file_extract(path)
                 self.assertEquals(mock_parse.called, True)
-                tool.tmp_dir = temp
-                calls = [mock.call("{0}{1}0".format(temp, os.sep)),
-                         mock.call("{0}{1}1".format(temp, os.sep))]
-                # pylint: disable=maybe-no-member
-                os.mkdir.assert_has_calls(calls)
-                extracts = [mock.call("bar.ear", "foo.war", '{0}{1}0'.
-                                      format(temp, os.sep)),
-                            mock.call('{0}{1}0{1}foo.war'.
-                                      format(temp, os.sep),
-                                      'META-INF{0}lib{0}baz.jar'.
-                                      format(os.sep),
-                                      '{0}{1}1'.
-                                      format(temp, os.sep)),
-                            mock.call('{0}{1}1{1}META-INF{1}lib{1}baz.jar'.
-                                      format(temp, os.sep),
-                                      'baz.properties', target)
-                            ]
-                mock_extract.assert_has_calls(extracts)
-                mock_return_file.assert_called_with('{0}{1}baz.properties'.
-                                                    format(target, os.sep))
+                mock_open_path.assert_called_with(
+                    ['bar.ear', 'foo.war',
+                     'META-INF{0}lib{0}baz.jar'.format(os.sep)],
+                    {('bar.ear', 'foo.war', 'META-INF{0}lib{0}baz.jar'.format(
+                        os.sep)): mock_open_path.return_value})
+                mock_return_entry.assert_called_with(
+                    mock_open_path.return_value, 'baz.properties')
+                self.assertTrue(mock_open_path.return_value.close.called)
+                self.assertFalse(tool.stdout_data)
+                # The messages go to stderr only while writing to stdout
+                tool.destination_dir = '-'
+                mock_return_entry.side_effect = lambda *_: \
+                    self.assertTrue(tool.stdout_data)
+                tool.process_file_extract(path)
+                self.assertFalse(tool.stdout_data)
+                mock_return_entry.side_effect = None
             with mock.patch.object(JarEarWarRar, 'parse_java_path',
                                    return_value=['bar.ear']):
                 path = 'bar.ear'
                 self.assertRaises(RuntimeError, tool.process_file_extract,
                                   'path')
 
+        @mock.patch.object(JarEarWarRar, 'console_out', return_value=True)
+        def test_open_nested_archive(self, mock_out):
+            """Testing opening nested archive in place, in memory and on
+            disk"""
+            inner = io.BytesIO()
+            with zipfile.ZipFile(inner, 'w') as archive:
+                archive.writestr('baz.properties', 'foo=bar')
+            outer = io.BytesIO()
+            with zipfile.ZipFile(outer, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('lib{0}baz.jar'.format(os.sep),
+                                 inner.getvalue())
+                archive.writestr(zipfile.ZipInfo('lib{0}qux.jar'.format(
+                    os.sep)), inner.getvalue())
+            contents = zipfile.ZipFile(outer, 'r')
+            contents.filename = 'bar.ear'
+            tool = JarEarWarRar()
+            tool.verbosity = True
+            tool.tmp_dir = '{0}tempdir'.format(os.sep)
+
+            # Sunshine path, nested archive is read in memory
+            nested = tool.open_nested_archive(contents,
+                                              'lib{0}baz.jar'.format(os.sep),
+                                              0)
+            self.assertEqual(nested.namelist(), ['baz.properties'])
+            self.assertEqual(nested.filename,
+                             'bar.ear{0}lib{0}baz.jar'.format(os.sep))
+
+            # Stored nested archive is opened as a window of the archive
+            nested = tool.open_nested_archive(contents,
+                                              'lib{0}qux.jar'.format(os.sep),
+                                              0)
+            self.assertIsInstance(nested.fp, ArchiveWindow)
+            self.assertEqual(nested.read('baz.properties'), b'foo=bar')
+            self.assertEqual(nested.filename,
+                             'bar.ear{0}lib{0}qux.jar'.format(os.sep))
+            tool.release_archive(nested)
+
+            # Archive over the memory limit is extracted to temp dir
+            tool.memory_limit = 0
+            with mock.patch.object(JarEarWarRar, 'extract_file',
+                                   return_value=True) as mock_extract, \
+                    mock.patch.object(JarEarWarRar, 'open_archive_file') \
+                    as mock_open:
+                tool.open_nested_archive(contents,
+                                         'lib{0}baz.jar'.format(os.sep), 1)
+                mock_extract.assert_called_with(
+                    contents, 'lib{0}baz.jar'.format(os.sep),
+                    '{0}tempdir{0}1'.format(os.sep), 1)
+                mock_open.assert_called_with(
+                    '{0}tempdir{0}1{0}lib{0}baz.jar'.format(os.sep))
+
+            # Nested archive not found
+            self.assertRaises(IOError, tool.open_nested_archive, contents,
+                              'foo.jar', 0)
+
+        @mock.patch.object(JarEarWarRar, 'console_err', return_value=True)
+        def test_walk_filelist(self, mock_err):
+            """Testing listing files of the nested archives"""
+            inner = io.BytesIO()
+            with zipfile.ZipFile(inner, 'w') as archive:
+                archive.writestr('baz.properties', 'foo=bar')
+            outer = io.BytesIO()
+            with zipfile.ZipFile(outer, 'w') as archive:
+                archive.writestr('lib{0}'.format(os.sep), '')
+                archive.writestr('lib{0}baz.jar'.format(os.sep),
+                                 inner.getvalue())
+                archive.writestr('lib{0}broken.jar'.format(os.sep), 'foo')
+                archive.writestr('foo.txt', 'foo')
+            tool = JarEarWarRar()
+            contents = zipfile.ZipFile(outer, 'r')
+            contents.filename = 'bar.ear'
+            filelist = tool.walk_filelist(contents, 'bar.ear', 0)
+            # Files are generated as they are found
+            self.assertEqual(next(filelist), 'bar.ear{0}lib{0}'
+                             .format(os.sep))
+            self.assertEqual(list(filelist),
+                             ['bar.ear{0}lib{0}baz.jar'.format(os.sep),
+                              'bar.ear{0}lib{0}baz.jar{0}baz.properties'
+                              .format(os.sep),
+                              'bar.ear{0}lib{0}broken.jar'.format(os.sep),
+                              'bar.ear{0}foo.txt'.format(os.sep)])
+            self.assertTrue(mock_err.called)
+            # Filter applies to the outermost archive
+            self.assertEqual(list(tool.walk_filelist(contents, 'bar.ear', 0,
+                                                     'lib{0}baz'
+                                                     .format(os.sep))),
+                             ['bar.ear{0}lib{0}baz.jar'.format(os.sep),
+                              'bar.ear{0}lib{0}baz.jar{0}baz.properties'
+                              .format(os.sep)])
+
+        @mock.patch.object(JarEarWarRar, 'close_archive', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'walk_filelist',
+                           return_value=iter(['foo']))
+        @mock.patch.object(JarEarWarRar, 'open_archive_path')
+        def test_process_filelist_recursive(self, mock_open_path, mock_walk,
+                                            mock_close):
+            """Testing recursive file list processing"""
+            mock_open_path.side_effect = lambda java_filelist, opened: \
+                opened.setdefault(tuple(java_filelist),
+                                  mock_open_path.return_value)
+            tool = JarEarWarRar()
+            path = 'bar.ear{0}foo.war{0}META-INF'.format(os.sep)
+            self.assertEqual(list(tool.process_filelist_recursive(path)),
+                             ['foo'])
+            self.assertEqual(mock_open_path.call_args[0][0],
+                             ['bar.ear', 'foo.war'])
+            mock_walk.assert_called_with(mock_open_path.return_value, '',
+                                         1, 'META-INF')
+            mock_close.assert_called_with(mock_open_path.return_value)
+
+        def test_compile_pattern(self):
+            """Testing glob and regex patterns of nested paths"""
+            tool = JarEarWarRar()
+            path = 'foo.war{0}WEB-INF{0}lib{0}bar.jar'.format(os.sep)
+            self.assertTrue(tool.compile_pattern('*.jar')(path))
+            self.assertTrue(tool.compile_pattern('b?r.[ijk]ar')(path))
+            self.assertFalse(tool.compile_pattern('*.war')(path))
+            self.assertTrue(tool.compile_pattern('**{0}lib{0}*.jar'
+                                                 .format(os.sep))(path))
+            self.assertFalse(tool.compile_pattern('*{0}lib{0}*.jar'
+                                                  .format(os.sep))(path))
+            self.assertTrue(tool.compile_pattern('foo.war{0}**'
+                                                 .format(os.sep))(path))
+            self.assertTrue(tool.compile_pattern('INF.lib', True)(path))
+            self.assertFalse(tool.compile_pattern('^lib', True)(path))
+
+        def test_process_pattern_extract(self):
+            """Testing extracting files matching the pattern with workers"""
+            inner = io.BytesIO()
+            with zipfile.ZipFile(inner, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('baz.properties', 'foo=bar')
+                archive.writestr('baz.txt', 'baz')
+            outer = io.BytesIO()
+            with zipfile.ZipFile(outer, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('lib{0}'.format(os.sep), '')
+                archive.writestr('lib{0}baz.jar'.format(os.sep),
+                                 inner.getvalue())
+                archive.writestr('..{0}foo.properties'.format(os.sep),
+                                 'foo=baz')
+            written = {}
+
+            def write_entry(source, target):
+                """Collect the written files"""
+                written[target] = source.read()
+                return True
+            tool = JarEarWarRar()
+            tool.destination_dir = 'foo'
+            with mock.patch.object(JarEarWarRar, 'open_archive_path',
+                                   side_effect=lambda *_: zipfile.ZipFile(
+                                       outer)), \
+                    mock.patch.object(tool, 'write_entry',
+                                      side_effect=write_entry):
+                self.assertTrue(tool.process_pattern_extract(
+                    'bar.ear', '*.properties', workers=2))
+                # Parent dirs are dropped from the paths
+                self.assertEqual(written, {
+                    'foo{0}lib{0}baz.jar{0}baz.properties'.format(os.sep):
+                    b'foo=bar',
+                    'foo{0}foo.properties'.format(os.sep): b'foo=baz'})
+                # Matching archives are extracted as they are, without workers
+                written.clear()
+                tool.memory_limit = 0
+                self.assertTrue(tool.process_pattern_extract(
+                    'bar.ear', 'lib{0}*.jar'.format(os.sep)))
+                self.assertEqual(written, {
+                    'foo{0}lib{0}baz.jar'.format(os.sep): inner.getvalue()})
+                # No matching files
+                written.clear()
+                self.assertRaises(IOError, tool.process_pattern_extract,
+                                  'bar.ear', '*.xml')
+                self.assertEqual(written, {})
+            # No workers are started for a missing archive
+            with mock.patch.object(JarEarWarRar, 'open_java_path',
+                                   side_effect=IOError('bar.ear')), \
+                    mock.patch('multiprocessing.pool.ThreadPool') \
+                    as mock_pool:
+                self.assertRaises(IOError, tool.process_pattern_extract,
+                                  'bar.ear', '*.properties')
+                self.assertFalse(mock_pool.called)
+            # Failed file releases its slot
+            pending = threading.BoundedSemaphore(1)
+            pending.acquire()
+            zinfo = zipfile.ZipInfo('foo.txt')
+            zinfo.CRC = 0
+            self.assertRaises(IOError, tool.write_raw_entry, b'foo', zinfo,
+                              'foo.txt', pending)
+            self.assertTrue(pending.acquire(False))
+
+        def test_nested_opened_once(self):
+            """Testing each nested archive is opened once per operation"""
+            jar = io.BytesIO()
+            with zipfile.ZipFile(jar, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('META-INF/MANIFEST.MF', 'foo')
+            war = io.BytesIO()
+            with zipfile.ZipFile(war, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('WEB-INF/lib/baz.jar', jar.getvalue())
+            ear = io.BytesIO()
+            with zipfile.ZipFile(ear, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('foo.war', war.getvalue())
+            path = 'bar.ear{0}foo.war{0}WEB-INF{0}lib{0}baz.jar{0}META-INF' \
+                '{0}MANIFEST.MF'.format(os.sep)
+            tool = JarEarWarRar()
+            tool.tmp_dir = '/tempdir'
+            with mock.patch.object(JarEarWarRar, 'outer_archive_file',
+                                   return_value='bar.ear'), \
+                mock.patch.object(JarEarWarRar, 'archive_identity',
+                                  return_value=('/bar.ear', 1, 2, 3.0)), \
+                mock.patch.object(JarEarWarRar, 'open_archive',
+                                  side_effect=lambda filename: filename if
+                                  hasattr(filename, 'namelist') else
+                                  zipfile.ZipFile(ear)), \
+                mock.patch.object(JarEarWarRar, 'open_nested_archive',
+                                  autospec=True,
+                                  side_effect=JarEarWarRar.
+                                  open_nested_archive) as mock_nested, \
+                mock.patch('os.mkdir'), mock.patch('shutil.copy'), \
+                mock.patch.object(JarEarWarRar, 'extract_file',
+                                  return_value=True) as mock_extract, \
+                mock.patch.object(JarEarWarRar, 'write_opened',
+                                  return_value=True) as mock_write:
+                tool.prepare_file_update(path, 'new.txt')
+                self.assertEqual([call[0][2] for call in
+                                  mock_nested.call_args_list],
+                                 ['foo.war', 'WEB-INF/lib/baz.jar'])
+                # Only the replaced file is extracted from its archive
+                self.assertEqual([call[0][1] for call in
+                                  mock_write.call_args_list],
+                                 ['/tempdir/0/foo.war',
+                                  '/tempdir/1/WEB-INF/lib/baz.jar'])
+                self.assertEqual(mock_extract.call_args[0][1:3],
+                                 ('META-INF/MANIFEST.MF', '/tempdir/2'))
+                self.assertEqual(mock_extract.call_count, 1)
+                mock_nested.reset_mock()
+                self.assertEqual(len(list(tool.process_filelist_recursive(
+                    path))), 1)
+                self.assertEqual(mock_nested.call_count, 2)
+                # Archives of the cache are extracted for the update
+                mock_write.reset_mock()
+                mock_extract.reset_mock()
+                tool.cache_dir = '/cache'
+                cached = mock.Mock(filename='/cache/archives/0.jar/foo.jar')
+                tool.extract_level(['bar.ear', 'foo.jar', 'baz.jar'], 1,
+                                   '/tempdir/0/foo.jar', '/tempdir/1',
+                                   {('bar.ear', 'foo.jar', 'baz.jar'):
+                                    cached})
+                mock_extract.assert_called_with('/tempdir/0/foo.jar',
+                                                'baz.jar', '/tempdir/1', 1)
+                self.assertFalse(mock_write.called)
+
+        def test_process_grep(self):
+            """Testing searching the files of the nested archives"""
+            inner = io.BytesIO()
+            with zipfile.ZipFile(inner, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('baz.properties', 'foo=bar\nbar=foo')
+                archive.writestr('Baz.class', b'\xca\xfe\xba\xbe\0foo')
+            outer = io.BytesIO()
+            with zipfile.ZipFile(outer, 'w') as archive:
+                archive.writestr('lib{0}baz.jar'.format(os.sep),
+                                 inner.getvalue())
+                archive.writestr('foo.txt', 'bar')
+            tool = JarEarWarRar()
+            with mock.patch.object(JarEarWarRar, 'open_archive_path',
+                                   side_effect=lambda *_: zipfile.ZipFile(
+                                       outer)):
+                # Binary files are skipped
+                self.assertEqual(list(tool.process_grep(
+                    'bar.ear', 'foo', workers=2)), [
+                        'lib{0}baz.jar{0}baz.properties:0:foo'.format(os.sep),
+                        'lib{0}baz.jar{0}baz.properties:12:foo'.format(
+                            os.sep)])
+                self.assertEqual(list(tool.process_grep(
+                    'bar.ear', 'fo+', '*.class', binary=True)),
+                                 ['lib{0}baz.jar{0}Baz.class:5:foo'.format(
+                                     os.sep)])
+                # Files over the memory limit are searched without workers
+                tool.memory_limit = 0
+                self.assertEqual(list(tool.process_grep(
+                    'bar.ear', 'ba.', '*.txt')), ['foo.txt:0:bar'])
+            # No workers are started for a missing archive
+            with mock.patch.object(JarEarWarRar, 'open_java_path',
+                                   side_effect=IOError('bar.ear')), \
+                    mock.patch('multiprocessing.pool.ThreadPool') \
+                    as mock_pool:
+                self.assertRaises(IOError, list,
+                                  tool.process_grep('bar.ear', 'foo'))
+                self.assertFalse(mock_pool.called)
+            # Failed search releases its slot
+            pending = threading.BoundedSemaphore(1)
+            pending.acquire()
+            zinfo = zipfile.ZipInfo('foo.txt')
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            self.assertRaises(zlib.error, tool.grep_raw_entry, b'foo', zinfo,
+                              re.compile(b'foo').finditer, 'foo.txt',
+                              pending=pending)
+            self.assertTrue(pending.acquire(False))
+
+        @mock.patch.object(JarEarWarRar, 'console_err', return_value=True)
+        def test_process_verify(self, mock_err):
+            """Testing verifying the files of the nested archives"""
+            inner = io.BytesIO()
+            with zipfile.ZipFile(inner, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('baz.properties', 'foo=bar')
+            outer = io.BytesIO()
+            with zipfile.ZipFile(outer, 'w') as archive:
+                archive.writestr('lib{0}'.format(os.sep), '')
+                archive.writestr('lib{0}baz.jar'.format(os.sep),
+                                 inner.getvalue())
+                archive.writestr('foo.txt', 'qux')
+            tool = JarEarWarRar()
+            with mock.patch.object(JarEarWarRar, 'open_archive_path',
+                                   side_effect=lambda *_: zipfile.ZipFile(
+                                       io.BytesIO(outer.getvalue()))):
+                self.assertEqual(list(tool.process_verify('bar.ear')), [])
+                mock_err.assert_called_with(mock.ANY)
+                self.assertTrue(mock_err.call_args[0][0].startswith(
+                    'Verified 3 files'))
+                # Files are sent to the workers one by one
+                tool.verify_batch_size = 0
+                self.assertEqual(list(tool.process_verify(
+                    'bar.ear', 'sha256', 2))[1:], [
+                        hashlib.sha256(b'foo=bar').hexdigest() +
+                        '  lib{0}baz.jar{0}baz.properties'.format(os.sep),
+                        hashlib.sha256(b'qux').hexdigest() + '  foo.txt'])
+                self.assertRaises(ValueError, list, tool.process_verify(
+                    'bar.ear', 'foo'))
+            # Broken file, also when bigger than memory limit
+            outer = io.BytesIO(outer.getvalue().replace(b'qux', b'quy'))
+            for tool.memory_limit in (tool.memory_limit, 0):
+                with mock.patch.object(JarEarWarRar, 'open_archive_path',
+                                       side_effect=lambda *_: zipfile.ZipFile(
+                                           outer)):
+                    self.assertRaises(RuntimeError, list,
+                                      tool.process_verify('bar.ear'))
+                    mock_err.assert_any_call('Bad CRC-32 for file', 'foo.txt')
+            # No workers are started for a missing archive
+            with mock.patch.object(JarEarWarRar, 'open_java_path',
+                                   side_effect=IOError('bar.ear')), \
+                    mock.patch('multiprocessing.Pool') as mock_pool:
+                self.assertRaises(IOError, list,
+                                  tool.process_verify('bar.ear'))
+                self.assertFalse(mock_pool.called)
+            # Failed batch fails the verify instead of blocking it
+            tool.verify_batch_size = 0
+            tool.memory_limit = JarEarWarRar.memory_limit
+            with mock.patch.object(JarEarWarRar, 'open_archive_path',
+                                   side_effect=lambda *_: zipfile.ZipFile(
+                                       outer)), \
+                    mock.patch('multiprocessing.Pool') as mock_pool:
+                failed = mock_pool.return_value.apply_async.return_value
+                failed.ready.return_value = True
+                failed.get.side_effect = MemoryError()
+                self.assertRaises(MemoryError, list,
+                                  tool.process_verify('bar.ear', workers=1))
+                self.assertTrue(mock_pool.return_value.join.called)
+
+        def test_process_diff(self):
+            """Testing comparing the archives by the central directories"""
+            archives = {}
+            for name, properties in (('foo.ear', 'foo=bar'),
+                                     ('bar.ear', 'foo=baz')):
+                inner = io.BytesIO()
+                with zipfile.ZipFile(inner, 'w') as archive:
+                    archive.writestr('baz.properties', properties)
+                    archive.writestr('baz.txt', 'baz')
+                archives[name] = io.BytesIO()
+                with zipfile.ZipFile(archives[name], 'w') as archive:
+                    archive.writestr('lib{0}baz.jar'.format(os.sep),
+                                     inner.getvalue())
+                    archive.writestr('lib{0}qux.jar'.format(os.sep), 'qux')
+                    archive.writestr(name + '.txt', 'foo')
+            tool = JarEarWarRar()
+            with mock.patch.object(JarEarWarRar, 'open_archive_path',
+                                   side_effect=lambda filelist, _:
+                                   zipfile.ZipFile(archives[filelist[0]])), \
+                    mock.patch.object(tool, 'open_nested_archive',
+                                      wraps=tool.open_nested_archive) \
+                    as mock_nested:
+                self.assertEqual(list(tool.process_diff('foo.ear',
+                                                        'bar.ear')), [
+                    'A bar.ear.txt',
+                    'D foo.ear.txt',
+                    'M lib{0}baz.jar'.format(os.sep),
+                    'M lib{0}baz.jar{0}baz.properties'.format(os.sep)])
+                # Unchanged nested archives are not opened
+                self.assertEqual(mock_nested.call_count, 2)
+                self.assertEqual(list(tool.process_diff('foo.ear',
+                                                        'foo.ear')), [])
+
+        @mock.patch('os.stat')
+        def test_process_index(self, mock_stat):
+            """Testing indexing the nested archives incrementally"""
+            inner = io.BytesIO()
+            with zipfile.ZipFile(inner, 'w') as archive:
+                archive.writestr('org/foo/Bar.class', 'bar')
+                archive.writestr('baz.properties', 'baz')
+            archives = []
+            for libs in ([('WEB-INF/lib/baz.jar', inner.getvalue())], []):
+                archives.append(io.BytesIO())
+                with zipfile.ZipFile(archives[-1], 'w') as archive:
+                    archive.writestr('WEB-INF/classes/org/foo/Baz.class',
+                                     'baz')
+                    for name, data in libs:
+                        archive.writestr(name, data)
+            opened = []
+            mock_stat.return_value.st_size = 100
+            mock_stat.return_value.st_mtime = 1.0
+            handle, index_file = tempfile.mkstemp()
+            os.close(handle)
+            path = os.path.abspath('bar.war')
+            tool = JarEarWarRar()
+            try:
+                with mock.patch.object(JarEarWarRar, 'open_archive_path',
+                                       side_effect=lambda *_: opened.append(
+                                           True) or zipfile.ZipFile(
+                                               archives[0])):
+                    self.assertEqual(tool.process_index('bar.war',
+                                                        index_file), 2)
+                    self.assertEqual(list(tool.process_lookup(
+                        index_file, 'org.foo.Bar')), [
+                            '{0}{1}WEB-INF/lib/baz.jar{1}org/foo/Bar.class '
+                            '{2:08x} 3'.format(path, os.sep,
+                                               zlib.crc32(b'bar') &
+                                               0xFFFFFFFF)])
+                    self.assertEqual(len(list(tool.process_lookup(
+                        index_file, 'org.foo.Baz'))), 1)
+                    self.assertEqual(len(list(tool.process_lookup(
+                        index_file, 'baz.properties'))), 1)
+                    # Unchanged archive is not opened
+                    self.assertEqual(tool.process_index('bar.war',
+                                                        index_file), 0)
+                    self.assertEqual(len(opened), 1)
+                    # Unchanged nested archive is not indexed again
+                    mock_stat.return_value.st_mtime = 2.0
+                    self.assertEqual(tool.process_index('bar.war',
+                                                        index_file), 1)
+                # Removed nested archive is removed from the index
+                archives.pop(0)
+                mock_stat.return_value.st_mtime = 3.0
+                with mock.patch.object(JarEarWarRar, 'open_archive_path',
+                                       side_effect=lambda *_: zipfile.ZipFile(
+                                           archives[0])):
+                    self.assertEqual(tool.process_index('bar.war',
+                                                        index_file), 1)
+                self.assertEqual(list(tool.process_lookup(
+                    index_file, 'org.foo.Bar')), [])
+            finally:
+                os.remove(index_file)
+
+        def test_grep_entry(self):
+            """Testing searching a file in chunks"""
+            tool = JarEarWarRar()
+            tool.grep_overlap = 4
+            search = re.compile(b'foo+').finditer
+            chunks = [b'xxfo', b'oxxxxx', b'xfooo', b'oo']
+            # Matches over the chunk boundaries are found once
+            self.assertEqual(tool.grep_entry(
+                (chunk for chunk in chunks), search, 'a'),
+                             [('a', 2, b'foo'), ('a', 11, b'fooooo')])
+            # Binary files are skipped
+            self.assertEqual(tool.grep_entry(
+                (chunk for chunk in [b'\0foo']), search, 'a'), [])
+            zinfo = zipfile.ZipInfo('a')
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            zinfo.CRC = 0
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+            data = compressor.compress(b'foo' * 100) + compressor.flush()
+            tool.chunk_size = 16
+            self.assertRaises(IOError, list, tool.raw_chunks(data, zinfo))
+            zinfo.CRC = zlib.crc32(b'foo' * 100) & 0xFFFFFFFF
+            self.assertEqual(b''.join(tool.raw_chunks(data, zinfo)),
+                             b'foo' * 100)
+
+        def test_close_archive(self):
+            """Testing archives extracted to temp dir are removed"""
+            tool = JarEarWarRar()
+            tool.tmp_dir = '{0}tempdir'.format(os.sep)
+            contents = mock.MagicMock()
+            with mock.patch('os.path.isfile', return_value=True), \
+                    mock.patch('os.remove') as mock_remove:
+                contents.filename = 'bar.ear'
+                tool.close_archive(contents)
+                self.assertTrue(contents.close.called)
+                self.assertFalse(mock_remove.called)
+                contents.filename = '{0}tempdir{0}0{0}foo.war'.format(os.sep)
+                tool.close_archive(contents)
+                mock_remove.assert_called_with(contents.filename)
+
+        @mock.patch.object(JarEarWarRar, 'open_nested_archive')
+        @mock.patch.object(JarEarWarRar, 'open_archive')
+        def test_open_archive_path(self, mock_open, mock_open_nested):
+            """Testing opening the innermost archive of a path"""
+            tool = JarEarWarRar()
+            nested = tool.open_archive_path(['bar.ear', 'foo.war',
+                                             'baz.jar'])
+            mock_open.assert_called_with('bar.ear')
+            calls = [mock.call(mock_open.return_value, 'foo.war', 0),
+                     mock.call(mock_open_nested.return_value, 'baz.jar', 1)]
+            mock_open_nested.assert_has_calls(calls)
+            self.assertEqual(nested, mock_open_nested.return_value)
+            self.assertTrue(mock_open.return_value.close.called)
+
+            # Single archive is opened as is
+            tool.open_archive_path(['bar.ear'])
+            mock_open.assert_called_with('bar.ear')
+
+            # Shared archives are opened once and left open
+            mock_open.reset_mock()
+            mock_open_nested.reset_mock()
+            opened = {}
+            tool.open_archive_path(['bar.ear', 'foo.war', 'baz.jar'], opened)
+            tool.open_archive_path(['bar.ear', 'foo.war', 'qux.jar'], opened)
+            self.assertEqual(mock_open.call_count, 1)
+            calls = [mock.call(mock_open.return_value, 'foo.war', 'shared1'),
+                     mock.call(mock_open_nested.return_value, 'baz.jar',
+                               'shared2'),
+                     mock.call(mock_open_nested.return_value, 'qux.jar',
+                               'shared3')]
+            self.assertEqual(mock_open_nested.call_args_list, calls)
+            self.assertEqual(sorted(opened),
+                             [('bar.ear',), ('bar.ear', 'foo.war'),
+                              ('bar.ear', 'foo.war', 'baz.jar'),
+                              ('bar.ear', 'foo.war', 'qux.jar')])
+            self.assertFalse(mock_open.return_value.close.called)
+
+        @mock.patch.object(JarEarWarRar, 'console_out', return_value=True)
+        def test_return_entry(self, mock_out):
+            """Testing writing file from archive to destination dir"""
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, 'w') as contents:
+                contents.writestr('lib{0}baz.properties'.format(os.sep),
+                                  'foo=bar')
+            contents = zipfile.ZipFile(archive, 'r')
+            tool = JarEarWarRar()
+            tool.verbosity = True
+            tool.destination_dir = '{0}foo'.format(os.sep)
+            mock_file = mock.mock_open()
+            with mock.patch('__builtin__.open', mock_file):
+                tool.return_entry(contents,
+                                  'lib{0}baz.properties'.format(os.sep))
+            mock_file.assert_called_with('{0}foo{0}baz.properties'
+                                         .format(os.sep), 'wb')
+            mock_file.return_value.write.assert_called_with('foo=bar')
+            self.assertRaises(IOError, tool.return_entry, contents,
+                              'lib{0}foo.properties'.format(os.sep))
+            # Streaming to stdout
+            tool.destination_dir = '-'
+            stdout = io.BytesIO()
+            with mock.patch.object(sys, 'stdout', stdout):
+                tool.return_entry(contents,
+                                  'lib{0}baz.properties'.format(os.sep))
+            self.assertEqual(stdout.getvalue(), b'foo=bar')
+
+        @mock.patch('os.stat')
         @mock.patch.object(JarEarWarRar, 'console_out',
                            return_value=True)
         @mock.patch('jewr.zipfile.ZipFile')
-        def test_extract_filelist(self, mock_zipfile, mock_console_out):
+        def test_extract_filelist(self, mock_zipfile, mock_console_out,
+                                  mock_stat):
             """Test listing files from an archive"""
+            mock_stat.return_value.st_size = 0
             java_archive_path = "{0}tmp{0}2{0}foo.jar".format(os.sep)
             tool = JarEarWarRar()
             tool.verbosity = True
@@ -647,6 +4562,8 @@ def test(test_name=None):
             # Filelist empty
             self.assertRaises(IOError, tool.extract_filelist,
                               java_archive_path, "NOTFOUND")
+            # The archive is opened once
+            self.assertEqual(mock_zipfile.call_count, 1)
 
         # pylint: disable=unused-argument
         @mock.patch.object(JarEarWarRar, 'extract_filelist',
@@ -654,28 +4571,17 @@ def test(test_name=None):
                                          .format(os.sep),
                                          "META-INF{0}ejb.xml".format(os.sep)])
         @mock.patch.object(JarEarWarRar, 'console_out', return_value=True)
-        @mock.patch.object(JarEarWarRar, 'return_file', return_value=True)
-        @mock.patch.object(JarEarWarRar, 'extract_file', return_value=True)
-        @mock.patch.object(JarEarWarRar, 'clean_tmp_dir', return_value=True)
-        def test_process_filelist(self, mock_clean_tmp,
-                                  mock_extract, mock_return_file,
-                                  mock_out, mock_extract_filelist):
+        @mock.patch.object(JarEarWarRar, 'open_archive_path')
+        def test_process_filelist(self, mock_open_path, mock_out,
+                                  mock_extract_filelist):
             """Testing file processing and call order"""
             # Sunshine path with many elements
             path = 'bar.ear{0}foo.war{0}META-INF{0}lib{0}\
                 baz.jar{0}/META-INF'.format(os.sep)
-            temp = '{0}dev{0}shm{0}tempdir'.format(os.sep)
-            dest_dir = '{0}foo'.format(os.sep)
             rpfilter = 'META-INF'
-            os.mkdir = mock.MagicMock(return_value=True)
-            os.access = mock.MagicMock(return_value=True)
-            shutil.move = mock.MagicMock(return_value=True)
-            tempfile.mkdtemp = mock.MagicMock(return_value=temp)
 
             tool = JarEarWarRar()
             tool.verbosity = True
-            tool.set_temp_dir(temp)
-            tool.set_destination_dir(dest_dir)
             with mock.patch.object(JarEarWarRar, 'parse_java_path',
                                    return_value=['bar.ear', 'foo.war',
                                                  'META-INF{0}lib{0}baz.jar'
@@ -683,45 +4589,29 @@ def test(test_name=None):
                                                  'META-INF']) as mock_parse:
                 tool.process_filelist(path)
                 self.assertEquals(mock_parse.called, True)
-                tool.tmp_dir = temp
-                calls = [mock.call("{0}{1}0".format(temp, os.sep)),
-                         mock.call("{0}{1}1".format(temp, os.sep))]
-                # pylint: disable=maybe-no-member
-                os.mkdir.assert_has_calls(calls)
-                extracts = [mock.call("bar.ear", "foo.war", '{0}{1}0'.
-                                      format(temp, os.sep)),
-                            mock.call('{0}{1}0{1}foo.war'.
-                                      format(temp, os.sep),
-                                      'META-INF{0}lib{0}baz.jar'.
-                                      format(os.sep),
-                                      '{0}{1}1'.
-                                      format(temp, os.sep))
-                            ]
-                mock_extract.assert_has_calls(extracts)
+                mock_open_path.assert_called_with(
+                    ['bar.ear', 'foo.war',
+                     'META-INF{0}lib{0}baz.jar'.format(os.sep)], {})
                 mock_extract_filelist.assert_called_with(
-                    "{0}{1}1{1}META-INF{1}lib{1}baz.jar".format(temp, os.sep),
-                    rpfilter)
+                    mock_open_path.return_value, rpfilter)
             # Single item list
             with mock.patch.object(JarEarWarRar, 'parse_java_path',
                                    return_value=['bar.ear']):
                 path = 'bar.ear'
                 tool.process_filelist(path)
-                mock_extract_filelist.assert_called_with(path)
-            # Russian doll setup
-            with mock.patch.object(JarEarWarRar, 'parse_java_path',
-                                   return_value=['bar.ear', 'bar.war']):
-                path = 'bar.ear{0}bar.war'.format(os.sep)
-                tool.process_filelist(path)
+                mock_open_path.assert_called_with(['bar.ear'], {})
                 mock_extract_filelist.assert_called_with(
-                    "{0}{1}0{1}bar.war".format(temp, os.sep))
+                    mock_open_path.return_value)
             # Deep russian doll setup
             with mock.patch.object(JarEarWarRar, 'parse_java_path',
                                    return_value=['bar.ear', 'bar.war',
                                                  'baz.jar']):
                 path = 'bar.ear{0}bar.war{0}baz.jar'.format(os.sep)
                 tool.process_filelist(path)
+                mock_open_path.assert_called_with(['bar.ear', 'bar.war',
+                                                   'baz.jar'], {})
                 mock_extract_filelist.assert_called_with(
-                    "{0}{1}1{1}baz.jar".format(temp, os.sep))
+                    mock_open_path.return_value)
             # Single itme with filter
             with mock.patch.object(JarEarWarRar, 'parse_java_path',
                                    return_value=['bar.ear', 'META-INF']),\
@@ -729,8 +4619,146 @@ def test(test_name=None):
                                   return_value=[True, False]):
                     path = 'bar.ear{0}META-INF'.format(os.sep)
                     tool.process_filelist(path)
-                    mock_extract_filelist.assert_called_with("bar.ear",
-                                                             "META-INF")
+                    mock_open_path.assert_called_with(['bar.ear'], {})
+                    mock_extract_filelist.assert_called_with(
+                        mock_open_path.return_value, "META-INF")
+
+        @mock.patch.object(JarEarWarRar, 'refresh_served', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'process_file_extract',
+                           return_value=True)
+        @mock.patch.object(JarEarWarRar, 'process_filelist',
+                           return_value=['foo'])
+        def test_process_request(self, mock_filelist, mock_extract,
+                                 mock_refresh):
+            """Testing processing the requests of the clients"""
+            tool = JarEarWarRar()
+            tool.destination_dir = 'foo'
+            opened = {}
+            served = {}
+            path = 'bar.ear{0}foo.war'.format(os.sep)
+            with mock.patch.object(JarEarWarRar, 'resolve_java_path') \
+                    as mock_resolve:
+                self.assertEqual(tool.process_request(
+                    {'op': 'list', 'path': path}, opened, served), ['foo'])
+                # The path is resolved by the operation only
+                self.assertFalse(mock_resolve.called)
+            mock_filelist.assert_called_with(path, opened)
+            mock_refresh.assert_called_with('bar.ear', opened, served)
+            with mock.patch('os.access', return_value=True):
+                self.assertEqual(tool.process_request(
+                    {'op': 'extract', 'path': path, 'destdir': 'bar'},
+                    opened, served), [])
+            mock_extract.assert_called_with(path, opened)
+            self.assertEqual(tool.destination_dir, 'foo')
+            # Replacing closes the opened archives, with a temp dir of its own
+            tool.tmp_dir = 'baz'
+            with mock.patch('tempfile.mkdtemp', return_value='qux'), \
+                mock.patch.object(JarEarWarRar, 'clean_tmp_dir') \
+                as mock_clean, \
+                mock.patch.object(JarEarWarRar, 'process_file_append',
+                                  return_value=True) as mock_append:
+                tool.process_request({'op': 'replace', 'path': path,
+                                      'file': 'foo.war', 'append': True},
+                                     opened, served)
+                mock_append.assert_called_with(path, 'foo.war')
+                mock_clean.assert_called_with(keep_shm=True)
+            mock_refresh.assert_called_with('bar.ear', opened, served, True)
+            self.assertEqual(tool.tmp_dir, 'baz')
+            self.assertRaises(RuntimeError, tool.process_request,
+                              {'op': 'foo', 'path': path}, opened, served)
+
+        @mock.patch.object(JarEarWarRar, 'close_archive', return_value=True)
+        def test_refresh_served(self, mock_close):
+            """Testing closing the archives of changed outermost archives"""
+            tool = JarEarWarRar()
+            info = mock.MagicMock(st_dev=1, st_ino=2, st_size=3, st_mtime=4)
+            opened = {('bar.ear',): 'bar', ('bar.ear', 'foo.war'): 'foo',
+                      ('baz.ear',): 'baz'}
+            served = {}
+            with mock.patch('os.stat', return_value=info):
+                tool.refresh_served('bar.ear', opened, served)
+                self.assertEqual(len(opened), 3)
+                self.assertEqual(served, {'bar.ear': (1, 2, 3, 4)})
+                info.st_mtime = 5
+                tool.refresh_served('bar.ear', opened, served)
+            self.assertEqual(opened, {('baz.ear',): 'baz'})
+            self.assertEqual(mock_close.call_args_list,
+                             [mock.call('foo'), mock.call('bar')])
+            # Least recently served archives are closed over served_size
+            mock_close.reset_mock()
+            tool.served_size = 2
+            opened.update({('bar.ear',): 'bar', ('qux.ear',): 'qux'})
+            served = collections.OrderedDict()
+            with mock.patch('os.stat', return_value=info):
+                for filename in ('baz.ear', 'bar.ear', 'baz.ear', 'qux.ear'):
+                    tool.refresh_served(filename, opened, served)
+            self.assertEqual(list(served), ['baz.ear', 'qux.ear'])
+            self.assertEqual(sorted(opened), [('baz.ear',), ('qux.ear',)])
+            mock_close.assert_called_once_with('bar')
+
+        def test_serve_terminate(self):
+            """Testing the server cleans up when terminated"""
+            tool = JarEarWarRar()
+            contents = mock.Mock()
+            # Timed out connection does not stop the server
+            requests = [socket.timeout('timed out'), None]
+
+            def serve_connection(connection, opened, served):
+                error = requests.pop(0)
+                if error is not None:
+                    raise error
+                opened['foo'] = contents
+            with mock.patch('socket.socket') as mock_socket, \
+                    mock.patch('os.path.exists', return_value=False), \
+                    mock.patch('os.chmod'), \
+                    mock.patch('os.umask', return_value=0o022) as mock_umask, \
+                    mock.patch.object(JarEarWarRar, 'serve_connection',
+                                      side_effect=serve_connection), \
+                    mock.patch.object(JarEarWarRar, 'close_archive') \
+                    as mock_close, \
+                    mock.patch.object(JarEarWarRar, 'clean_tmp_dir') \
+                    as mock_clean:
+                server = mock_socket.return_value
+                connection = mock.Mock()
+
+                def accept():
+                    if not requests:
+                        os.kill(os.getpid(), signal.SIGTERM)
+                    return connection, None
+                server.accept.side_effect = accept
+                self.assertTrue(tool.serve('/tmp/jewr.sock'))
+                self.assertEqual(mock_umask.call_args_list,
+                                 [mock.call(0o077), mock.call(0o022)])
+                connection.settimeout.assert_called_with(60)
+                self.assertEqual(connection.close.call_count, 2)
+                mock_close.assert_called_with(contents)
+                self.assertTrue(mock_clean.called)
+                self.assertTrue(server.close.called)
+            # The previous handler is restored
+            self.assertEqual(signal.getsignal(signal.SIGTERM),
+                             signal.SIG_DFL)
+
+        @mock.patch.object(JarEarWarRar, 'process_request',
+                           side_effect=[['foo'], IOError('bar')])
+        def test_serve_connection(self, mock_request):
+            """Testing serving the requests of a connection"""
+            tool = JarEarWarRar()
+            server, client = socket.socketpair()
+            try:
+                client.sendall(b'{"op": "list", "path": "foo.jar"}\n'
+                               b'{"op": "list", "path": "bar.jar"}\n')
+                client.shutdown(socket.SHUT_WR)
+                tool.serve_connection(server, {}, {})
+                server.close()
+                responses = client.makefile('rb').read().decode('utf-8')
+            finally:
+                client.close()
+            self.assertEqual([json.loads(line) for line in
+                              responses.splitlines()],
+                             [{'status': 'ok', 'output': ['foo']},
+                              {'status': 'error', 'error': 'bar'}])
+            mock_request.assert_called_with({'op': 'list', 'path': 'bar.jar'},
+                                            {}, {})
 
         # pylint: disable=unused-argument,too-many-arguments,too-many-locals
         @mock.patch.object(JarEarWarRar, 'console_out', return_value=True)
@@ -776,15 +4804,15 @@ def test(test_name=None):
                 archive1 = "foo.war".format(os.sep)
                 target1 = temp + "{0}0".format(os.sep)
 
-                extracts = [mock.call(filename1, archive1, target1),
-                            mock.call(filename2, archive2, target2),
-                            mock.call(filename3, archive3, target3)]
+                extracts = [mock.call(filename1, archive1, target1, 0),
+                            mock.call(filename2, archive2, target2, 1),
+                            mock.call(filename3, archive3, target3, 2)]
 
                 mock_extract.assert_has_calls(extracts)
 
-                updates = [mock.call(filename3, archive3, target3),
-                           mock.call(filename2, archive2, target2),
-                           mock.call(filename1, archive1, target1)]
+                updates = [mock.call(filename3, archive3, target3, 2),
+                           mock.call(filename2, archive2, target2, 1),
+                           mock.call(filename1, archive1, target1, 0)]
 
                 mock_update_file.assert_has_calls(updates)
 
@@ -797,6 +4825,298 @@ def test(test_name=None):
                 self.assertRaises(RuntimeError, tool.process_file_update,
                                   path, 'file')
 
+        def test_fleet_targets(self):
+            """Testing expanding the target archives of fleet patching"""
+            tool = JarEarWarRar()
+            handle, listing = tempfile.mkstemp()
+            try:
+                with os.fdopen(handle, 'w') as output:
+                    output.write('b.ear\n\nc.ear\n')
+                with mock.patch('glob.glob', return_value=['c.ear', 'a.ear']):
+                    self.assertEqual(tool.fleet_targets(
+                        ['*.ear', '@' + listing, 'd.ear']),
+                                     ['a.ear', 'c.ear', 'b.ear', 'd.ear'])
+            finally:
+                os.remove(listing)
+
+        @mock.patch.object(JarEarWarRar, 'console_err', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'clean_tmp_dir', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'set_temp_dir', return_value='/tmp1')
+        @mock.patch.object(JarEarWarRar, 'process_file_update')
+        @mock.patch('multiprocessing.Pool')
+        def test_process_fleet_update(self, mock_pool, mock_update,
+                                      mock_set_temp, mock_clean, mock_err):
+            """Testing replacing the file in many archives"""
+            mock_pool.return_value.imap_unordered.side_effect = \
+                lambda update, paths: [update(path) for path in paths]
+            mock_update.side_effect = [True, RuntimeError('error: foo')]
+            tool = JarEarWarRar()
+            tool.tmp_dir = '/tmp'
+            results = []
+            with self.assertRaises(RuntimeError):
+                for line in tool.process_fleet_update(
+                        'foo.war{0}foo.xml'.format(os.sep),
+                        ['a.ear', 'b.ear'], 'bar.xml', workers=2):
+                    results.append(line)
+            mock_pool.assert_called_with(2)
+            self.assertTrue(results[0].startswith(
+                'patched a.ear{0}foo.war{0}foo.xml in'.format(os.sep)))
+            self.assertEqual(results[1], 'failed b.ear{0}foo.war{0}foo.xml: '
+                             'error: foo'.format(os.sep))
+            mock_update.assert_called_with('b.ear{0}foo.war{0}foo.xml'.format(
+                os.sep), 'bar.xml')
+            # Each archive has a temp dir of its own under the temp dir
+            mock_set_temp.assert_called_with('/tmp')
+            self.assertEqual(mock_clean.call_count, 2)
+            self.assertTrue(mock_err.call_args[0][0].startswith(
+                'Patched 1 of 2 archives'))
+
+        @mock.patch.object(JarEarWarRar, 'clean_tmp_dir', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'set_temp_dir', return_value='/tmp1')
+        def test_fleet_update(self, mock_set_temp, mock_clean):
+            """Testing a target which is not an archive fails alone"""
+            handle, target = tempfile.mkstemp(suffix='.ear')
+            try:
+                with os.fdopen(handle, 'wb') as output:
+                    output.write(b'not an archive')
+                path, error, _, size = fleet_update(
+                    target + os.sep + 'foo.war' + os.sep + 'foo.xml',
+                    'bar.xml')
+                self.assertTrue(path.startswith(target))
+                self.assertTrue(error)
+                self.assertEqual(size, 0)
+            finally:
+                os.remove(target)
+
+        @mock.patch.object(JarEarWarRar, 'clean_tmp_dir', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'set_temp_dir', return_value='/tmp1')
+        def test_async_api(self, mock_set_temp, mock_clean):
+            """Testing the operations are run by the executor"""
+            if asyncio is None:
+                self.assertRaises(RuntimeError, AsyncJarEarWarRar)
+                return
+            loop = asyncio.new_event_loop()
+            service = AsyncJarEarWarRar(2, '/tmp', loop=loop)
+            try:
+                with mock.patch.object(JarEarWarRar, 'process_filelist',
+                                       return_value=['foo.txt']), \
+                        mock.patch.object(JarEarWarRar, 'process_file_update',
+                                          return_value=True) as mock_update:
+                    self.assertEqual(loop.run_until_complete(asyncio.gather(
+                        service.filelist('foo.jar'),
+                        service.update('foo.jar{0}foo.txt'.format(os.sep),
+                                       'bar.txt'))), [['foo.txt'], True])
+                    mock_update.assert_called_with(
+                        'foo.jar{0}foo.txt'.format(os.sep), 'bar.txt')
+                mock_set_temp.assert_called_with('/tmp')
+                self.assertEqual(mock_clean.call_count, 2)
+                with mock.patch.object(JarEarWarRar, 'process_file_extract',
+                                       side_effect=IOError):
+                    self.assertRaises(IOError, loop.run_until_complete,
+                                      service.extract('foo.jar{0}foo.txt'
+                                                      .format(os.sep)))
+            finally:
+                service.close()
+                loop.close()
+
+        def test_read_batch(self):
+            """Testing reading batch operations"""
+            tool = JarEarWarRar()
+            batch = ["# Comment line\n",
+                     "list bar.ear{0}foo.war\n".format(os.sep),
+                     "\n",
+                     "extract bar.ear{0}baz.txt\n".format(os.sep),
+                     "extract 'bar.ear{0}foo bar.txt' {0}tmp\n"
+                     .format(os.sep),
+                     "replace bar.ear{0}baz.txt new.txt # new\n"
+                     .format(os.sep)]
+            self.assertEqual(tool.read_batch(batch),
+                             [('list', 'bar.ear{0}foo.war'.format(os.sep),
+                               None),
+                              ('extract', 'bar.ear{0}baz.txt'.format(os.sep),
+                               None),
+                              ('extract', 'bar.ear{0}foo bar.txt'
+                               .format(os.sep), '{0}tmp'.format(os.sep)),
+                              ('replace', 'bar.ear{0}baz.txt'.format(os.sep),
+                               'new.txt')])
+            self.assertRaises(RuntimeError, tool.read_batch, ["remove foo"])
+            self.assertRaises(RuntimeError, tool.read_batch,
+                              ["replace bar.ear{0}baz.txt".format(os.sep)])
+
+        # pylint: disable=unused-argument,too-many-arguments
+        @mock.patch.object(JarEarWarRar, 'console_out', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'process_batch_update',
+                           return_value=True)
+        @mock.patch.object(JarEarWarRar, 'process_file_extract',
+                           return_value=True)
+        @mock.patch.object(JarEarWarRar, 'process_filelist',
+                           return_value=['baz.txt'])
+        def test_process_batch(self, mock_filelist, mock_extract,
+                               mock_batch_update, mock_out):
+            """Testing batch processing shares the opened archives"""
+            os.access = mock.MagicMock(return_value=True)
+            tool = JarEarWarRar()
+            tool.destination_dir = '/foo'
+            tool.process_batch([('replace', 'bar.ear/baz.txt', 'new.txt'),
+                                ('list', 'bar.ear', None),
+                                ('extract', 'bar.ear/baz.txt', '/bar'),
+                                ('replace', 'bar.ear/qux.txt', 'qux.txt')],
+                               True)
+            opened = mock_filelist.call_args[0][1]
+            mock_filelist.assert_called_with('bar.ear', opened)
+            mock_extract.assert_called_with('bar.ear/baz.txt', opened)
+            mock_out.assert_called_with('baz.txt')
+            mock_batch_update.assert_called_with(
+                [('bar.ear/baz.txt', 'new.txt'),
+                 ('bar.ear/qux.txt', 'qux.txt')], True, opened)
+            self.assertEqual(tool.destination_dir, '/foo')
+
+            # No replacements
+            mock_batch_update.reset_mock()
+            tool.process_batch([('list', 'bar.ear', None)])
+            self.assertFalse(mock_batch_update.called)
+
+        # pylint: disable=unused-argument,too-many-arguments
+        @mock.patch.object(JarEarWarRar, 'console_out', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'get_file_info', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'open_archive')
+        @mock.patch.object(JarEarWarRar, 'append_archive', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'repack_archive', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'extract_file', return_value=True)
+        def test_process_batch_update(self, mock_extract, mock_repack,
+                                      mock_append, mock_open, mock_info,
+                                      mock_out):
+            """Testing batch replacements are repacked once per archive"""
+            temp = '{0}tempdir'.format(os.sep)
+            tool = JarEarWarRar()
+            tool.verbosity = True
+            tool.tmp_dir = temp
+            tool.process_batch_update(
+                [('bar.ear{0}foo.war{0}a.txt'.format(os.sep), 'new_a'),
+                 ('bar.ear{0}foo.war{0}lib{0}baz.jar{0}b.txt'
+                  .format(os.sep), 'new_b'),
+                 ('bar.ear{0}foo.war{0}c.txt'.format(os.sep), 'new_c'),
+                 ('bar.ear{0}d.txt'.format(os.sep), 'new_d')])
+            war = '{0}{1}batch1{1}foo.war'.format(temp, os.sep)
+            jar = '{0}{1}batch2{1}lib{1}baz.jar'.format(temp, os.sep)
+            extracts = [mock.call('bar.ear', 'foo.war',
+                                  '{0}{1}batch1'.format(temp, os.sep), 0),
+                        mock.call(war, 'lib{0}baz.jar'.format(os.sep),
+                                  '{0}{1}batch2'.format(temp, os.sep), 1)]
+            self.assertEqual(mock_extract.call_args_list, extracts)
+            repacks = [mock.call(jar, {'b.txt': 'new_b'}),
+                       mock.call(war, {'a.txt': 'new_a', 'c.txt': 'new_c',
+                                       'lib{0}baz.jar'.format(os.sep): jar}),
+                       mock.call('bar.ear', {'d.txt': 'new_d',
+                                             'foo.war': war})]
+            self.assertEqual(mock_repack.call_args_list, repacks)
+            self.assertEqual(mock_info.call_count, 4)
+
+            # Missing file fails the batch before any archive is written
+            mock_repack.reset_mock()
+
+            def file_info(contents, archive_path):
+                if archive_path == 'nosuch.xml':
+                    raise IOError("file 'nosuch.xml' not found")
+                return True
+            mock_info.side_effect = file_info
+            self.assertRaises(IOError, tool.process_batch_update,
+                              [('qux.ear{0}foo.war{0}a.txt'.format(os.sep),
+                                'new_a'),
+                               ('bar.ear{0}nosuch.xml'.format(os.sep),
+                                'new_d')])
+            self.assertFalse(mock_repack.called)
+            mock_info.side_effect = None
+
+            # Outermost archive is appended to
+            mock_repack.reset_mock()
+            tool.process_batch_update([('bar.ear{0}d.txt'.format(os.sep),
+                                        'new_d')], True)
+            mock_append.assert_called_with('bar.ear', {'d.txt': 'new_d'})
+            self.assertFalse(mock_repack.called)
+
+            # No file to replace
+            self.assertRaises(RuntimeError, tool.process_batch_update,
+                              [('bar.ear', 'new_d')])
+
+        # pylint: disable=unused-argument
+        @mock.patch.object(JarEarWarRar, 'console_out', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'update_file', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'append_file', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'prepare_file_update',
+                           return_value=['bar.ear', 'foo.war',
+                                         'baz.properties'])
+        def test_process_file_append(self, mock_prepare, mock_append_file,
+                                     mock_update_file, mock_out):
+            """Testing file update by appending to outermost archive"""
+            temp = '{0}tempdir'.format(os.sep)
+            tool = JarEarWarRar()
+            tool.tmp_dir = temp
+            tool.process_file_append('bar.ear{0}foo.war{0}baz.properties'
+                                     .format(os.sep), 'baz.properties')
+            mock_prepare.assert_called_with('bar.ear{0}foo.war{0}'
+                                            'baz.properties'.format(os.sep),
+                                            'baz.properties')
+            mock_update_file.assert_called_with(
+                '{0}{1}0{1}foo.war'.format(temp, os.sep), 'baz.properties',
+                '{0}{1}1'.format(temp, os.sep), 1)
+            mock_append_file.assert_called_with(
+                'bar.ear', 'foo.war', '{0}{1}0'.format(temp, os.sep), 0)
+
+        @mock.patch.object(JarEarWarRar, 'console_out', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'append_archive', return_value=True)
+        def test_append_file(self, mock_append, mock_out):
+            """Testing file append to Java archive"""
+            tool = JarEarWarRar()
+            tool.verbosity = True
+            tool.append_file('foo.ear', 'foo' + os.sep + 'bar.jar', '/tmp')
+            mock_append.assert_called_with(
+                'foo.ear', {'foo' + os.sep + 'bar.jar': '/tmp' + os.sep +
+                            'foo' + os.sep + 'bar.jar'})
+
+        @mock.patch.object(JarEarWarRar, 'console_out', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'repack_archive', return_value=True)
+        def test_process_compact(self, mock_repack, mock_out):
+            """Testing compacting dead space out of archive"""
+            tool = JarEarWarRar()
+            tool.verbosity = True
+            with mock.patch('os.stat') as mock_stat:
+                mock_stat.return_value.st_size = 100
+                tool.process_compact('bar.ear')
+                mock_repack.assert_called_with('bar.ear', {})
+            # Nested archives are not compacted
+            self.assertRaises(RuntimeError, tool.process_compact,
+                              'bar.ear{0}foo.war'.format(os.sep))
+
+        def test_bench_archive(self):
+            """Testing generating the nested archives of the benchmark"""
+            outer = io.BytesIO()
+            names = bench_archive(outer, 4, 3, 100, zipfile.ZIP_DEFLATED)
+            self.assertEqual(names, ['bench.war',
+                                     'WEB-INF{0}lib{0}bench2.jar'
+                                     .format(os.sep),
+                                     'lib{0}bench3.jar'.format(os.sep)])
+            contents = zipfile.ZipFile(outer)
+            for name in names:
+                self.assertEqual(len(contents.namelist()), 4)
+                contents = zipfile.ZipFile(io.BytesIO(contents.read(name)))
+            self.assertEqual([len(contents.read(name)) for name in
+                              contents.namelist()], [100, 100, 100])
+            # Archives are reproducible
+            again = io.BytesIO()
+            bench_archive(again, 4, 3, 100, zipfile.ZIP_DEFLATED)
+            self.assertEqual(outer.getvalue(), again.getvalue())
+
+        def test_bench_percentiles(self):
+            """Testing the latency percentiles of the benchmark"""
+            result = bench_percentiles([0.001 * i for i in range(100, 0, -1)])
+            self.assertAlmostEqual(result['min'], 1)
+            self.assertAlmostEqual(result['p50'], 50)
+            self.assertAlmostEqual(result['p90'], 90)
+            self.assertAlmostEqual(result['p99'], 99)
+            self.assertAlmostEqual(result['max'], 100)
+            self.assertAlmostEqual(result['mean'], 50.5)
+
         # pylint: disable=unused-argument,
         @mock.patch.object(JarEarWarRar, 'extract_file', return_value=True)
         @mock.patch.object(JarEarWarRar, 'return_file', return_value=True)
@@ -828,11 +5148,11 @@ def test(test_name=None):
             archive1 = "properties{0}baz.properties".format(os.sep)
             target1 = temp+"{0}0".format(os.sep)
 
-            extracts = [mock.call(filename1, archive1, target1)]
+            extracts = [mock.call(filename1, archive1, target1, 0)]
 
             mock_extract.assert_has_calls(extracts)
 
-            updates = [mock.call(filename1, archive1, target1)]
+            updates = [mock.call(filename1, archive1, target1, 0)]
 
             mock_update_file.assert_has_calls(updates)
 
@@ -841,32 +5161,26 @@ def test(test_name=None):
                                            archive1)
 
         # pylint: disable=unused-argument,no-self-use
-        @mock.patch.object(JarEarWarRar, 'return_file', return_value=True)
-        @mock.patch.object(JarEarWarRar, 'extract_file', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'return_entry', return_value=True)
+        @mock.patch.object(JarEarWarRar, 'open_archive')
         @mock.patch.object(JarEarWarRar, 'clean_tmp_dir', return_value=True)
         @mock.patch.object(JarEarWarRar, 'parse_java_path',
                            return_value=['baz.jar', 'baz.properties'])
         def test_process_file_ext_2_files(self, mock_parse, mock_clean_tmp,
-                                          mock_extract, mock_return_file):
+                                          mock_open, mock_return_entry):
             """Testing file processing with exception of single file"""
 
             # Special case of two elements
             path = 'baz.jar' + os.sep + 'baz.properties'
-            temp = '/dev/shm/tempdir'
-            target = temp+'/0'
             dest_dir = '/foo'
-            shutil.move = mock.MagicMock(return_value=True)
-            os.mkdir = mock.MagicMock(return_value=True)
             os.access = mock.MagicMock(return_value=True)
             tool = JarEarWarRar()
-            tool.set_temp_dir(temp)
             tool.set_destination_dir(dest_dir)
 
             tool.process_file_extract(path)
-            extracts = [mock.call("baz.jar", "baz.properties", target)]
-            mock_extract.assert_has_calls(extracts)
-            mock_return_file.assert_called_with(target + os.sep +
-                                                'baz.properties')
+            mock_open.assert_called_with("baz.jar")
+            mock_return_entry.assert_called_with(mock_open.return_value,
+                                                 'baz.properties')
 
         @mock.patch.object(JarEarWarRar, 'set_jar_path',
                            return_value=True)
@@ -896,6 +5210,192 @@ def test(test_name=None):
                 self.assertEquals(mock_set_temp.called, True)
                 self.assertEquals(mock_dest_dir.called, True)
                 self.assertEquals(mock_process_u.called, True)
+                # Jar command is opt-in
+                self.assertEquals(mock_set_jp.called, False)
+
+            with mock.patch.object(sys, 'argv', ['app.py',
+                                                 'foo.jar/foo.properties',
+                                                 '--use-jar', '--replace',
+                                                 'bar']):
+                main()
+                mock_set_jp.assert_called_with(None)
+
+            with mock.patch.object(sys, 'argv', ['app.py',
+                                                 'foo.jar/foo.properties',
+                                                 '--replace', 'bar', '-a']), \
+                mock.patch.object(JarEarWarRar, 'process_file_append',
+                                  return_value=True) as mock_append:
+                main()
+                mock_append.assert_called_with('foo.jar/foo.properties',
+                                               'bar')
+
+            with mock.patch.object(sys, 'argv', ['app.py',
+                                                 'foo.jar/foo.properties',
+                                                 '--replace', 'bar',
+                                                 '--level', '1', '--store',
+                                                 '--keep-method']), \
+                mock.patch.object(JarEarWarRar, 'set_cache_dir',
+                                  return_value=True), \
+                mock.patch.object(JarEarWarRar, 'close',
+                                  autospec=True) as mock_close:
+                main()
+                policy = mock_close.call_args[0][0].compression_policy()
+                self.assertEqual(policy, {'compress_level': 1,
+                                          'store_compressed': True,
+                                          'keep_method': True})
+
+            with mock.patch.object(sys, 'argv', ['app.py', 'foo.jar',
+                                                 '-lR']), \
+                mock.patch.object(JarEarWarRar, 'console_out',
+                                  return_value=True) as mock_out, \
+                mock.patch.object(JarEarWarRar, 'process_filelist_recursive',
+                                  return_value=iter(['a.jar/b']))\
+                    as mock_recursive:
+                main()
+                mock_recursive.assert_called_with('foo.jar')
+                mock_out.assert_called_with('a.jar/b')
+
+            with mock.patch.object(sys, 'argv', ['app.py',
+                                                 'foo.jar/foo.properties',
+                                                 '--memory-budget', '512M']), \
+                mock.patch.object(JarEarWarRar, 'close',
+                                  autospec=True) as mock_close:
+                main()
+                self.assertEqual(mock_close.call_args[0][0].memory_budget,
+                                 512 * 1024 * 1024)
+
+            with mock.patch.object(sys, 'argv', ['app.py', '--batch', '-']), \
+                mock.patch.object(sys, 'stdin', ['list foo.jar']), \
+                mock.patch.object(JarEarWarRar, 'process_batch',
+                                  return_value=True) as mock_batch:
+                main()
+                mock_batch.assert_called_with([('list', 'foo.jar', None)],
+                                              False)
+
+            with mock.patch.object(sys, 'argv', ['app.py', 'foo.jar',
+                                                 '--compact']), \
+                mock.patch.object(JarEarWarRar, 'process_compact',
+                                  return_value=True) as mock_compact:
+                main()
+                mock_compact.assert_called_with('foo.jar')
+
+            with mock.patch.object(sys, 'argv', ['app.py', 'foo.jar',
+                                                 '-g', '*.xml', '-w', '2']), \
+                mock.patch.object(JarEarWarRar, 'process_pattern_extract',
+                                  return_value=True) as mock_pattern:
+                main()
+                mock_pattern.assert_called_with('foo.jar', '*.xml', False, 2)
+
+            with mock.patch.object(sys, 'argv', ['app.py', 'foo.jar/foo.txt',
+                                                 '--stats', '--trace',
+                                                 'foo.json']), \
+                mock.patch.object(JarEarWarRar, 'stats_summary',
+                                  return_value=['stats']), \
+                mock.patch.object(JarEarWarRar, 'console_err',
+                                  return_value=True) as mock_err, \
+                mock.patch.object(JarEarWarRar, 'write_trace',
+                                  return_value=True) as mock_trace:
+                main()
+                mock_err.assert_called_with('stats')
+                mock_trace.assert_called_with('foo.json')
+
+            with mock.patch.object(sys, 'argv', ['app.py', 'foo.ear',
+                                                 '--verify', '--hash',
+                                                 'sha256']), \
+                mock.patch.object(JarEarWarRar, 'console_out',
+                                  return_value=True) as mock_out, \
+                mock.patch.object(JarEarWarRar, 'process_verify',
+                                  return_value=['0123  foo.txt']) \
+                    as mock_verify:
+                main()
+                mock_verify.assert_called_with('foo.ear', 'sha256', None)
+                mock_out.assert_called_with('0123  foo.txt')
+
+            with mock.patch.object(sys, 'argv', ['app.py', 'foo.xml', '-r',
+                                                 'bar.xml', '--fleet',
+                                                 'a.ear', 'b.ear']), \
+                mock.patch.object(JarEarWarRar, 'console_out',
+                                  return_value=True) as mock_out, \
+                mock.patch.object(JarEarWarRar, 'process_fleet_update',
+                                  return_value=['patched a.ear']) \
+                    as mock_fleet:
+                main()
+                mock_fleet.assert_called_with('foo.xml', ['a.ear', 'b.ear'],
+                                              'bar.xml', False, None)
+                mock_out.assert_called_with('patched a.ear')
+
+            with mock.patch.object(sys, 'argv', ['app.py', '--index',
+                                                 'foo.db', '--lookup',
+                                                 'org.foo.Bar']), \
+                mock.patch.object(JarEarWarRar, 'console_out',
+                                  return_value=True) as mock_out, \
+                mock.patch.object(JarEarWarRar, 'process_lookup',
+                                  return_value=['foo.jar']) as mock_lookup:
+                main()
+                mock_lookup.assert_called_with('foo.db', 'org.foo.Bar')
+                mock_out.assert_called_with('foo.jar')
+
+            with mock.patch.object(sys, 'argv', ['app.py', 'foo.jar', '-l',
+                                                 '-d', '-']), \
+                mock.patch.object(JarEarWarRar, 'process_filelist',
+                                  return_value=['foo.txt']), \
+                mock.patch.object(JarEarWarRar, 'set_destination_dir',
+                                  return_value=True) as mock_dest:
+                main()
+                # Listing is written to stdout
+                mock_dest.assert_called_with(None)
+
+            with mock.patch.object(sys, 'argv', ['app.py', 'foo.jar/foo.txt',
+                                                 '--connect', '/tmp/sock',
+                                                 '-d', '-']), \
+                mock.patch('sys.stderr', io.BytesIO() if str is bytes else
+                           io.StringIO()), \
+                mock.patch.object(JarEarWarRar, 'request_server') \
+                    as mock_request:
+                with self.assertRaises(SystemExit) as exit_info:
+                    main()
+                self.assertEqual(exit_info.exception.code, 2)
+                self.assertFalse(mock_request.called)
+
+            # Usage error exits with status 2, before the processing
+            with mock.patch.object(sys, 'argv', ['app.py', '--lookup',
+                                                 'org.foo.Bar']), \
+                mock.patch('sys.stderr', io.BytesIO() if str is bytes else
+                           io.StringIO()), \
+                mock.patch.object(JarEarWarRar, 'console_err',
+                                  return_value=True) as mock_err:
+                with self.assertRaises(SystemExit) as exit_info:
+                    main()
+                self.assertEqual(exit_info.exception.code, 2)
+                self.assertFalse(mock_err.called)
+
+            with mock.patch.object(sys, 'argv', ['app.py', '--diff',
+                                                 'foo.ear', 'bar.ear']), \
+                mock.patch.object(JarEarWarRar, 'console_out',
+                                  return_value=True) as mock_out, \
+                mock.patch.object(JarEarWarRar, 'process_diff',
+                                  return_value=['M foo.txt']) as mock_diff:
+                main()
+                mock_diff.assert_called_with('foo.ear', 'bar.ear')
+                mock_out.assert_called_with('M foo.txt')
+
+            with mock.patch.object(sys, 'argv', ['app.py', '--serve',
+                                                 'foo.sock']), \
+                mock.patch.object(JarEarWarRar, 'serve',
+                                  return_value=True) as mock_serve:
+                main()
+                mock_serve.assert_called_with('foo.sock')
+
+            with mock.patch.object(sys, 'argv', ['app.py', 'foo.jar', '-l',
+                                                 '--connect', 'foo.sock']), \
+                mock.patch.object(JarEarWarRar, 'console_out',
+                                  return_value=True) as mock_out, \
+                mock.patch.object(JarEarWarRar, 'request_server',
+                                  return_value=['file']) as mock_request:
+                main()
+                mock_request.assert_called_with('foo.sock', {
+                    'op': 'list', 'path': os.path.abspath('foo.jar')})
+                mock_out.assert_called_with('file')
 
             with mock.patch.object(sys, 'argv', ['app.py',
                                                  'foo.jar/foo.properties',
@@ -947,9 +5447,209 @@ def test(test_name=None):
         unittest.TextTestRunner(verbosity=2).run(suite)
 
 
+#
+# Hidden benchmark suite
+# Generates the nested archives and measures the operations end to end
+#
+def bench_archive(fileobj, depth, entries, size, compression):
+    """Write a synthetic archive of depth nested levels (ear, war, jars) to
+    fileobj, each level has the entries of the given size. Returns the names
+    of the nested archives of the path to the innermost level"""
+    names = ['bench.war', 'WEB-INF' + os.sep + 'lib' + os.sep + 'bench2.jar']
+    names = (names + ['lib' + os.sep + 'bench' + str(level) + '.jar' for
+                      level in range(3, depth)])[:depth - 1]
+    words = [b'class', b'public', b'static', b'void', b'import', b'java',
+             b'return', b'final', b'string', b'\n']
+    data = None
+    for level in range(depth - 1, -1, -1):
+        # Reproducible (on any Python version), partly compressible contents
+        rand = random.Random(level)
+        chunk = b' '.join([words[int(rand.random() * len(words))] for _ in
+                           range(16384)])
+        output = io.BytesIO() if level else fileobj
+        with zipfile.ZipFile(output, 'w', compression, True) as archive:
+            for i in range(entries):
+                zinfo = zipfile.ZipInfo('data' + os.sep + 'entry' + str(i) +
+                                        '.txt', (1980, 1, 1, 0, 0, 0))
+                zinfo.compress_type = compression
+                offset = int(rand.random() * len(chunk))
+                archive.writestr(zinfo, ((chunk[offset:] + chunk) *
+                                         (size // len(chunk) + 1))[:size])
+            if data is not None:
+                zinfo = zipfile.ZipInfo(names[level], (1980, 1, 1, 0, 0, 0))
+                zinfo.compress_type = compression
+                archive.writestr(zinfo, data)
+        if level:
+            data = output.getvalue()
+    return names
+
+
+def bench_percentiles(samples):
+    """Latency percentiles (nearest rank) of the samples in milliseconds"""
+    samples = sorted(samples)
+    result = {'min': samples[0] * 1000, 'max': samples[-1] * 1000,
+              'mean': sum(samples) / len(samples) * 1000}
+    for percentile in (50, 90, 99):
+        rank = max(int(math.ceil(percentile / 100.0 * len(samples))), 1)
+        result['p' + str(percentile)] = samples[rank - 1] * 1000
+    return result
+
+
+def bench_peak_rss():
+    """Peak resident set size of the process in bytes (None if unknown)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on linux, bytes on mac
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def bench_isolated(case):
+    """Run the benchmark case (returning a JSON serializable dict) in a
+    forked process, so that the peak RSS is the one of the case and not of
+    the earlier cases. Without fork the case is run in this process and the
+    peak RSS is not known"""
+    if not hasattr(os, 'fork'):
+        result = case()
+        result['peak_rss'] = None
+        return result
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_fd)
+            result = case()
+            result['peak_rss'] = bench_peak_rss()
+            with os.fdopen(write_fd, 'w') as pipe:
+                json.dump(result, pipe)
+            status = 0
+        # pylint: disable=broad-except
+        except BaseException as ex:
+            print("error:", ex, file=sys.stderr)
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        data = pipe.read()
+    _, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError("error: benchmark case failed")
+    return json.loads(data)
+
+
+def benchmark(argv):
+    """Run the benchmark suite with the command line arguments"""
+    parser = argparse.ArgumentParser(prog='jewr.py --bench',
+                                     description='Benchmark the list, \
+                                     extract and update operations of a \
+                                     synthetic nested archive')
+    parser.add_argument('--depth', type=int, default=3, help="Number of \
+                        nested archive levels")
+    parser.add_argument('--entries', type=int, default=100, help="Number of \
+                        files on each level")
+    parser.add_argument('--size', type=int, default=4096, help="Size of the \
+                        files in bytes")
+    parser.add_argument('--stored', default=False, action='store_true',
+                        help="Store the files and archives uncompressed")
+    parser.add_argument('--rounds', type=int, default=10, help="Number of \
+                        rounds of each operation")
+    parser.add_argument('-t', '--tempdir', default=None, help="Temporary \
+                        directory to use")
+    parser.add_argument('-o', '--output', default=None, help="File to write \
+                        the results to as JSON (defaults to stdout)")
+    parser.add_argument('--compare', default=None, help="Results of an \
+                        earlier run to compare with, the ratios of the \
+                        median latencies are written to stderr")
+    args = parser.parse_args(argv)
+    if args.depth < 1:
+        parser.error("--depth must be at least 1")
+    timer = getattr(time, 'perf_counter', time.time)
+    work_dir = tempfile.mkdtemp(prefix='jewrbench')
+    try:
+        archive_file = work_dir + os.sep + 'bench.ear'
+        with open(archive_file, 'wb') as output:
+            names = bench_archive(output, args.depth, args.entries, args.size,
+                                  zipfile.ZIP_STORED if args.stored else
+                                  zipfile.ZIP_DEFLATED)
+        nested_path = os.sep.join([archive_file] + names)
+        target = nested_path + os.sep + 'data' + os.sep + 'entry0.txt'
+        replacement = work_dir + os.sep + 'entry0.txt'
+        with open(replacement, 'wb') as output:
+            output.write(b'replaced\n' * (args.size // 9 + 1))
+        operations = [
+            ('list', lambda tool: tool.process_filelist(nested_path)),
+            ('extract', lambda tool: tool.process_file_extract(target)),
+            ('update', lambda tool: tool.process_file_update(target,
+                                                             replacement))]
+
+        def case(run):
+            """Rounds of the operation, with the most bytes written (to the
+            temp dir, the repacked archives and the returned file)"""
+            samples = []
+            bytes_written = 0
+            for _ in range(args.rounds):
+                # Each round starts cold, like a run from the command line
+                tool = JarEarWarRar()
+                tool.stats = []
+                tool.set_destination_dir(work_dir)
+                tool.set_temp_dir(args.tempdir)
+                try:
+                    start = timer()
+                    run(tool)
+                    samples.append(timer() - start)
+                finally:
+                    tool.close()
+                    tool.clean_tmp_dir()
+                bytes_written = max(bytes_written, sum(
+                    record['bytes_written'] for record in tool.stats))
+            result = bench_percentiles(samples)
+            result['bytes_written'] = bytes_written
+            return result
+
+        results = {}
+        for operation, run in operations:
+            results[operation] = bench_isolated(functools.partial(case, run))
+        report = {'python': sys.version.split()[0], 'platform': sys.platform,
+                  'parameters': {'depth': args.depth, 'entries': args.entries,
+                                 'size': args.size, 'stored': args.stored,
+                                 'rounds': args.rounds},
+                  'archive_bytes': os.path.getsize(archive_file),
+                  'results': results}
+    finally:
+        shutil.rmtree(work_dir)
+    if args.output is None:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if args.compare is not None:
+        with open(args.compare) as earlier:
+            earlier = json.load(earlier)
+        for operation in sorted(results):
+            if operation in earlier['results']:
+                print(operation, 'p50 ratio %.3f' % (
+                    results[operation]['p50'] /
+                    earlier['results'][operation]['p50']), file=sys.stderr)
+    return 0
+
+
 #
 # Initial entry point.
 #
+def byte_size(value):
+    """Size in bytes of the argument, with an optional K, M or G suffix"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    try:
+        if value[-1:].upper() in units:
+            return int(float(value[:-1]) * units[value[-1].upper()])
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: " + value)
+
+
 def main():
     """Main entry point"""
     # Hidden argument, --test launches internal testing sequence
@@ -969,6 +5669,10 @@ def main():
             test()
         return 0
 
+    # Hidden argument, --bench runs the benchmark suite (see --bench -h)
+    if len(sys.argv) > 1 and sys.argv[1] == "--bench":
+        return benchmark(sys.argv[2:])
+
     parser = argparse.ArgumentParser(description='Tool to manage Java archive \
                                      types (jar, rar, ear, war). \
                                      Copyright (C) 2014  Harri Savolainen. \
@@ -977,7 +5681,8 @@ def main():
                                      are welcome to redistribute it under \
                                      certain conditions. See GPL3v licence \
                                      for more information.')
-    parser.add_argument('path', metavar='java_pgk_paths', help="Archive path \
+    parser.add_argument('path', metavar='java_pgk_paths', nargs='?',
+                        help="Archive path \
                         including filenames as single path, i.e. " +
                         "example.ear{0}example.war".format(os.sep) +
                         "{0}lib{0}example.jar{0}".format(os.sep) +
@@ -988,40 +5693,227 @@ def main():
                         "META-INF")
     parser.add_argument('-d', '--destdir', default=None, help="Target director\
                         to extract the file (defaults to current working dir \
-                        [.])")
+                        [.]), '-' writes the file to stdout")
     parser.add_argument('-t', '--tempdir', default=None, help="Temporary \
                         directory to use (defaults to system temp or /dev/shm \
                         if available)")
+    parser.add_argument('--memory-budget', default=None, type=byte_size,
+                        metavar='SIZE', help="Memory for the nested archives \
+                        read in memory or extracted to /dev/shm (e.g. 512M), \
+                        the nested archives not fitting in it are extracted \
+                        to the temp dir on disk")
     parser.add_argument('-j', '--jarpath', default=None, help="Path to jar\
-                        command, which is required for repacking archives. \
-                        Defaults to /usr/bin/jar. Honors also JEWR_JAVA_HOME \
-                        or secondarily JAVA_HOME environment variables which \
-                        also can used to set the path.")
+                        command, which is used for repacking archives instead \
+                        of the built-in archive writer when set (implies \
+                        --use-jar).")
+    parser.add_argument('--use-jar', default=False, help="Repack archives \
+                        with the jar command. Defaults to /usr/bin/jar. \
+                        Honors also JEWR_JAVA_HOME or secondarily JAVA_HOME \
+                        environment variables which also can used to set the \
+                        path.", action='store_true')
     parser.add_argument('-r', '--replace', default=None, help="File name with \
                         path when replacing the file inside the archieve \
                         structure")
+    parser.add_argument('-a', '--append', default=False, help="Replace the \
+                        file by appending it to the end of the outermost \
+                        archive, the old file is left as dead space (see \
+                        --compact)", action='store_true')
+    parser.add_argument('--level', default=None, type=int,
+                        choices=range(10), metavar='LEVEL', help="Deflate \
+                        level (0-9) of the files written to the archives \
+                        when repacking, 0 stores them (fastest)")
+    parser.add_argument('--store', default=False, help="Store the nested \
+                        archives and the already compressed files (.gz, \
+                        .png, ...) written to the archives uncompressed",
+                        action='store_true')
+    parser.add_argument('--keep-method', default=False, help="Write the \
+                        replaced files with the compression method of the \
+                        files they replace", action='store_true')
+    parser.add_argument('--fleet', default=None, nargs='+',
+                        metavar='TARGET', help="Replace the file of the \
+                        nested path in each of the target archives (paths, \
+                        glob patterns or @files listing the archives) in \
+                        parallel, with --replace")
+    parser.add_argument('--compact', default=False, help="Compact the dead \
+                        space out of the archive", action='store_true')
+    parser.add_argument('-b', '--batch', default=None, help="File of \
+                        operations to process, one per line: 'list PATH', \
+                        'extract PATH [DESTDIR]' or 'replace PATH FILE' \
+                        ('-' reads standard input). Replacements are made \
+                        after listing and extracting.")
+    parser.add_argument('-g', '--glob', default=None, help="Extract all of \
+                        the files matching the glob pattern from the archive \
+                        and its nested archives, e.g. '*.properties' or \
+                        '**/META-INF/*.xml' (with --grep, search only the \
+                        matching files)")
+    parser.add_argument('-e', '--regex', default=None, help="Extract all of \
+                        the files with the nested path matching the regular \
+                        expression (with --grep, search only the matching \
+                        files)")
+    parser.add_argument('-w', '--workers', default=None, type=int,
+                        help="Number of worker threads for extracting with \
+                        pattern, searching and compressing the big files \
+                        when repacking, worker processes for verifying and \
+                        fleet patching (defaults to number of CPUs)")
+    parser.add_argument('--grep', default=None, metavar='PATTERN',
+                        help="Search the files of the archive and its nested \
+                        archives for the regular expression, the matches are \
+                        written as 'nested path:byte offset:match'")
+    parser.add_argument('--binary', default=False, help="Search also the \
+                        binary files (e.g. classes) with --grep",
+                        action='store_true')
+    parser.add_argument('--diff', default=None, nargs=2, metavar=('A', 'B'),
+                        help="List the files added (A), deleted (D) and \
+                        modified (M) in archive B compared to archive A, \
+                        including the files of their nested archives")
+    parser.add_argument('--verify', default=False, help="Verify the CRC-32s \
+                        of all of the files of the archive and its nested \
+                        archives, the throughput is written to stderr",
+                        action='store_true')
+    parser.add_argument('--hash', default=None, metavar='ALGORITHM',
+                        help="Write the manifest of the digests of the files \
+                        ('digest  nested path') with --verify, e.g. sha256")
+    parser.add_argument('--index', default=None, metavar='DB',
+                        help="Index the files and classes of the archive and \
+                        its nested archives to the SQLite file, only the \
+                        changed archives are indexed again")
+    parser.add_argument('--lookup', default=None, metavar='NAME',
+                        help="Find the files by class name (e.g. \
+                        org.foo.Bar), name or base name from the index of \
+                        --index")
+    parser.add_argument('--serve', default=None, metavar='SOCKET',
+                        help="Serve the list, extract and replace requests \
+                        of the clients from the unix socket, keeping the \
+                        archives open between the requests")
+    parser.add_argument('--connect', default=None, metavar='SOCKET',
+                        help="Send the list, extract or replace operation to \
+                        the server of the unix socket")
     parser.add_argument('-l', '--list', default=False, help="List path files",
                         action='store_true')
+    parser.add_argument('-c', '--cache', default=False, help="Cache the \
+                        file lists of the archives for listing and the nested \
+                        archives extracted to disk. The cache dir \
+                        defaults to ~/.cache/jewr, honors also JEWR_CACHE_DIR \
+                        environment variable.", action='store_true')
+    parser.add_argument('-R', '--recursive', default=False, help="List also \
+                        the files of the nested archives, with their nested \
+                        paths", action='store_true')
+    parser.add_argument('--stats', default=False, help="Write the time and \
+                        bytes of the stages of the operation by nesting \
+                        level to stderr", action='store_true')
+    parser.add_argument('--trace', default=None, metavar='FILE',
+                        help="Write the stages of the operation to the file \
+                        as Chrome trace event JSON (chrome://tracing)")
     parser.add_argument('-v', '--verbose', default=False, help="Add verbosity",
                         action='store_true')
 
     args = parser.parse_args()
+    if args.path is None and args.batch is None and args.serve is None and \
+            args.diff is None and args.lookup is None:
+        parser.error("java_pgk_paths is required")
+    if args.lookup is not None and args.index is None:
+        parser.error("--lookup requires --index")
+    if args.connect is not None and args.destdir == '-':
+        parser.error("--connect can not write the file to stdout (-d -)")
+    # Only the extracted files are written to stdout with -d -, the other
+    # operations write their output lines there
+    extracting = args.replace is None and not args.list and \
+        args.grep is None and args.diff is None and not args.verify and \
+        args.index is None and not args.compact
 
     try:
         tool = JarEarWarRar()
         tool.verbosity = args.verbose
-        tool.set_destination_dir(args.destdir)
+        if args.stats or args.trace is not None:
+            tool.stats = []
+        tool.set_destination_dir(args.destdir if extracting else None)
+        # The batch and the server write to STDOUT only during the extracts
+        tool.stdout_data = tool.destination_dir == '-' and \
+            args.batch is None and args.serve is None
+        if args.connect is not None:
+            request = {'op': 'list', 'path': os.path.abspath(args.path)}
+            if args.replace is not None:
+                request.update(op='replace', append=args.append,
+                               file=os.path.abspath(args.replace))
+            elif not args.list:
+                request.update(op='extract', destdir=os.path.abspath(
+                    tool.destination_dir))
+            for line in tool.request_server(args.connect, request):
+                tool.console_out(line)
+            return 0
+        tool.memory_budget = args.memory_budget
         tool.set_temp_dir(args.tempdir)
+        if args.level is not None:
+            tool.compress_level = args.level
+        tool.store_compressed = args.store
+        tool.keep_method = args.keep_method
+        tool.compress_workers = args.workers
+        if args.cache:
+            tool.set_cache_dir()
+        if args.serve is not None:
+            tool.serve(args.serve)
+            return 0
+        if args.batch is not None:
+            if args.batch == '-':
+                tool.process_batch(tool.read_batch(sys.stdin), args.append)
+            else:
+                with open(args.batch) as batch:
+                    tool.process_batch(tool.read_batch(batch), args.append)
+            return 0
+        if args.index is not None and args.lookup is not None:
+            for line in tool.process_lookup(args.index, args.lookup):
+                tool.console_out(line)
+            return 0
+        if args.index is not None:
+            indexed = tool.process_index(args.path, args.index)
+            if tool.verbosity:
+                tool.console_out("Indexed archives:", indexed)
+            return 0
+        if args.verify:
+            for line in tool.process_verify(args.path, args.hash,
+                                            args.workers):
+                tool.console_out(line)
+            return 0
+        if args.diff is not None:
+            for line in tool.process_diff(*args.diff):
+                tool.console_out(line)
+            return 0
+        if args.list and args.recursive:
+            for line in tool.process_filelist_recursive(args.path):
+                tool.console_out(line)
+            return 0
         if args.list:
             filelist = tool.process_filelist(args.path)
             for line in filelist:
                 tool.console_out(line)
             return 0
-        if args.replace is None:
+        if args.grep is not None:
+            for line in tool.process_grep(args.path, args.grep,
+                                          args.regex or args.glob,
+                                          args.regex is not None,
+                                          args.workers, args.binary):
+                tool.console_out(line)
+            return 0
+        if args.glob is not None or args.regex is not None:
+            tool.process_pattern_extract(args.path, args.regex or args.glob,
+                                         args.regex is not None,
+                                         args.workers)
+        elif args.compact:
+            tool.process_compact(args.path)
+        elif args.replace is None:
             tool.process_file_extract(args.path)
         else:
-            tool.set_jar_path(args.jarpath)
-            tool.process_file_update(args.path, args.replace)
+            if args.use_jar or args.jarpath is not None:
+                tool.set_jar_path(args.jarpath)
+            if args.fleet is not None:
+                for line in tool.process_fleet_update(
+                        args.path, args.fleet, args.replace, args.append,
+                        args.workers):
+                    tool.console_out(line)
+            elif args.append:
+                tool.process_file_append(args.path, args.replace)
+            else:
+                tool.process_file_update(args.path, args.replace)
         return 0
     except BaseException as ex:
         tool.console_err("Error occured! Please see the messages with -v")
@@ -1030,7 +5922,13 @@ def main():
         return 1
 
     finally:
+        tool.close()
         tool.clean_tmp_dir()
+        if args.stats:
+            for line in tool.stats_summary():
+                tool.console_err(line)
+        if args.trace is not None:
+            tool.write_trace(args.trace)
 
 if __name__ == '__main__':
     MAJOR, MINOR, MICRO, REL, SER = sys.version_info